@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Measure control plane throughput between a client and a server in the same
+process for each control message encoding.
+
+"""
+import timeit
+import time
+
+import tornado.ioloop
+from zmq.eventloop import ioloop
+
+# Install the zmq tornado IOLoop version
+ioloop.install()
+
+from streamkinect2.client import Client
+from streamkinect2.common import EndpointType, MessageType
+from streamkinect2.common import control_encoding_names, make_msg, parse_msg
+from streamkinect2.mock import MockKinect
+from streamkinect2.server import Server
+
+def benchmark_burst(client, send, n_messages):
+    """Send *n_messages* requests using *send*, which takes a response
+    callback, without waiting for replies and return the number of replies
+    received per second."""
+    io_loop = tornado.ioloop.IOLoop.instance()
+    n_replies = [0]
+
+    def reply(*args):
+        n_replies[0] += 1
+        if n_replies[0] == n_messages:
+            io_loop.stop()
+
+    then = time.time()
+    for _ in range(n_messages):
+        send(reply)
+    io_loop.start()
+    return n_messages / (time.time() - then)
+
+def benchmark_encoding(server, encoding, n_messages):
+    io_loop = tornado.ioloop.IOLoop.instance()
+
+    client = Client(server.endpoints[EndpointType.control], connect_immediately=True)
+    client.control_encodings = [encoding]
+
+    # Wait for the client to learn about the server
+    def check_connected():
+        if client.server_name is not None:
+            io_loop.stop()
+        else:
+            io_loop.add_callback(check_connected)
+    check_connected()
+    io_loop.start()
+    assert client.control_encoding == encoding
+
+    ping = lambda cb: client.ping(cb)
+    who = lambda cb: client._control_send(MessageType.who, recv_cb=cb)
+    print('{0:>8}: ping {1:8.0f} msg/sec, who {2:8.0f} msg/sec'.format(encoding,
+        benchmark_burst(client, ping, n_messages),
+        benchmark_burst(client, who, n_messages)))
+
+    client.disconnect()
+
+def benchmark_codec(encoding, type, payload, n_repeats=20000):
+    msg = make_msg(type, payload, encoding)
+    make_time = timeit.timeit(lambda: make_msg(type, payload, encoding), number=n_repeats)
+    parse_time = timeit.timeit(lambda: parse_msg(msg), number=n_repeats)
+    print('{0:>8}: {1:>4} {2:5d} bytes, make {3:6.2f} usec, parse {4:6.2f} usec'.format(
+        encoding, type.name, sum(len(p) for p in msg),
+        1e6 * make_time / n_repeats, 1e6 * parse_time / n_repeats))
+
+def main():
+    n_messages = 2000
+
+    with MockKinect() as kinect:
+        server = Server(address='127.0.0.1', start_immediately=True, announce=False)
+        server.add_kinect(kinect)
+
+        print('Control plane throughput for bursts of {0} requests:'.format(n_messages))
+        for encoding in control_encoding_names():
+            benchmark_encoding(server, encoding, n_messages)
+
+        print('Per-message cost:')
+        me = server._current_me()
+        for encoding in control_encoding_names():
+            benchmark_codec(encoding, MessageType.pong, { 'etag': server._etag })
+            benchmark_codec(encoding, MessageType.me, me)
+
+        server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -1,37 +1,201 @@
 from logging import getLogger
 import time
 
+import numpy as np
 import tornado.ioloop
+import zmq
 from zmq.eventloop import ioloop
 
 # Install the zmq tornado IOLoop version
 ioloop.install()
 
 from streamkinect2.mock import MockKinect
-from streamkinect2.compress import DepthFrameCompressor
+from streamkinect2.compress import DepthFrameCompressor, DepthFrameDecompressor
+from streamkinect2.compress import FrameHeader, codec_names, get_codec, make_frame_header
+from streamkinect2.compress import _compress_depth_frame
 
-def benchmark_compressed(wait_time):
+def benchmark_compressed(wait_time, backend='process', keyframe_interval=1, n_bands=1):
     io_loop = tornado.ioloop.IOLoop.instance()
 
-    print('Running compressed pipeline for {0} seconds...'.format(wait_time))
+    print('Running compressed pipeline with {0} backend, keyframe interval {1} '
+          'and {2} band(s) for {3} seconds...'.format(backend, keyframe_interval,
+              n_bands, wait_time))
     packets = []
+    latencies = []
     with MockKinect() as kinect:
-        fc = DepthFrameCompressor(kinect)
+        fc = DepthFrameCompressor(kinect, backend=backend,
+                keyframe_interval=keyframe_interval, n_bands=n_bands)
         @fc.on_compressed_frame.connect_via(fc)
         def new_compressed_frame(_, compressed_frame):
             packets.append(compressed_frame)
+            latencies.append(fc.latency)
 
         then = time.time()
-        io_loop.call_later(5, io_loop.stop)
+        io_loop.call_later(wait_time, io_loop.stop)
         io_loop.start()
         now = time.time()
 
     delta = now - then
-    data_size = sum(len(p) for p in packets)
+    data_size = sum(len(part) for p in packets for part in p)
     data_rate = float(data_size) / delta # bytes/sec
     pps = len(packets) / delta
     print('Mock kinect runs at {0:.2f} packets/second w/ compression'.format(pps))
     print('Data rate is {0:2f} Mbytes/second'.format(data_rate / (1024*1024)))
+    if len(latencies) > 0:
+        print('Mean compression latency is {0:.2f} ms (max {1:.2f} ms)'.format(
+            1e3 * sum(latencies) / len(latencies), 1e3 * max(latencies)))
+
+def benchmark_codecs(n_frames):
+    print('Compressing {0} frames with each codec...'.format(n_frames))
+    frames = []
+    with MockKinect() as kinect:
+        @kinect.on_depth_frame.connect_via(kinect)
+        def f(kinect, depth_frame):
+            if len(frames) < n_frames:
+                frames.append(depth_frame)
+        while len(frames) < n_frames:
+            time.sleep(0.1)
+
+    arrays = [
+        np.frombuffer(df.data, dtype=np.uint16).reshape(df.shape[::-1])
+        for df in frames
+    ]
+    raw_size = sum(a.nbytes for a in arrays)
+    for name in codec_names():
+        codec = get_codec(name)
+
+        then = time.time()
+        compressed = [codec.compress(a) for a in arrays]
+        compress_time = time.time() - then
+
+        out, scratch = np.empty_like(arrays[0]), {}
+        then = time.time()
+        for c in compressed:
+            codec.decompress(c, out, scratch)
+        decompress_time = time.time() - then
+
+        # Check a frame beyond the 12-bit range survives compression
+        far = arrays[-1] | 0xf000
+        codec.decompress(codec.compress(far), out, scratch)
+        lossless = np.all(out == far)
+
+        ratio = float(raw_size) / sum(len(c) for c in compressed)
+        print('{0:>12}: ratio {1:.2f}, compress {2:.1f} Mbytes/second, '
+              'decompress {3:.1f} Mbytes/second, {4}'.format(name, ratio,
+                  raw_size / compress_time / (1024*1024),
+                  raw_size / decompress_time / (1024*1024),
+                  'lossless' if lossless else 'lossy'))
+
+def benchmark_allocations(n_frames):
+    try:
+        import tracemalloc
+    except ImportError:
+        print('Allocation benchmark needs the tracemalloc module')
+        return
+
+    print('Measuring memory allocated while compressing {0} frames...'.format(n_frames))
+    frames = []
+    with MockKinect() as kinect:
+        @kinect.on_depth_frame.connect_via(kinect)
+        def f(kinect, depth_frame):
+            if len(frames) < n_frames + 1:
+                frames.append(depth_frame)
+        while len(frames) < n_frames + 1:
+            time.sleep(0.1)
+
+    # Working memory is not zero. The LZ4 codecs need about one compressed
+    # output bound, 0.75 frame sizes for lz4 and 1.0 for lz4_16bit and
+    # lz4_shuffle, which lz4 allocates itself. RVL delta frames need several
+    # frame sizes of index arrays since most residual samples need more than
+    # one nibble.
+    frame_size = len(frames[0].data)
+    for name in codec_names():
+        compress = get_codec(name).compress
+        for delta in (False, True):
+            # Let the worker allocate its scratch buffers before measuring. A
+            # frame compared with itself has an empty residual and so would not
+            # grow them to the size needed for real delta frames.
+            for reference, depth_frame in zip(frames[:-1], frames[1:]):
+                _compress_depth_frame(depth_frame, reference.data if delta else None, compress)
+
+            # The peak of traced memory less the compressed output is the
+            # working memory needed to compress each frame.
+            working = []
+            tracemalloc.start()
+            for reference, depth_frame in zip(frames[:-1], frames[1:]):
+                tracemalloc.clear_traces()
+                compressed = _compress_depth_frame(depth_frame,
+                        reference.data if delta else None, compress)
+                working.append(tracemalloc.get_traced_memory()[1] - len(compressed))
+            tracemalloc.stop()
+
+            print('{0:>12} {1:>5} frames: mean working memory {2:.2f} frame sizes'.format(
+                name, 'delta' if delta else 'key',
+                float(sum(working)) / len(working) / frame_size))
+
+def benchmark_zero_copy(n_frames, codec='raw'):
+    try:
+        import tracemalloc
+    except ImportError:
+        print('Zero-copy benchmark needs the tracemalloc module')
+        return
+
+    print('Sending and decoding {0} {1} frames over TCP with and without copying...'.format(
+        n_frames, codec))
+    frames = []
+    with MockKinect() as kinect:
+        @kinect.on_depth_frame.connect_via(kinect)
+        def f(kinect, depth_frame):
+            if len(frames) < n_frames:
+                frames.append(depth_frame)
+        while len(frames) < n_frames:
+            time.sleep(0.1)
+    codec = get_codec(codec)
+    messages = [
+        [
+            make_frame_header(FrameHeader(kinect_id='benchmark', seq=seq,
+                frame_type=0, codec_id=codec.id, background_id=0,
+                shape=df.shape, capture_time=0, compress_time=0)),
+            _compress_depth_frame(df, compress=codec.compress),
+        ]
+        for seq, df in enumerate(frames)
+    ]
+    frame_size = len(frames[0].data)
+
+    ctx = zmq.Context.instance()
+    pub, sub = ctx.socket(zmq.PUB), ctx.socket(zmq.SUB)
+    port = pub.bind_to_random_port('tcp://127.0.0.1')
+    sub.connect('tcp://127.0.0.1:{0}'.format(port))
+    sub.setsockopt(zmq.SUBSCRIBE, b'')
+    time.sleep(0.5) # wait for the subscription to arrive
+
+    for copy in (True, False):
+        # Let the decompressor allocate its frame buffer before measuring
+        decompressor = DepthFrameDecompressor()
+        decompressor.decompress(messages[0])
+
+        # Python objects allocated per message are copies of the frame data
+        # which zero-copy sends and receives avoid. Decoding is included since
+        # a decoder which copies its input undoes the saving.
+        tracemalloc.start()
+        then = time.time()
+        for msg in messages:
+            pub.send_multipart(msg, copy=copy)
+            received = sub.recv_multipart(copy=copy)
+            if not copy:
+                received = [part.buffer for part in received]
+            decompressor.decompress(received)
+            del received
+        elapsed = time.time() - then
+        allocated = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print('{0:>9}: {1:.2f} ms per frame, peak Python allocation {2:.2f} frame sizes'.format(
+            'copy' if copy else 'zero-copy', 1e3 * elapsed / n_frames,
+            float(allocated) / frame_size))
+
+    pub.close()
+    sub.close()
 
 def benchmark_mock(wait_time):
     io_loop = tornado.ioloop.IOLoop.instance()
@@ -44,7 +208,7 @@ def benchmark_mock(wait_time):
             state['n_frames'] += 1
 
         then = time.time()
-        io_loop.call_later(5, io_loop.stop)
+        io_loop.call_later(wait_time, io_loop.stop)
         io_loop.start()
         now = time.time()
 
@@ -54,7 +218,14 @@ def benchmark_mock(wait_time):
 
 def main():
     wait_time = 5
-    benchmark_compressed(wait_time)
+    for backend in ('process', 'thread', 'inline'):
+        benchmark_compressed(wait_time, backend)
+    benchmark_compressed(wait_time, keyframe_interval=30)
+    benchmark_compressed(wait_time, n_bands=4)
+    benchmark_codecs(60)
+    benchmark_allocations(20)
+    benchmark_zero_copy(100)
+    benchmark_zero_copy(100, 'lz4_shuffle')
     benchmark_mock(wait_time)
 
 if __name__ == '__main__':
@@ -4,7 +4,6 @@ Simple benchmark of how fast depth frames are delivered.
 
 """
 import logging
-import struct
 import threading
 import time
 from PIL import Image
@@ -14,8 +13,6 @@ from tornado.ioloop import IOLoop, PeriodicCallback
 from streamkinect2.server import ServerBrowser
 from streamkinect2.client import Client
 
-from lz4 import decompress, compress
-
 # Install the zmq ioloop
 from zmq.eventloop import ioloop
 ioloop.install()
@@ -47,12 +44,9 @@ class Benchmark(object):
             return
         self.count += 1
 
-        orig_len, data = depth_frame
-        orig_len = np.frombuffer(orig_len, '>i4')[0]
-        fw, fh = struct.unpack('>hh', depth_frame[1][:4])
-        frame_data = np.frombuffer(depth_frame[1][4:(4+2*fw*fh)], '>i2').reshape((fh,fw))
-        #print(frame_data.shape, (fw*fh))
-        frame = Image.fromarray(frame_data.astype(np.uint8), 'L')
+        fw, fh = depth_frame.shape
+        frame_data = np.frombuffer(depth_frame.data, np.uint16).reshape((fh,fw))
+        frame = Image.fromarray((frame_data >> 4).astype(np.uint8), 'L')
         frame.save('foo.png')
 
     def _report(self):
@@ -61,6 +55,13 @@ class Benchmark(object):
         log.info('Kinect "{0}", {1} frames in {2:.0f} seconds => {3:1f} fps'.format(
             self.kinect_id, self.count, delta, self.count/delta))
 
+        stats = self.client.depth_stream_stats(self.kinect_id)
+        if stats.header is not None:
+            log.info('Kinect "{0}", {1} frames lost, compression took {2:.1f} ms, '
+                     'latency {3:.1f} ms'.format(self.kinect_id, stats.n_lost,
+                         1e3 * (stats.header.compress_time - stats.header.capture_time),
+                         1e3 * stats.latency))
+
 class ClientWrapper(object):
     def __init__(self, client, io_loop=None):
         self.client = client
@@ -47,5 +47,6 @@ setup(
 
     extras_require={
         'docs': [ 'sphinx', 'docutils', ],
+        'msgpack': [ 'msgpack>=1.0', ],
     },
 )
@@ -3,9 +3,13 @@ Client
 ======
 
 """
-from collections import namedtuple, deque
+from collections import namedtuple
 from logging import getLogger
 import functools
+import heapq
+import os
+import struct
+import time
 
 from blinker import Signal
 import tornado.ioloop
@@ -13,11 +17,52 @@ import zmq
 from zmq.eventloop.zmqstream import ZMQStream
 
 from .common import EndpointType, ProtocolError, MessageType
-from .common import make_msg, parse_msg
+from .common import make_msg, parse_msg, control_encoding_names, _DEPTH_ENDPOINT_TYPES
+from .compress import DepthFrameDecompressor, get_codec, _FRAME_TOPIC
+from .ring import DepthFrameRingReader
 
 # Global logging object
 log = getLogger(__name__)
 
+# Control requests are identified by unsigned 32-bit integers which wrap around
+_REQUEST_ID_STRUCT = struct.Struct('<I')
+_REQUEST_ID_MODULUS = 1 << 32
+
+def _is_local_endpoint(address):
+    """Return *True* if *address* is an ipc:// endpoint on this host."""
+    return address.startswith('ipc://') and os.path.exists(address[len('ipc://'):])
+
+class DepthStreamStats(namedtuple('DepthStreamStats',
+        ['header', 'n_received', 'n_lost', 'latency'])):
+    """Statistics for the depth frames received from one device.
+
+    This is a subclass of the builtin :py:class:`tuple` class with named
+    accessors for convenience.
+
+    .. py:attribute:: header
+
+        The :py:class:`streamkinect2.compress.FrameHeader` of the most recently
+        received depth frame or *None* if no frame has been received. The
+        difference between its *compress_time* and *capture_time* gives the
+        time the frame spent being compressed.
+
+    .. py:attribute:: n_received
+
+        The number of depth frames received and successfully decompressed.
+
+    .. py:attribute:: n_lost
+
+        The number of depth frames which the server sent but which were not
+        received.
+
+    .. py:attribute:: latency
+
+        The time, in seconds, between the server receiving the most recent
+        depth frame from the device and the client receiving it or *None* if no
+        frame has been received. This relies on the client and server clocks
+        agreeing.
+    """
+
 class Client(object):
     """Client for a streaming kinect2 server.
 
@@ -56,6 +101,21 @@ class Client(object):
 
         *True* if the client is connected. *False* otherwise.
 
+    .. py:attribute:: control_encoding
+
+        The name of the encoding used for the payloads of control messages.
+        This is ``json`` until the server has said which encodings it supports
+        and then the first of :py:attr:`control_encodings` which it supports.
+
+    .. py:attribute:: control_encodings
+
+        A list of the names of the control message encodings the client may
+        use, most preferred first. See
+        :py:func:`streamkinect2.common.control_encoding_names`. By default the
+        more compact MessagePack encoding is preferred if the optional
+        ``msgpack`` package is installed and ``json`` is used otherwise. Set
+        this to ``['json']`` to always use JSON.
+
     The following attributes are mostly of use to the unit tests and advanced
     users.
 
@@ -63,12 +123,15 @@ class Client(object):
 
         The delay, in milliseconds, between "heartbeat" requests to the server.
         These are used to ensure the server is still alive. Changes to this
-        attribute are ignored once :py:meth:`connect` has been called.
+        attribute are ignored once :py:meth:`connect` has been called. The
+        list of devices is only fetched again if the server says that it has
+        changed.
 
     .. py:attribute:: response_timeout
 
         The maximum wait time, in milliseconds, the client waits for the server
-        to reply before giving up.
+        to reply to each request before giving up. Requests are not sent in
+        lockstep and so many may be awaiting replies at once.
 
     """
 
@@ -91,13 +154,19 @@ class Client(object):
     on_depth_frame = Signal()
     """A signal which is emitted when a new depth frame is available. Handlers
     should accept two keyword arguments: *depth_frame* which will be an
-    instance of an object with the same interface as :py:class:`DepthFrame` and
-    *kinect_id* which will be the unique id of the kinect device producing the
-    depth frame."""
+    instance of an object with the same interface as
+    :py:class:`streamkinect2.mock.DepthFrame` and *kinect_id* which will be the
+    unique id of the kinect device producing the depth frame.
+
+    The depth frame data is decompressed into a buffer which is re-used for
+    each subsequent frame from the same device. Handlers which need to keep the
+    frame data must copy it."""
 
     def __init__(self, control_endpoint, connect_immediately=False, zmq_ctx=None, io_loop=None):
         self.is_connected = False
         self.server_name = None
+        self.control_encoding = 'json'
+        self.control_encodings = control_encoding_names()
         self.endpoints = {
             EndpointType.control: control_endpoint
         }
@@ -112,19 +181,36 @@ class Client(object):
 
         self._io_loop = io_loop or tornado.ioloop.IOLoop.instance()
 
-        self._response_handlers = deque()
+        # Handlers for requests awaiting a reply keyed by request id
+        self._pending_requests = {}
+        self._next_request_id = 0
+
+        # Heap of (deadline, request id) pairs giving the time by which each
+        # request must be answered. Entries for answered requests are left in
+        # place until they reach the top of the heap or, if they come to
+        # outnumber the rest, the heap is rebuilt without them.
+        self._deadlines = []
+        self._n_stale_deadlines = 0
 
         # Heartbeat callback
         self._heartbeat_callback = None
 
+        # ETag of the last "me" payload received from the server
+        self._me_etag = None
+
         # Dictionary of device records keyed by id
         self._kinect_records = {}
 
         # ZMQStream for control socket
         self._control_stream = None
 
-        # Handle to timeout when waiting for a response
+        # Depth subscriber sockets keyed by endpoint address. Devices whose
+        # depth streams share a socket on the server share one here too.
+        self._depth_sockets = {}
+
+        # Handle to timeout for the earliest deadline and the deadline itself
         self._response_timeout_handle = None
+        self._response_timeout_deadline = None
 
         if connect_immediately:
             self.connect()
@@ -147,11 +233,82 @@ class Client(object):
 
         self._control_send(MessageType.ping, recv_cb=pong)
 
-    def enable_depth_frames(self, kinect_id):
+    def request_keyframe(self, kinect_id, ack_cb=None):
+        """Ask the server to send a keyframe as the next depth frame from the
+        device with id *kinect_id*. If *ack_cb* is not *None*, it is a callable
+        which is called with no arguments when the server has acknowledged the
+        request.
+
+        Delta coded depth frames cannot be decompressed until a keyframe has
+        been received and so this is done automatically by
+        :py:meth:`enable_depth_frames` when necessary.
+
+        """
+        self._ensure_connected()
+
+        def ack(type, payload, ack_cb=ack_cb):
+            if ack_cb is not None:
+                ack_cb()
+
+        self._control_send(MessageType.keyframe, { 'id': kinect_id }, recv_cb=ack)
+
+    def depth_stream_stats(self, kinect_id):
+        """Return a :py:class:`DepthStreamStats` describing the depth frames
+        received from the device with id *kinect_id*.
+
+        :raises ValueError: if depth frames have not been enabled for
+            *kinect_id* via :py:meth:`enable_depth_frames`
+
+        """
+        try:
+            stats = self._kinect_records[kinect_id].depth_stats
+        except KeyError:
+            stats = {}
+        if 'decompressor' not in stats:
+            raise ValueError('Depth frames are not enabled for kinect id "{0}"'.format(
+                kinect_id))
+
+        decompressor = stats['decompressor']
+        return DepthStreamStats(header=decompressor.header,
+                n_received=stats['n_received'], n_lost=decompressor.n_lost,
+                latency=stats['latency'])
+
+    def enable_depth_frames(self, kinect_id, endpoint_type=EndpointType.depth,
+            fps=None, decimation=1, roi=None, codec=None):
         """Enable streaming of depth frames. *kinect_id* is the id of the
         device which should have streaming enabled.
 
-        :raises ValueError: if *kinect_id* does not correspond to a connected device
+        *endpoint_type* selects the resolution of the depth frames. It may be
+        :py:attr:`EndpointType.depth` for full resolution frames or, if the
+        server advertises them for the device,
+        :py:attr:`EndpointType.depth_half` or
+        :py:attr:`EndpointType.depth_quarter` for downsampled frames. Depth
+        frames should be enabled for at most one of these per device.
+
+        If any of *fps*, *decimation*, *roi* or *codec* are given, the server
+        is asked for a stream of full resolution frames with at most *fps*
+        frames per second, only the (x, y, width, height) region *roi*, every
+        *decimation*-th sample and compressed with *codec*. See
+        :py:class:`streamkinect2.compress.DepthFrameSelector`. Frames arrive
+        once the server has agreed. If it refuses, an error is logged and no
+        frames arrive. Clients asking for the same profile share the work of
+        compressing it.
+
+        If the server publishes the depth streams of several devices on one
+        endpoint, a single connection to it carries the frames of every device
+        for which depth frames are enabled.
+
+        The fastest transport offered by the server is used. If the server is
+        on the same host and writes full resolution frames to shared memory,
+        frames without a profile are read from there without copying. Such
+        frames are only valid until the server re-uses their memory a few
+        frames later. Otherwise ``ipc://`` endpoints are preferred to TCP.
+
+        :raises ValueError: if *kinect_id* does not correspond to a connected
+            device, if the device has no endpoint of type *endpoint_type*, if
+            the device's depth codec or *codec* is not supported or if a
+            profile is given for an endpoint other than
+            :py:attr:`EndpointType.depth`
 
         """
         try:
@@ -159,21 +316,112 @@ class Client(object):
         except KeyError:
             raise ValueError('Kinect id "{0}" does not correspond to a connected device'.format(
                 kinect_id))
+        if endpoint_type not in _DEPTH_ENDPOINT_TYPES or \
+                endpoint_type not in record.endpoints:
+            raise ValueError('Kinect id "{0}" has no "{1}" depth endpoint'.format(
+                kinect_id, endpoint_type.name))
+
+        # Servers which do not advertise a codec use "lz4"
+        if fps is None and decimation == 1 and roi is None and codec is None:
+            if endpoint_type == EndpointType.depth and len(record.ring) > 0:
+                try:
+                    reader = DepthFrameRingReader(record.ring['path'])
+                except (IOError, OSError, ValueError) as e:
+                    log.warn('Cannot read depth frames of "{0}" from shared memory: {1}'.format(
+                        kinect_id, e))
+                else:
+                    self._subscribe_depth(kinect_id, record, endpoint_type,
+                            record.ring['endpoint'], _FRAME_TOPIC, reader)
+                    return
+            self._subscribe_depth(kinect_id, record, endpoint_type,
+                    record.endpoints[endpoint_type],
+                    record.topics.get(endpoint_type, _FRAME_TOPIC),
+                    DepthFrameDecompressor(codec=record.codecs.get(endpoint_type, 'lz4')))
+            return
+
+        if endpoint_type != EndpointType.depth:
+            raise ValueError('Stream profiles are only available for full resolution depth')
+        if codec is not None:
+            codec = get_codec(codec).name
+        self._ensure_connected()
 
-        # Create subscriber stream
-        socket = self._zmq_ctx.socket(zmq.SUB)
-        socket.connect(record.endpoints[EndpointType.depth])
-        socket.setsockopt_string(zmq.SUBSCRIBE, u'')
-        stream = ZMQStream(socket, self._io_loop)
-        record.streams[EndpointType.depth] = stream
+        def subscribed(type, payload):
+            if type != MessageType.subscribe:
+                log.error('Server refused depth stream profile for "{0}": {1}'.format(
+                    kinect_id, payload.get('reason') if payload else None))
+                return
+            self._subscribe_depth(kinect_id, record, endpoint_type,
+                    record.endpoints[endpoint_type], payload['topic'].encode('utf8'),
+                    DepthFrameDecompressor(codec=payload['codec']))
+
+        self._control_send(MessageType.subscribe, {
+            'id': kinect_id, 'fps': fps, 'decimation': decimation,
+            'roi': list(roi) if roi is not None else None, 'codec': codec,
+        }, recv_cb=subscribed)
+
+    def _subscribe_depth(self, kinect_id, record, endpoint_type, address, topic,
+            decompressor):
+        """Subscribe to the depth frames published under *topic* on the
+        endpoint at *address* for the endpoint *endpoint_type* of the device
+        with id *kinect_id*. The default stream is selected by the first byte
+        of the frame header. Frames from any other topic are preceded by a part
+        holding the topic. Frames are passed to the *decompress* method of
+        *decompressor*.
 
-        # Fire signal on incoming depth frame
+        """
+        # Each device has its own decompressor and hence its own frame buffer.
+        # A ring reader used by an earlier stream is no longer needed.
+        stats = record.depth_stats
+        self._close_ring_reader(record)
+        stats.update(decompressor=decompressor, n_received=0, latency=None)
+
+        # Create or re-use the subscriber stream for this endpoint
+        depth_socket = self._depth_sockets.get(address)
+        if depth_socket is None:
+            socket = self._zmq_ctx.socket(zmq.SUB)
+            socket.connect(address)
+            stream = ZMQStream(socket, self._io_loop)
+            stream.on_recv(functools.partial(self._depth_recv, address), copy=False)
+            depth_socket = Client._DepthSocket(stream=stream, handlers={})
+            self._depth_sockets[address] = depth_socket
+        if topic not in depth_socket.handlers:
+            depth_socket.stream.socket.setsockopt(zmq.SUBSCRIBE, topic)
+        record.streams[endpoint_type] = depth_socket.stream
+
+        # Only have one keyframe request outstanding at a time
+        state = { 'requesting_keyframe': False }
+        def request_keyframe():
+            if state['requesting_keyframe'] or not self.is_connected:
+                return
+            state['requesting_keyframe'] = True
+            def ack():
+                state['requesting_keyframe'] = False
+            self.request_keyframe(kinect_id, ack)
+
+        # Fire signal on incoming depth frame. Frames are received without
+        # copying and decompressed directly from ZeroMQ's buffers.
         def on_recv(msg, kinect_id=kinect_id):
-            # TODO: decompress frame
-            self.on_depth_frame.send(self, kinect_id=kinect_id, depth_frame=msg)
+            received_at = time.time()
+            try:
+                depth_frame = decompressor.decompress([part.buffer for part in msg])
+            except ValueError as e:
+                log.warn('Dropping bad depth frame from "{0}": {1}'.format(kinect_id, e))
+                depth_frame = None
+
+            if depth_frame is None:
+                # We need a keyframe before we can continue
+                request_keyframe()
+                return
+
+            stats['n_received'] += 1
+            stats['latency'] = received_at - decompressor.header.capture_time
+            self.on_depth_frame.send(self, kinect_id=kinect_id, depth_frame=depth_frame)
 
         # Wire up callback
-        stream.on_recv(on_recv)
+        depth_socket.handlers[topic] = on_recv
+
+        # Ask for a keyframe so that we need not wait for the next one
+        request_keyframe()
 
     def connect(self):
         """Explicitly connect the client."""
@@ -194,7 +442,7 @@ class Client(object):
 
         # Create and start the heartbeat callback
         self._heartbeat_callback = tornado.ioloop.PeriodicCallback(
-                self._who_me, self.heartbeat_period, self._io_loop)
+                self._heartbeat, self.heartbeat_period, self._io_loop)
         self._heartbeat_callback.start()
 
         # Finally, signal connection
@@ -206,9 +454,15 @@ class Client(object):
             log.warn('Client not connected')
             return
 
-        # Cancel any pending response timeout
-        if self._response_timeout_handle is not None:
-            self._io_loop.remove_timeout(self._response_timeout_handle)
+        # The server may have changed by the time we reconnect
+        self._me_etag = None
+        self.control_encoding = 'json'
+
+        # Forget any pending requests and cancel their timeout
+        self._pending_requests = {}
+        self._deadlines = []
+        self._n_stale_deadlines = 0
+        self._arm_response_timeout()
 
         # Stop heartbeat callback
         if self._heartbeat_callback is not None:
@@ -218,12 +472,33 @@ class Client(object):
         # TODO: check if disconnect() on the sockets is necessary
         self._control_stream = None
 
+        # Close depth streams so that the server knows to stop sending frames
+        for depth_socket in self._depth_sockets.values():
+            depth_socket.stream.close()
+        self._depth_sockets = {}
+        for record in self._kinect_records.values():
+            for ep_type in record.streams:
+                record.streams[ep_type] = None
+            self._close_ring_reader(record)
+
         self.is_connected = False
 
         # Finally, signal disconnection
         self.on_disconnect.send(self)
 
-    _KinectRecord = namedtuple('_KinectRecord', ['endpoints', 'streams'])
+    def _close_ring_reader(self, record):
+        """Unmap the shared memory ring, if any, from which depth frames of the
+        device with record *record* are read.
+
+        """
+        reader = record.depth_stats.get('decompressor')
+        if isinstance(reader, DepthFrameRingReader):
+            reader.close()
+
+    _KinectRecord = namedtuple('_KinectRecord',
+            ['endpoints', 'streams', 'codecs', 'topics', 'ring', 'depth_stats'])
+
+    _DepthSocket = namedtuple('_DepthSocket', ['stream', 'handlers'])
 
     def _who_me(self):
         """Request the list of endpoints from the server.
@@ -242,6 +517,16 @@ class Client(object):
 
             # Fill in server information
             self.server_name = payload['name']
+            self._me_etag = payload.get('etag')
+
+            # Use the most preferred encoding the server supports. Servers
+            # which do not say support only JSON.
+            server_encodings = payload.get('encodings', ['json'])
+            self.control_encoding = 'json'
+            for encoding in self.control_encodings:
+                if encoding in server_encodings:
+                    self.control_encoding = encoding
+                    break
             log.info('Server identifies itself as "{0}"'.format(self.server_name))
 
             # Remember the old kinect ids
@@ -255,7 +540,8 @@ class Client(object):
                 try:
                     record = self._kinect_records[device['id']]
                 except KeyError:
-                    record = Client._KinectRecord(endpoints={}, streams={})
+                    record = Client._KinectRecord(endpoints={}, streams={}, codecs={},
+                            topics={}, ring={}, depth_stats={})
                 new_records[device['id']] = record
 
                 # Fill in endpoint and stream dictionaries for device
@@ -267,6 +553,12 @@ class Client(object):
                     except KeyError:
                         pass
 
+                    # Prefer an endpoint on this host if there is one
+                    local_ep = device.get('local_endpoints', {}).get(ep_type.name)
+                    if ep is not None and local_ep is not None and \
+                            _is_local_endpoint(local_ep):
+                        ep = local_ep
+
                     if ep is None and ep_type in record.endpoints:
                         # Endpoint has gone away but was there
                         del record.endpoints[ep_type]
@@ -281,7 +573,33 @@ class Client(object):
                             # subscribing to services we do not need.
                             record.streams[ep_type] = None
 
-            # Update kinect records
+                    # Record the codec used by this endpoint, if any
+                    try:
+                        record.codecs[ep_type] = device['codecs'][ep_type.name]
+                    except KeyError:
+                        record.codecs.pop(ep_type, None)
+
+                    # Record the topic of this endpoint's stream if it shares
+                    # a socket with other devices
+                    try:
+                        record.topics[ep_type] = device['topics'][ep_type.name].encode('utf8')
+                    except KeyError:
+                        record.topics.pop(ep_type, None)
+
+                # Record where to find the device's shared memory ring if it
+                # is on this host
+                ring = device.get('ring')
+                if ring is not None and _is_local_endpoint(ring['endpoint']) and \
+                        os.path.exists(ring['path']):
+                    record.ring.update(ring)
+                else:
+                    record.ring.clear()
+
+            # Update kinect records. Devices which have gone no longer need
+            # their rings.
+            for k_id, record in self._kinect_records.items():
+                if k_id not in new_records:
+                    self._close_ring_reader(record)
             self._kinect_records = new_records
 
             # Fill in out server endpoint list from payload
@@ -310,6 +628,19 @@ class Client(object):
         log.info('Requesting server identity')
         self._control_send(MessageType.who, recv_cb=got_me)
 
+    def _heartbeat(self):
+        """Check that the server is still alive and fetch its list of devices
+        if it has changed. Servers which give no ETag are always asked for
+        their list of devices.
+
+        """
+        def pong(type, payload):
+            etag = payload.get('etag') if isinstance(payload, dict) else None
+            if etag is None or etag != self._me_etag:
+                self._who_me()
+
+        self._control_send(MessageType.ping, recv_cb=pong)
+
     def _ensure_connected(self):
         if not self.is_connected:
             raise RuntimeError('Client is not connected')
@@ -329,26 +660,30 @@ class Client(object):
             self._control_stream = None
 
         # Create, connect and wire up control socket listener
-        control_socket = self._zmq_ctx.socket(zmq.REQ)
+        control_socket = self._zmq_ctx.socket(zmq.DEALER)
         control_socket.connect(control_endpoint)
         self._control_stream = ZMQStream(control_socket, self._io_loop)
         self._control_stream.on_recv(self._control_recv)
 
     def _control_send(self, type, payload=None, recv_cb=None):
-        """Send *payload* formatted as a JSON object along the control socket.
-        If *recv_cb* is not *None*, it is a callable which is called with the
-        type and Python object representing the response payload from the
-        server. If there is no payload, None is passed.
+        """Send *payload* encoded with :py:attr:`control_encoding` along the
+        control socket. If *recv_cb* is not *None*, it is a callable which is
+        called with the type and Python object representing the response
+        payload from the server. If there is no payload, None is passed.
 
         """
-        # (Re-)set response timeout
-        if self._response_timeout_handle is not None:
-            self._io_loop.remove_timeout(self._response_timeout_handle)
-        self._io_loop.call_later(self.response_timeout * 1e-3, self._response_timed_out)
+        request_id = _REQUEST_ID_STRUCT.pack(self._next_request_id)
+        self._next_request_id = (self._next_request_id + 1) % _REQUEST_ID_MODULUS
+
+        # Record the response handler and when the response is due
+        self._pending_requests[request_id] = recv_cb
+        heapq.heappush(self._deadlines,
+                (self._io_loop.time() + self.response_timeout * 1e-3, request_id))
+        self._arm_response_timeout()
 
-        # Add the response handler and send the message
-        self._response_handlers.append(recv_cb)
-        self._control_stream.send_multipart(make_msg(type, payload))
+        # Send the message with an envelope holding the request id
+        self._control_stream.send_multipart([request_id, b''] +
+                make_msg(type, payload, self.control_encoding))
 
     def _control_recv(self, msg):
         """Called when there is something to be received on the control socket."""
@@ -356,19 +691,84 @@ class Client(object):
         if not self.is_connected:
             return
 
+        # Find the request this is a reply to. It may have timed out.
+        if len(msg) < 2 or msg[1] != b'':
+            log.warn('Client received a reply without a request id')
+            return
+        try:
+            handler = self._pending_requests.pop(msg[0])
+        except KeyError:
+            log.warn('Client received a reply to an unknown request')
+            return
+
+        # Free the deadlines of answered requests once they are the majority
+        self._n_stale_deadlines += 1
+        if self._n_stale_deadlines > len(self._deadlines) // 2:
+            self._deadlines = [d for d in self._deadlines if d[1] in self._pending_requests]
+            heapq.heapify(self._deadlines)
+            self._n_stale_deadlines = 0
+        self._arm_response_timeout()
+
         # Parse message
-        type, payload = parse_msg(msg)
+        type, payload = parse_msg(msg[2:])
 
         # Do we have a recv handler?
-        handler = self._response_handlers.popleft()
         if handler is not None:
             handler(type, payload)
 
+    def _arm_response_timeout(self):
+        """Make sure that the response timeout fires at the earliest deadline
+        of the pending requests or not at all if there are none.
+
+        """
+        # Discard the deadlines of answered requests from the top of the heap
+        while len(self._deadlines) > 0 and self._deadlines[0][1] not in self._pending_requests:
+            heapq.heappop(self._deadlines)
+            self._n_stale_deadlines -= 1
+
+        deadline = self._deadlines[0][0] if len(self._deadlines) > 0 else None
+        if deadline == self._response_timeout_deadline:
+            return
+
+        if self._response_timeout_handle is not None:
+            self._io_loop.remove_timeout(self._response_timeout_handle)
+            self._response_timeout_handle = None
+        if deadline is not None:
+            self._response_timeout_handle = self._io_loop.call_at(deadline,
+                    self._response_timed_out)
+        self._response_timeout_deadline = deadline
+
+    def _depth_recv(self, address, msg):
+        """Called when a depth frame is received from the endpoint at
+        *address*. The frame is passed, without any topic part, to the handler
+        for its topic.
+
+        """
+        try:
+            handlers = self._depth_sockets[address].handlers
+        except KeyError:
+            return
+
+        # Frames of the default stream start with their header. Others start
+        # with a part holding the topic.
+        topic = msg[0].bytes
+        if topic in handlers:
+            handlers[topic](msg[1:])
+        elif topic[:1] == _FRAME_TOPIC and _FRAME_TOPIC in handlers:
+            handlers[_FRAME_TOPIC](msg)
+
     def _response_timed_out(self):
         """Called when the response timeout fires."""
-        # Do nothing if already disconnected or if there are no pending requests
-        if not self.is_connected or len(self._response_handlers) == 0:
+        self._response_timeout_handle = None
+        self._response_timeout_deadline = None
+
+        # Do nothing if already disconnected
+        if not self.is_connected:
             return
 
-        log.error('Client timed out while waiting for server response')
-        self.disconnect()
+        # Disconnect if the earliest pending request is overdue
+        self._arm_response_timeout()
+        if self._response_timeout_deadline is not None and \
+                self._response_timeout_deadline <= self._io_loop.time():
+            log.error('Client timed out while waiting for server response')
+            self.disconnect()
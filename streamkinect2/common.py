@@ -3,8 +3,15 @@ Common elements for both client and server
 ==========================================
 
 """
+from collections import namedtuple
 import enum
 import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 class ProtocolError(RuntimeError):
     """Raised when some low-level error in the network protocol has been
@@ -23,9 +30,24 @@ class EndpointType(enum.Enum):
 
         A *PUB* endpoint which broadcasts compressed depth frames to connected subscribers.
 
+    .. py:attribute:: depth_half
+
+        As for *depth* but broadcasting frames of half the width and height.
+
+    .. py:attribute:: depth_quarter
+
+        As for *depth* but broadcasting frames of a quarter of the width and
+        height.
+
     """
     control = 1
     depth = 2
+    depth_half = 3
+    depth_quarter = 4
+
+# Endpoints which broadcast depth frames ordered by decreasing resolution
+_DEPTH_ENDPOINT_TYPES = (EndpointType.depth, EndpointType.depth_half,
+        EndpointType.depth_quarter)
 
 class MessageType(enum.Enum):
     error = b'\x00'
@@ -33,16 +55,103 @@ class MessageType(enum.Enum):
     pong = b'\x02'
     who = b'\x03'
     me = b'\x04'
+    keyframe = b'\x05'
+    subscribe = b'\x06'
+
+def _dump_msgpack(payload):
+    return msgpack.packb(payload, use_bin_type=True)
+
+def _load_msgpack(data):
+    try:
+        return msgpack.unpackb(bytes(data), raw=False)
+    except Exception as e:
+        raise ValueError('Bad MessagePack payload: {0}'.format(e))
+
+def _dump_json(payload):
+    return json.dumps(payload).encode('utf8')
+
+def _load_json(data):
+    return json.loads(bytes(data).decode('utf8'))
+
+class _Encoding(namedtuple('_Encoding', ['id', 'name', 'dumps', 'loads'])):
+    pass
+
+# Control payload encodings in order of preference. The id of a message's
+# encoding is held in the top four bits of its type byte so that JSON, id 0,
+# is used by clients and servers which know of no other. MessagePack is more
+# compact and faster to parse and so is preferred if the optional msgpack
+# package is installed.
+_ENCODINGS = [
+    _Encoding(id=0, name='json', dumps=_dump_json, loads=_load_json),
+]
+if msgpack is not None:
+    _ENCODINGS.insert(0,
+        _Encoding(id=1, name='msgpack', dumps=_dump_msgpack, loads=_load_msgpack))
+_ENCODINGS_BY_NAME = dict((e.name, e) for e in _ENCODINGS)
+
+# Message type and payload encoding for each valid type byte and the type
+# byte for each pair
+_TYPES_BY_BYTE = {}
+_BYTES_BY_TYPE = {}
+for _type in MessageType:
+    for _encoding in _ENCODINGS:
+        _byte = struct.pack('B', _encoding.id << 4 | ord(_type.value))
+        _TYPES_BY_BYTE[_byte] = (_type, _encoding)
+        _BYTES_BY_TYPE[(_type, _encoding.name)] = _byte
 
-def make_msg(type, payload):
+def control_encoding_names():
+    """Return a list of the names of the supported control message payload
+    encodings in decreasing order of preference. ``msgpack`` is supported,
+    and preferred, if the optional ``msgpack`` package is installed. ``json``
+    is always supported.
+
+    """
+    return [e.name for e in _ENCODINGS]
+
+def make_msg(type, payload, encoding='json'):
+    """Return a multipart control message of type *type*, a
+    :py:class:`MessageType`, with *payload* encoded using the encoding named
+    *encoding*. If *payload* is *None*, the message has no payload.
+
+    :raises ValueError: if *encoding* is unknown or *payload* cannot be
+        encoded
+
+    """
+    try:
+        type_byte = _BYTES_BY_TYPE[(type, encoding)]
+    except KeyError:
+        raise ValueError('Unknown control message encoding "{0}"'.format(encoding))
     if payload is None:
-        return [type.value,]
-    return [type.value, json.dumps(payload).encode('utf8')]
+        return [type_byte,]
+    return [type_byte, _ENCODINGS_BY_NAME[encoding].dumps(payload)]
 
 def parse_msg(msg):
+    """Parse the multipart control message *msg* and return its
+    :py:class:`MessageType` and payload. The payload is *None* if there is
+    none.
+
+    :raises ValueError: if *msg* is malformed
+
+    """
+    try:
+        type, encoding = _TYPES_BY_BYTE[bytes(msg[0])]
+    except (IndexError, KeyError):
+        raise ValueError('Unknown message type')
+
     if len(msg) == 1:
-        return MessageType(msg[0]), None
+        return type, None
     elif len(msg) == 2:
-        return MessageType(msg[0]), json.loads(msg[1].decode('utf8'))
+        return type, encoding.loads(msg[1])
 
     raise ValueError('Multipart message must have length 1 or 2')
+
+def msg_encoding(msg):
+    """Return the name of the encoding used by the multipart control message
+    *msg*. Replies should use the same encoding. Malformed messages are taken
+    to use ``json``.
+
+    """
+    try:
+        return _TYPES_BY_BYTE[bytes(msg[0])][1].name
+    except (IndexError, KeyError):
+        return 'json'
@@ -4,33 +4,989 @@ Depth frame compression
 
 """
 from logging import getLogger
-from io import BytesIO
-from multiprocessing.pool import Pool
+from multiprocessing.pool import Pool, ThreadPool
+from multiprocessing.sharedctypes import RawArray
 from multiprocessing import cpu_count
+from collections import deque, namedtuple
+import functools
+import struct
+import threading
+import time
 
 from blinker import Signal
 import lz4
 import numpy as np
 import tornado.ioloop
 
+from .mock import DepthFrame
+
+# Releases of lz4 from 0.10 provide lz4.block whose functions accept any
+# buffer. Earlier releases provide only lz4.dumps and lz4.loads which accept
+# only bytes on Python 3. Both use the same format.
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
 log = getLogger(__name__)
 
-def _compress_depth_frame(depth_frame):
+# The (width, height) of a Kinect v2 depth frame. Buffers for compressing and
+# decompressing frames are sized for this shape by default.
+DEFAULT_DEPTH_FRAME_SHAPE = (512, 424)
+
+# Frame types recorded in the header of each compressed frame. A keyframe can
+# be decompressed on its own. A delta frame holds the bitwise XOR of a frame
+# with the one before it. A foreground frame holds a mask of the samples which
+# do not match the background model and a frame with the samples which match
+# it zeroed. A background frame holds a new
+# background model followed by a foreground frame relative to it. A tile frame
+# holds only those tiles of a frame which changed since the frame before it.
+_KEYFRAME = 0
+_DELTA_FRAME = 1
+_BACKGROUND_FRAME = 2
+_FOREGROUND_FRAME = 3
+_TILE_FRAME = 4
+_FRAME_TYPES = (_KEYFRAME, _DELTA_FRAME, _BACKGROUND_FRAME, _FOREGROUND_FRAME,
+        _TILE_FRAME)
+
+# Fixed layout of a frame header: version, frame type, codec id, background
+# id, sequence number, capture time, compression time, width and height. The
+# UTF-8 encoded kinect id fills the remainder of the header part.
+_HEADER_VERSION = 1
+_HEADER_STRUCT = struct.Struct('<BBBBIddHH')
+
+# Every frame header starts with the version byte and so subscribers to a PUB
+# socket select frames which are not prefixed by some other topic with it.
+_FRAME_TOPIC = struct.pack('B', _HEADER_VERSION)
+
+# Sequence numbers are unsigned 32-bit integers which wrap around
+_SEQ_MODULUS = 1 << 32
+
+class FrameHeader(namedtuple('FrameHeader',
+        ['kinect_id', 'seq', 'frame_type', 'codec_id', 'background_id',
+         'shape', 'capture_time', 'compress_time'])):
+    r"""The header sent as the first part of each compressed frame message. Use
+    :py:func:`make_frame_header` and :py:func:`parse_frame_header` to convert
+    to and from the wire format.
+
+    This is a subclass of the builtin :py:class:`tuple` class with named
+    accessors for convenience.
+
+    .. py:attribute:: kinect_id
+
+        The unique id of the kinect which produced the frame.
+
+    .. py:attribute:: seq
+
+        The sequence number of the frame. This increases by one, modulo
+        2\ :sup:`32`, for each frame sent by a compressor and so a gap
+        indicates that frames have been lost.
+
+    .. py:attribute:: frame_type
+
+        Zero if the frame is a keyframe, one if it is a delta frame, two if it
+        is a background frame, three if it is a foreground frame and four if
+        it is a tile frame.
+
+    .. py:attribute:: codec_id
+
+        The id of the :py:class:`Codec` used to compress the frame.
+
+    .. py:attribute:: background_id
+
+        For background and foreground frames, a number identifying the
+        background model the frame uses. This increases by one, modulo 256,
+        each time the model is sent. Zero for other frames.
+
+    .. py:attribute:: shape
+
+        Pair giving the width and height of the frame.
+
+    .. py:attribute:: capture_time
+
+        The time, in seconds since the epoch, at which the frame was received
+        from the kinect.
+
+    .. py:attribute:: compress_time
+
+        The time, in seconds since the epoch, at which compression of the frame
+        finished.
+    """
+
+def make_frame_header(header):
+    """Return a :py:class:`bytes` object encoding the :py:class:`FrameHeader`
+    *header*.
+
+    """
+    w, h = header.shape
+    return _HEADER_STRUCT.pack(_HEADER_VERSION, header.frame_type,
+            header.codec_id, header.background_id, header.seq % _SEQ_MODULUS,
+            header.capture_time, header.compress_time, w, h) + \
+            header.kinect_id.encode('utf8')
+
+def parse_frame_header(data):
+    """Parse *data*, a buffer-like object encoding a frame header, and return
+    a :py:class:`FrameHeader`.
+
+    :raises ValueError: if *data* is not a valid frame header
+
+    """
+    data = bytes(data)
+    if len(data) < _HEADER_STRUCT.size:
+        raise ValueError('Frame header is too short')
+    version, frame_type, codec_id, background_id, seq, capture_time, \
+            compress_time, w, h = _HEADER_STRUCT.unpack_from(data)
+    if version != _HEADER_VERSION:
+        raise ValueError('Unknown frame header version {0}'.format(version))
+    if frame_type not in _FRAME_TYPES:
+        raise ValueError('Unknown frame type {0}'.format(frame_type))
+    return FrameHeader(kinect_id=data[_HEADER_STRUCT.size:].decode('utf8'),
+            seq=seq, frame_type=frame_type, codec_id=codec_id,
+            background_id=background_id, shape=(w, h),
+            capture_time=capture_time, compress_time=compress_time)
+
+class Codec(namedtuple('Codec',
+        ['id', 'name', 'compress', 'decompress', 'keyframe_interval'])):
+    """A depth frame codec which may be registered with
+    :py:func:`register_codec`.
+
+    This is a subclass of the builtin :py:class:`tuple` class with named
+    accessors for convenience.
+
+    .. py:attribute:: id
+
+        A small integer uniquely identifying the codec.
+
+    .. py:attribute:: name
+
+        A string uniquely naming the codec. This is the name advertised to
+        clients.
+
+    .. py:attribute:: compress
+
+        A callable which takes a C-ordered height by width array of uint16
+        depth samples and returns a buffer-like object containing the
+        compressed samples. This is called in worker processes and so must be
+        a module-level function.
+
+    .. py:attribute:: decompress
+
+        A callable which takes a compressed buffer, a C-ordered height by
+        width uint16 array to decompress into and a :py:class:`dict` which the
+        codec may use to keep scratch arrays between calls. It should raise
+        :py:class:`ValueError` if the buffer does not match the array's shape.
+
+    .. py:attribute:: keyframe_interval
+
+        The default number of frames between keyframes when streams use this
+        codec. If one, every frame is a keyframe and delta coding is disabled.
+    """
+
+# Registered codecs keyed by name and by id
+_CODECS_BY_NAME = {}
+_CODECS_BY_ID = {}
+
+def register_codec(codec):
+    """Register a :py:class:`Codec`. Codecs should be registered when a module
+    is imported so that worker processes know of them.
+
+    :raises ValueError: if a codec with the same name or id is already registered
+
+    """
+    if codec.name in _CODECS_BY_NAME or codec.id in _CODECS_BY_ID:
+        raise ValueError('Codec "{0}" or id {1} already registered'.format(
+            codec.name, codec.id))
+    _CODECS_BY_NAME[codec.name] = codec
+    _CODECS_BY_ID[codec.id] = codec
+
+def get_codec(name):
+    """Return the registered :py:class:`Codec` with name *name*. For
+    convenience, if *name* is a :py:class:`Codec` it is returned unchanged.
+
+    :raises ValueError: if there is no codec named *name*
+
+    """
+    if isinstance(name, Codec):
+        return name
+    try:
+        return _CODECS_BY_NAME[name]
+    except KeyError:
+        raise ValueError('Unknown codec "{0}"'.format(name))
+
+def _get_codec_by_id(codec_id):
+    try:
+        return _CODECS_BY_ID[codec_id]
+    except KeyError:
+        raise ValueError('Unknown codec id {0}'.format(codec_id))
+
+def codec_names():
+    """Return a list of the names of all registered codecs."""
+    return sorted(_CODECS_BY_NAME.keys())
+
+# Shared memory frame slots used by a worker process. Set by _init_worker.
+_worker_slots = None
+
+def _init_worker(slots):
+    """Initialise a worker process with the list of shared memory frame slots
+    it shares with the parent :py:class:`CompressionPool`.
+
+    """
+    global _worker_slots
+    _worker_slots = slots
+
+def _band_rows(height, n_bands):
+    """Return a list of (start, stop) pairs giving the rows of each of
+    *n_bands* horizontal bands which together cover *height* rows.
+
+    """
+    bounds = [(height * idx) // n_bands for idx in range(n_bands + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def _frame_band(depth_frame, reference, rows):
+    """Return a (depth_frame, reference) pair holding only the band of rows
+    given by the (start, stop) pair *rows*. *reference* may be *None*.
+
+    """
+    w = depth_frame.shape[0]
+    start, stop = rows
+    band = DepthFrame(data=np.frombuffer(depth_frame.data, dtype=np.uint16)[start*w:stop*w],
+            shape=(w, stop-start))
+    if reference is not None:
+        reference = np.frombuffer(reference, dtype=np.uint16)[start*w:stop*w]
+    return band, reference
+
+def _compress_depth_frame_slot(slot, shape, compress, rows=None):
+    """Compress a depth frame of shape *shape* which the parent process has
+    copied into shared memory slot *slot*. Only the slot index, shape,
+    compression function and band cross the process boundary.
+
+    """
+    w, h = shape
+    d = np.frombuffer(_worker_slots[slot], dtype=np.uint16, count=w*h)
+    return _compress_depth_frame(DepthFrame(data=d, shape=shape), compress=compress,
+            rows=rows)
+
+def _compress_depth_frame(depth_frame, reference=None, compress=None, rows=None,
+        threshold=None):
+    """Compress *depth_frame* with the codec compression function *compress*.
+    If *compress* is *None*, the ``lz4`` codec is used. If *reference* is not
+    *None*, it is the raw data of a reference frame and the residual computed
+    by :py:func:`_subtract_reference` with *threshold* is compressed instead.
+    If *rows* is not *None*, it is a (start, stop) pair and only that band of
+    rows is compressed.
+
+    """
     try:
         d = np.frombuffer(depth_frame.data, dtype=np.uint16).reshape(
                 depth_frame.shape[::-1], order='C')
-        high_bits = ((d >> 4) & 0xff).astype(np.uint8)
-        low_bits = (d & 0xf).astype(np.uint8)
-        packed_low_bits = (low_bits[:,0::2]<<4) | low_bits[:,1::2]
-
-        bio = BytesIO()
-        bio.write(np.asarray(high_bits, order='C').data)
-        bio.write(np.asarray(packed_low_bits, order='C').data)
-        return lz4.dumps(bio.getvalue())
+        if reference is not None:
+            r = np.frombuffer(reference, dtype=np.uint16).reshape(d.shape)
+        if rows is not None:
+            d = d[rows[0]:rows[1]]
+            if reference is not None:
+                r = r[rows[0]:rows[1]]
+        if reference is not None:
+            residual = _scratch_buffer(2*d.size, 'residual').view(np.uint16)
+            d = _subtract_reference(d, r, threshold, residual.reshape(d.shape))
+        return (compress or _compress_lz4)(d)
     except Exception as e:
         print('Error: {0}'.format(e))
         return None
 
+def _on_band_error(callback, e):
+    """Error callback for a band submitted to a worker pool. The band is
+    passed to *callback* as having failed so that its frame, and the frame's
+    slot, are still released.
+
+    """
+    log.warn('Compressing depth frame band raised {0} exception'.format(e))
+    callback(None)
+
+def _subtract_reference(d, reference, threshold, out):
+    """Write the residual of the uint16 array *d* with respect to the
+    reference frame *reference* into *out* and return *out*. If *threshold* is
+    *None*, the residual is the bitwise XOR of the two. Otherwise it is *d*
+    with each sample within *threshold* of the reference set to zero.
+
+    """
+    if threshold is None:
+        return np.bitwise_xor(d, reference, out=out)
+
+    matches = _scratch_buffer(d.size, 'matches').view(np.bool_).reshape(d.shape)
+    _absolute_difference(d, reference, out, matches)
+    np.less_equal(out, threshold, out=matches)
+    np.copyto(out, d)
+    np.copyto(out, 0, where=matches)
+    return out
+
+def _foreground_mask(d, reference, threshold):
+    """Return the LZ4 compressed bitmap of those samples of the uint16 array
+    *d* which differ from the reference frame *reference* by more than
+    *threshold*. There is one bit per sample, in row-major order, packed most
+    significant bit first. Unlike the zeroed samples of the residual, the
+    bitmap distinguishes a foreground sample which is zero from one matching
+    the background.
+
+    """
+    d = d.reshape(-1)
+    diff = _scratch_buffer(2*d.size, 'mask_diff').view(np.uint16)
+    foreground = _scratch_buffer(d.size, 'mask').view(np.bool_)
+    _absolute_difference(d, reference.reshape(-1), diff, foreground)
+    np.greater(diff, threshold, out=foreground)
+    return _lz4_compress(np.packbits(foreground))
+
+def _absolute_difference(a, b, out, wrapped):
+    """Write the absolute difference of the uint16 arrays *a* and *b* into
+    *out*. *wrapped* is a boolean array of the same shape used as scratch
+    space.
+
+    """
+    # Stay within uint16 by negating, modulo 2**16, those differences which
+    # wrapped around
+    np.subtract(a, b, out=out)
+    np.less(a, b, out=wrapped)
+    np.negative(out, out=out, where=wrapped)
+    return out
+
+# Side length of the square tiles used by dirty-tile coding
+_TILE_SIZE = 16
+
+def _tile_grid(shape):
+    """Return the number of rows and columns of tiles needed to cover a frame
+    whose (width, height) is *shape*.
+
+    """
+    w, h = shape
+    return -(-h // _TILE_SIZE), -(-w // _TILE_SIZE)
+
+def _tiles(padded):
+    """Return a view of *padded*, an array whose sides are a multiple of the
+    tile size, indexed by tile row, tile column, row and column.
+
+    """
+    rows, cols = padded.shape[0] // _TILE_SIZE, padded.shape[1] // _TILE_SIZE
+    return padded.reshape((rows, _TILE_SIZE, cols, _TILE_SIZE)).swapaxes(1, 2)
+
+# Scratch space for the calling worker keyed by name. Each worker process or
+# thread compresses one frame at a time and so intermediate results are
+# written into buffers which are re-used for every frame.
+_worker_scratch = threading.local()
+
+def _scratch_buffer(size, name='planes'):
+    """Return a uint8 array of *size* bytes belonging to the calling worker.
+    Its contents are only valid until the next call with the same *name*.
+
+    """
+    buffers = getattr(_worker_scratch, 'buffers', None)
+    if buffers is None:
+        buffers = _worker_scratch.buffers = {}
+    buf = buffers.get(name)
+    if buf is None or buf.shape[0] < size:
+        buf = buffers[name] = np.empty(size, dtype=np.uint8)
+    return buf[:size]
+
+def _split_12bit(d, out):
+    """Write the low 12 bits of each sample in the height by width array *d*
+    into the uint8 array *out* as a height by width plane of bits 4 to 11
+    followed by a height by width / 2 plane of packed bits 0 to 3. Casting to
+    uint8 discards the bits which do not belong in each plane.
+
+    """
+    h, w = d.shape
+    high_bits = out[:h*w].reshape((h, w))
+    packed_low_bits = out[h*w:h*w + h*(w>>1)].reshape((h, w>>1))
+    nibbles = _scratch_buffer(h*(w>>1), 'nibbles').reshape((h, w>>1))
+
+    np.right_shift(d, 4, out=high_bits, casting='unsafe')
+    np.left_shift(d[:,0::2], 4, out=packed_low_bits, casting='unsafe')
+    np.bitwise_and(d[:,1::2], 0xf, out=nibbles, casting='unsafe')
+    packed_low_bits |= nibbles
+
+def _shuffle_bytes(d, out):
+    """Write a plane of the most significant byte of each sample in *d*
+    followed by a plane of the least significant byte into the uint8 array
+    *out*.
+
+    """
+    samples = np.asarray(d, dtype='<u2').reshape(-1).view(np.uint8).reshape((-1, 2))
+    n = samples.shape[0]
+    np.copyto(out[:n], samples[:,1])
+    np.copyto(out[n:2*n], samples[:,0])
+
+def _check_size(data, expected_size, out):
+    if data.shape[0] != expected_size:
+        raise ValueError('Compressed frame does not match frame shape {0}'.format(
+            out.shape[::-1]))
+
+def _compress_raw(d):
+    return bytes(np.asarray(d, dtype='<u2', order='C').data)
+
+def _decompress_raw(compressed, out, scratch):
+    data = np.frombuffer(compressed, dtype='<u2')
+    _check_size(data, out.size, out)
+    np.copyto(out, data.reshape(out.shape))
+
+def _lz4_compress(data):
+    """LZ4 compress the contiguous buffer *data*. The buffer is only copied if
+    the installed lz4 cannot read from it directly.
+
+    """
+    if lz4_block is not None:
+        return lz4_block.compress(data)
+    return lz4.dumps(memoryview(data).tobytes())
+
+def _lz4_decompress(compressed):
+    """Decompress the LZ4 compressed buffer *compressed*. Zero-copy message
+    parts are passed straight to lz4 unless the installed lz4 accepts only
+    bytes.
+
+    """
+    if lz4_block is not None:
+        return lz4_block.decompress(compressed)
+    if not isinstance(compressed, bytes):
+        compressed = memoryview(compressed).tobytes()
+    return lz4.loads(compressed)
+
+def _compress_lz4(d):
+    h, w = d.shape
+    planes = _scratch_buffer(h*w + h*(w>>1))
+    _split_12bit(d, planes)
+    return _lz4_compress(planes)
+
+def _decompress_lz4(compressed, out, scratch):
+    """Decompress *compressed*, as produced by :py:func:`_compress_lz4`, into
+    the C-ordered uint16 array *out*. A uint8 array with half as many columns
+    as *out* is kept in *scratch* for intermediate results so that no
+    per-frame arrays are allocated beyond the decompressed LZ4 data itself.
+
+    """
+    h, w = out.shape
+    data = np.frombuffer(_lz4_decompress(compressed), dtype=np.uint8)
+    _check_size(data, h*w + h*(w>>1), out)
+
+    high_bits = data[:h*w].reshape((h, w))
+    packed_low_bits = data[h*w:].reshape((h, w>>1))
+
+    nibbles = scratch.get('nibbles')
+    if nibbles is None or nibbles.shape != packed_low_bits.shape:
+        nibbles = scratch['nibbles'] = np.zeros_like(packed_low_bits)
+
+    # Reverse the bit-splitting performed by _compress_lz4 in-place.
+    np.copyto(out, high_bits)
+    out <<= 4
+    np.right_shift(packed_low_bits, 4, out=nibbles)
+    out[:,0::2] |= nibbles
+    np.bitwise_and(packed_low_bits, 0xf, out=nibbles)
+    out[:,1::2] |= nibbles
+
+def _compress_lz4_16bit(d):
+    return _lz4_compress(np.ascontiguousarray(d, dtype='<u2'))
+
+def _decompress_lz4_16bit(compressed, out, scratch):
+    _decompress_raw(_lz4_decompress(compressed), out, scratch)
+
+def _compress_lz4_shuffle(d):
+    """Compress all 16 bits of *d* by LZ4 compressing a plane of the most
+    significant byte of each sample followed by a plane of the least
+    significant byte. Neighbouring depth samples rarely differ in their high
+    byte and so the first plane compresses far better than interleaved
+    samples.
+
+    """
+    planes = _scratch_buffer(2 * d.size)
+    _shuffle_bytes(d, planes)
+    return _lz4_compress(planes)
+
+def _decompress_lz4_shuffle(compressed, out, scratch):
+    data = np.frombuffer(_lz4_decompress(compressed), dtype=np.uint8)
+    _check_size(data, 2*out.size, out)
+
+    planes = data.reshape((2,) + out.shape)
+    np.copyto(out, planes[0])
+    out <<= 8
+    out |= planes[1]
+
+def _scratch_array(scratch, name, size, dtype):
+    """Return a one-dimensional array of *size* elements of *dtype* kept in the
+    dict *scratch* under *name*, growing it if necessary. Its contents are only
+    valid until the next call with the same *name*.
+
+    """
+    buf = scratch.get(name)
+    if buf is None or buf.shape[0] < size:
+        buf = scratch[name] = np.empty(size, dtype=dtype)
+    return buf[:size]
+
+def _rvl_nibbles(tokens):
+    """Return the variable-length nibble encoding of the uint32 array *tokens*
+    zero-padded to a whole number of words. Each value is written as 3-bit
+    chunks, least significant first, with the top bit of each nibble set if
+    further chunks follow. The result is only valid until the next call.
+
+    """
+    # Most values need only one nibble. Those which need more are few and so
+    # are handled by index while the rest are handled by mask.
+    n = tokens.shape[0]
+    is_multi = _scratch_buffer(n, 'rvl_is_multi').view(np.bool_)
+    np.greater_equal(tokens, 0x8, out=is_multi)
+    multi = np.flatnonzero(is_multi)
+    multi_values = tokens[multi]
+    counts = np.ones(multi.shape[0], dtype=np.intp)
+    for shift in range(3, 32, 3):
+        counts += multi_values >= (1 << shift)
+
+    # The nibbles of each value follow those of all earlier values
+    multi_starts = multi + (np.cumsum(counts) - counts) - np.arange(multi.shape[0])
+    n_nibbles = n + int(counts.sum()) - multi.shape[0]
+    nibbles = _scratch_buffer(n_nibbles + (-n_nibbles) % 8, 'rvl_nibbles')
+    nibbles[n_nibbles:] = 0
+    is_first = _scratch_buffer(n_nibbles, 'rvl_is_first').view(np.bool_)
+    is_first[...] = True
+
+    # Write the later nibbles of each value which has them and then the first
+    # nibble of every value into the remaining places
+    for k in range(1, int(counts.max()) if counts.shape[0] > 0 else 1):
+        selected = counts > k
+        positions = multi_starts[selected] + k
+        chunk = ((multi_values[selected] >> (3 * k)) & 0x7).astype(np.uint8)
+        chunk[counts[selected] > k + 1] |= 0x8
+        nibbles[positions] = chunk
+        is_first[positions] = False
+    first = _scratch_buffer(n, 'rvl_first')
+    np.bitwise_and(tokens, 0x7, out=first, casting='unsafe')
+    first[multi] |= 0x8
+    nibbles[:n_nibbles][is_first] = first
+    return nibbles
+
+def _compress_rvl(d):
+    """Compress *d* with the run-length variable-length (RVL) algorithm
+    described in "Fast Lossless Depth Image Compression" by Andrew D. Wilson.
+    Runs of zero and non-zero samples alternate, starting with a zero run.
+    Each non-zero run is followed by the zig-zag encoded difference, modulo
+    2**16, of each sample from the previous non-zero sample. All integers are
+    variable-length nibble encoded and the nibbles packed into little-endian
+    32-bit words, most significant nibble first.
+
+    """
+    flat = np.ascontiguousarray(d, dtype=np.uint16).reshape(-1)
+    n = flat.shape[0]
+
+    # Find the start and end of each non-zero run. The mask of non-zero
+    # samples is padded with a zero sample at either end so that every run
+    # starts and ends at a change.
+    padded = _scratch_buffer(n + 2, 'rvl_nonzero').view(np.bool_)
+    padded[0] = padded[-1] = False
+    nonzero = padded[1:-1]
+    np.not_equal(flat, 0, out=nonzero)
+    changes = _scratch_buffer(n + 1, 'rvl_changes').view(np.bool_)
+    np.not_equal(padded[1:], padded[:-1], out=changes)
+    edges = np.flatnonzero(changes)
+    run_starts, run_ends = edges[0::2], edges[1::2]
+
+    # Each pair is a zero run followed by a non-zero run. If the frame ends in
+    # zeros, there is a final pair with an empty non-zero run.
+    zero_runs = run_starts - np.concatenate(([0], run_ends[:-1]))
+    nonzero_runs = run_ends - run_starts
+    if len(run_ends) == 0 or run_ends[-1] != n:
+        zero_runs = np.append(zero_runs, n - (run_ends[-1] if len(run_ends) > 0 else 0))
+        nonzero_runs = np.append(nonzero_runs, 0)
+
+    # Zig-zag encoded differences between successive non-zero samples. These
+    # wrap around modulo 2**16 and so need only 16 bits.
+    n_values = int(nonzero_runs.sum())
+    values = flat[nonzero]
+    deltas = _scratch_buffer(2 * n_values, 'rvl_deltas').view(np.uint16)
+    if n_values > 0:
+        deltas[0] = values[0]
+        np.subtract(values[1:], values[:-1], out=deltas[1:])
+    signed_deltas = deltas.view(np.int16)
+    signs = _scratch_buffer(2 * n_values, 'rvl_signs').view(np.int16)
+    np.right_shift(signed_deltas, 15, out=signs)
+    np.left_shift(signed_deltas, 1, out=signed_deltas)
+    np.bitwise_xor(signed_deltas, signs, out=signed_deltas)
+
+    # Interleave the run lengths and differences. Pair i starts after the
+    # 2*i run lengths and the differences of all earlier pairs.
+    n_pairs = zero_runs.shape[0]
+    n_tokens = 2 * n_pairs + n_values
+    pair_starts = 2 * np.arange(n_pairs) + (np.cumsum(nonzero_runs) - nonzero_runs)
+    tokens = _scratch_buffer(4 * n_tokens, 'rvl_tokens').view(np.uint32)
+    is_value = _scratch_buffer(n_tokens, 'rvl_is_value').view(np.bool_)
+    is_value[...] = True
+    is_value[pair_starts] = False
+    is_value[pair_starts + 1] = False
+    tokens[pair_starts] = zero_runs
+    tokens[pair_starts + 1] = nonzero_runs
+    tokens[is_value] = deltas
+
+    # Pack nibbles into words of eight, most significant first
+    nibble_pairs = _rvl_nibbles(tokens).reshape((-1, 4, 2))[:, ::-1]
+    words = np.empty(nibble_pairs.shape[:2], dtype=np.uint8)
+    np.left_shift(nibble_pairs[:, :, 0], 4, out=words)
+    words |= nibble_pairs[:, :, 1]
+    return words.tobytes()
+
+def _decompress_rvl(compressed, out, scratch):
+    data = np.frombuffer(compressed, dtype=np.uint8)
+    if data.shape[0] % 4 != 0:
+        raise ValueError('RVL data must be a whole number of words')
+    if data.shape[0] == 0:
+        raise ValueError('RVL data is empty')
+
+    # Unpack nibbles, most significant first within each word
+    n_nibbles = 2 * data.shape[0]
+    nibbles = _scratch_array(scratch, 'nibbles', n_nibbles, np.uint8)
+    nibble_pairs = nibbles.reshape((-1, 4, 2))
+    words = data.reshape((-1, 4))[:, ::-1]
+    np.right_shift(words, 4, out=nibble_pairs[:, :, 0])
+    np.bitwise_and(words, 0xf, out=nibble_pairs[:, :, 1])
+
+    # Decode variable-length integers. A token ends at each nibble without its
+    # continuation bit set. Most tokens are that nibble alone.
+    is_end = _scratch_array(scratch, 'is_end', n_nibbles, np.bool_)
+    np.less(nibbles, 0x8, out=is_end)
+    end_nibbles = nibbles[is_end]
+    n_tokens = end_nibbles.shape[0]
+    tokens = _scratch_array(scratch, 'tokens', n_tokens, '<u4')
+    tokens[...] = end_nibbles
+
+    # The few continuation nibbles belong to the token ending at the next end
+    # nibble. Shift the end nibble of each such token above them and add them
+    # in.
+    continued = np.flatnonzero(~is_end)
+    owners = continued - np.arange(continued.shape[0])
+    n_continued = int(np.searchsorted(owners, n_tokens))
+    continued, owners = continued[:n_continued], owners[:n_continued]
+    if n_continued > 0:
+        is_first = np.empty(n_continued, dtype=np.bool_)
+        is_first[0] = True
+        np.not_equal(owners[1:], owners[:-1], out=is_first[1:])
+        firsts = np.flatnonzero(is_first)
+        lengths = np.diff(np.append(firsts, n_continued))
+        if lengths.max() > 10:
+            raise ValueError('RVL integer is too large')
+        chunks = np.arange(n_continued) - np.repeat(firsts, lengths)
+        tokens[owners[firsts]] <<= (3 * lengths).astype(np.uint32)
+        np.bitwise_or.at(tokens, owners,
+                (nibbles[continued] & 0x7).astype(np.uint32) << (3 * chunks).astype(np.uint32))
+
+    # Walk the run-length pairs to find where each starts. The start of each
+    # pair depends on the pair before it and so this visits each run, rather
+    # than each sample, in turn.
+    n_samples = out.size
+    token = tokens.item
+    pair_starts = []
+    n_decoded, pos = 0, 0
+    while n_decoded < n_samples and pos + 1 < n_tokens:
+        pair_starts.append(pos)
+        nonzeros = token(pos + 1)
+        n_decoded += token(pos) + nonzeros
+        pos += 2 + nonzeros
+    if n_decoded != n_samples or pos > n_tokens:
+        raise ValueError('Compressed frame does not match frame shape {0}'.format(
+            out.shape[::-1]))
+    pair_starts = np.array(pair_starts, dtype=np.intp)
+    runs = np.empty(2 * pair_starts.shape[0], dtype=np.intp)
+    runs[0::2] = tokens[pair_starts]
+    runs[1::2] = tokens[pair_starts + 1]
+
+    # Every other token before the end of the last pair is a zig-zag encoded
+    # difference. Undo the encoding modulo 2**16, which needs only the low
+    # half of each token once shifted, and sum the differences.
+    is_value = _scratch_array(scratch, 'is_value', pos, np.bool_)
+    is_value[...] = True
+    is_value[pair_starts] = False
+    is_value[pair_starts + 1] = False
+    differences = tokens[:pos]
+    signs = _scratch_array(scratch, 'signs', pos, np.uint16)
+    np.bitwise_and(differences, 1, out=signs, casting='unsafe')
+    np.negative(signs, out=signs)
+    differences >>= 1
+    np.bitwise_xor(differences.view('<u2')[0::2], signs, out=signs)
+    values = signs[is_value]
+    np.cumsum(values, dtype=np.uint16, out=values)
+
+    # Mark the non-zero samples by adding one at the start of each non-zero
+    # run and subtracting one at its end and then summing
+    bounds = np.cumsum(runs)
+    marks = _scratch_array(scratch, 'marks', n_samples + 1, np.int8)
+    marks[...] = 0
+    np.add.at(marks, bounds[0::2], 1)
+    np.subtract.at(marks, bounds[1::2], 1)
+    np.cumsum(marks, dtype=np.int8, out=marks)
+
+    flat = out.reshape(-1)
+    flat[...] = 0
+    flat[marks[:n_samples].view(np.bool_)] = values
+
+# Uncompressed little-endian samples.
+register_codec(Codec(id=0, name='raw',
+    compress=_compress_raw, decompress=_decompress_raw, keyframe_interval=1))
+
+# The low 12 bits of each sample split into a plane of the high 8 bits and a
+# plane of packed low nibbles which are then LZ4 compressed. Samples beyond
+# 4095mm wrap.
+register_codec(Codec(id=1, name='lz4',
+    compress=_compress_lz4, decompress=_decompress_lz4, keyframe_interval=1))
+
+# LZ4 compressed little-endian samples. Lossless.
+register_codec(Codec(id=2, name='lz4_16bit',
+    compress=_compress_lz4_16bit, decompress=_decompress_lz4_16bit,
+    keyframe_interval=1))
+
+# As for lz4 but with delta coding enabled by default.
+register_codec(Codec(id=3, name='delta',
+    compress=_compress_lz4, decompress=_decompress_lz4, keyframe_interval=30))
+
+# Run-length variable-length coding of all 16 bits. Lossless. Implemented
+# with numpy rather than a compiled library and so, on the mock frames, about
+# half as fast as lz4 to compress, several times slower to decompress and with
+# a worse ratio. It suits frames with many invalid, zero, samples, although
+# decompression visits each run of them in turn.
+register_codec(Codec(id=4, name='rvl',
+    compress=_compress_rvl, decompress=_decompress_rvl, keyframe_interval=1))
+
+# LZ4 compressed planes of the high and low bytes of each sample. Lossless.
+register_codec(Codec(id=5, name='lz4_shuffle',
+    compress=_compress_lz4_shuffle, decompress=_decompress_lz4_shuffle,
+    keyframe_interval=1))
+
+class CompressionPool(object):
+    """
+    A pool of compression workers which may be shared between many
+    :py:class:`DepthFrameCompressor` instances.
+
+    *backend* selects where frames are compressed. It may be one of:
+
+    ``'process'``
+        A pool of worker processes. Frames are handed to the workers through a
+        ring of shared memory slots, one per frame which may be in flight, so
+        that only a slot index need be sent to the worker. Frames larger than
+        :py:data:`DEFAULT_DEPTH_FRAME_SHAPE` do not fit in a slot and are sent
+        to the worker directly.
+
+    ``'thread'``
+        A pool of worker threads within this process. Since LZ4 and NumPy
+        release the GIL for most of their work, this avoids inter-process
+        communication entirely. Workers operate directly on the frame data
+        without copying it.
+
+    ``'inline'``
+        Frames are compressed synchronously on the thread which emits them.
+
+    *workers* is the number of worker processes or threads. If *None*, the
+    number of CPUs is used.
+
+    Compressors sharing a pool are served in round-robin order. Each
+    compressor holds at most one frame waiting for a free worker and, when a
+    worker becomes free, the compressor which has waited longest is served
+    first. Hence one busy kinect cannot starve the others.
+
+    :raises ValueError: if *backend* is not recognised
+
+    .. py:attribute:: backend
+
+        The name of the compression backend in use.
+
+    .. py:attribute:: max_in_flight
+
+        The maximum number of frames which may be being compressed at any one
+        time.
+    """
+
+    # The supported compression backends
+    _BACKENDS = ('process', 'thread', 'inline')
+
+    # The size, in bytes, of each shared memory frame slot.
+    _SLOT_SIZE = DEFAULT_DEPTH_FRAME_SHAPE[0] * DEFAULT_DEPTH_FRAME_SHAPE[1] * 2
+
+    def __init__(self, backend='process', workers=None):
+        # Worker pool, if any. Set first since __del__ relies on it.
+        self._pool = None
+
+        if backend not in CompressionPool._BACKENDS:
+            raise ValueError('Unknown compression backend "{0}"'.format(backend))
+
+        workers = workers or cpu_count()
+
+        # Public attributes
+        self.backend = backend
+        self.max_in_flight = workers + 1
+
+        # Private attributes
+        self._lock = threading.Lock()
+        self._waiting = deque() # compressors with a frame ready to submit
+
+        # Frame slots. A frame is in flight for as long as it holds a slot and
+        # so the free list also limits the number of frames in flight. Only
+        # the process backend needs slots to be backed by shared memory.
+        self._free_slots = list(range(self.max_in_flight))
+        self._slot_arrays = None
+
+        if backend == 'process':
+            slots = [RawArray('B', CompressionPool._SLOT_SIZE)
+                    for _ in self._free_slots]
+            self._slot_arrays = [np.frombuffer(slot, dtype=np.uint16) for slot in slots]
+            self._pool = Pool(workers, initializer=_init_worker, initargs=(slots,))
+        elif backend == 'thread':
+            self._pool = ThreadPool(workers)
+
+    def __del__(self):
+        self.terminate()
+
+    def terminate(self):
+        """Terminate the worker pool. Frames submitted after this call are
+        dropped.
+
+        """
+        # As a courtesy, terminate the worker pool to avoid having a sea of
+        # dangling processes.
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def _frame_ready(self, compressor):
+        """Called by *compressor* when it has a pending frame."""
+        with self._lock:
+            self._enqueue(compressor)
+        self._schedule()
+
+    def _enqueue(self, compressor):
+        # Must be called with the lock held
+        if compressor._pending is None or compressor._is_waiting:
+            return
+        if compressor._n_in_flight >= compressor._in_flight_limit:
+            return
+        compressor._is_waiting = True
+        self._waiting.append(compressor)
+
+    # A frame submitted to the pool. The shape is that of the frame being sent
+    # which, for tile frames, differs from that of the tiles being compressed.
+    # The tile map and foreground mask, if any, are sent before the bands.
+    _Job = namedtuple('_Job',
+            ['seq', 'frame_type', 'depth_frame', 'reference', 'capture_time',
+             'background', 'background_id', 'shape', 'tile_map', 'foreground_mask'])
+
+    def _schedule(self):
+        """Submit pending frames from waiting compressors in round-robin order
+        while there are free slots.
+
+        """
+        while True:
+            with self._lock:
+                if len(self._free_slots) == 0 or len(self._waiting) == 0:
+                    return
+                compressor = self._waiting.popleft()
+                compressor._is_waiting = False
+                depth_frame, compressor._pending = compressor._pending, None
+                compressor._n_in_flight += 1
+                slot = self._free_slots.pop()
+
+                # Frames must be prepared in the order they are submitted
+                job = compressor._prepare(depth_frame, compressor._pending_capture_time)
+
+            self._submit(compressor, slot, job)
+
+    def _submit(self, compressor, slot, job):
+        if self._pool is None and self.backend != 'inline':
+            # The pool has been terminated. Drop the frame and return its slot.
+            self._on_compressed_frame(compressor, slot, job, time.time(), None)
+            return
+
+        depth_frame, reference = job.depth_frame, job.reference
+        compress = compressor.codec.compress
+        bands = _band_rows(depth_frame.shape[1], compressor.n_bands)
+
+        # Background and foreground frames are relative to the background model
+        threshold = None
+        if job.frame_type in (_BACKGROUND_FRAME, _FOREGROUND_FRAME):
+            threshold = compressor.background_threshold
+
+        # Bands are compressed concurrently and may complete in any order. The
+        # frame has been compressed once the last band arrives. Background
+        # frames send each band of the background model before the frame.
+        n_parts = len(bands) if job.background is None else 2 * len(bands)
+        parts = [None] * n_parts
+        n_remaining = [n_parts]
+        submitted_at = time.time()
+        def on_band(idx, compressed_band):
+            with self._lock:
+                parts[idx] = compressed_band
+                n_remaining[0] -= 1
+                if n_remaining[0] > 0:
+                    return
+            compressed_frame = None if any(p is None for p in parts) else parts
+            self._on_compressed_frame(compressor, slot, job, submitted_at,
+                    compressed_frame)
+        callbacks = [functools.partial(on_band, idx) for idx in range(n_parts)]
+
+        if job.background is not None:
+            self._submit_bands(callbacks[:len(bands)], bands, job.background,
+                    None, compress, None)
+            callbacks = callbacks[len(bands):]
+
+        if self._slot_arrays is not None:
+            frame = np.frombuffer(depth_frame.data, dtype=np.uint16)
+            slot_array = self._slot_arrays[slot]
+            if frame.shape[0] <= slot_array.shape[0]:
+                # Copy the frame, or its residual from the reference, into
+                # shared memory and send only the slot index
+                if reference is None:
+                    slot_array[:frame.shape[0]] = frame
+                else:
+                    _subtract_reference(frame, np.frombuffer(reference, dtype=np.uint16),
+                            threshold, slot_array[:frame.shape[0]])
+                for callback, rows in zip(callbacks, bands):
+                    self._pool.apply_async(_compress_depth_frame_slot,
+                            args=(slot, depth_frame.shape, compress, rows),
+                            callback=callback,
+                            error_callback=functools.partial(_on_band_error, callback))
+                return
+
+        self._submit_bands(callbacks, bands, depth_frame, reference, compress, threshold)
+
+    def _submit_bands(self, callbacks, bands, depth_frame, reference, compress, threshold):
+        """Compress each band of *depth_frame* without a shared memory slot,
+        passing the result for each band to the corresponding callback.
+
+        """
+        for callback, rows in zip(callbacks, bands):
+            if self.backend == 'inline':
+                callback(_compress_depth_frame(depth_frame, reference, compress, rows,
+                    threshold))
+            elif self.backend == 'process':
+                # The frame is too large for a slot and so only each band's rows
+                # are sent to the worker process
+                band, band_reference = _frame_band(depth_frame, reference, rows)
+                self._pool.apply_async(_compress_depth_frame,
+                        args=(band, band_reference, compress, None, threshold),
+                        callback=callback,
+                        error_callback=functools.partial(_on_band_error, callback))
+            else:
+                # Thread workers share our address space and so can use the
+                # frame directly
+                self._pool.apply_async(_compress_depth_frame,
+                        args=(depth_frame, reference, compress, rows, threshold),
+                        callback=callback,
+                        error_callback=functools.partial(_on_band_error, callback))
+
+    def _on_compressed_frame(self, compressor, slot, job, submitted_at, compressed_frame):
+        # Record arrival of frame by returning its slot
+        with self._lock:
+            self._free_slots.append(slot)
+            compressor._n_in_flight -= 1
+
+            # If the compressor is keeping up, let an adaptive limit recover
+            if compressor._pending is None and \
+                    compressor._in_flight_limit < compressor.max_in_flight:
+                compressor._in_flight_limit += 1
+
+            self._enqueue(compressor)
+            compressor._on_compressed_frame(job, compressed_frame,
+                    time.time() - submitted_at)
+
+        self._schedule()
+
 class DepthFrameCompressor(object):
     """
     Asynchronous compression pipeline for depth frames.
@@ -43,43 +999,435 @@ class DepthFrameCompressor(object):
     :py:class:`tornado.ioloop.IOLoop` which is used to co-ordinate the worker
     process. If not provided, the global instance is used.
 
+    *pool* is the :py:class:`CompressionPool` used to compress frames. If
+    *None*, a new pool is created for this compressor using the backend named
+    by *backend*. See :py:class:`CompressionPool` for the supported backends.
+
+    *max_in_flight* is the maximum number of frames from this compressor which
+    may be being compressed at any one time. If *None*, the limit is that of
+    the pool.
+
+    *codec* is the name of the registered :py:class:`Codec` used to compress
+    frames. See :py:func:`codec_names` for the available codecs.
+
+    *keyframe_interval* enables temporal delta coding if greater than one. If
+    *None*, the codec's default interval is used. In
+    that case only every *keyframe_interval*-th frame is compressed on its own
+    as a "keyframe". The frames in between are compressed as the bitwise XOR
+    with the previous frame which, for a mostly static scene, is mostly zero
+    and so compresses far better. A subscriber joining part way through the
+    stream may call :py:meth:`request_keyframe` to avoid waiting for the next
+    keyframe. Compressed frames are always emitted in the order the depth
+    frames were received.
+
+    *n_bands* splits each frame into that many horizontal bands of rows which
+    are compressed concurrently by the pool's workers and sent as separate
+    message parts. This lowers the latency of compressing a single frame when
+    workers would otherwise be idle at the cost of slightly worse compression.
+
+    At most one frame may be waiting for a worker to become free. *drop_policy*
+    specifies what happens when a new frame arrives while one is waiting. It
+    may be one of:
+
+    ``'drop_newest'``
+        The new frame is dropped and the waiting frame is kept.
+
+    ``'replace_pending'``
+        The waiting frame is dropped and replaced by the new frame. This
+        minimises latency at the cost of completeness since the frame which is
+        eventually compressed is always the latest one.
+
+    ``'adaptive'``
+        As for ``'replace_pending'`` but, in addition, the number of frames
+        from this compressor allowed in flight is halved each time a frame is
+        replaced and grows again by one for each frame compressed while no
+        frame is waiting. Frames already submitted to a worker cannot be
+        replaced and so this keeps as many frames as possible replaceable while
+        the compressor is overloaded.
+
+    If *tiles* is *True*, each frame is divided into 16 by 16 tiles and only
+    those tiles in which some sample differs by more than *tile_threshold*
+    from the frame the client last saw are sent, along with a bitmap of which
+    tiles were sent. Quiet scenes then cost little more than the bitmap. The
+    compressor keeps its own copy of the client's frame and so errors do not
+    accumulate beyond *tile_threshold*, but a non-zero threshold makes the
+    stream lossy. Every *keyframe_interval* frames, or 300 frames if it is
+    *None*, a keyframe is sent instead.
+
+    If *background* is *True*, the compressor keeps a model of the static
+    background of the scene. The model is the furthest depth seen at each
+    sample since it was last sent and so people and other moving objects only
+    become part of it if they stay still for the whole time. Every
+    *keyframe_interval* frames, or when a keyframe is requested, the model is
+    sent in place of a keyframe. If *keyframe_interval* is *None*, the model is
+    sent every 300 frames. All other frames are sent as foreground frames in
+    which every sample within *background_threshold* of the model is zeroed.
+    These compress far better than a full frame when the camera is fixed. Each
+    is sent with a mask of the samples which are not within the threshold. On
+    decompression, samples outside the mask are replaced by the model, so
+    samples within the threshold of the model take the model's value.
+
+    :raises ValueError: if *backend*, *codec* or *drop_policy* is not
+        recognised, if *keyframe_interval* or *n_bands* is less than one, if
+        *background_threshold* or *tile_threshold* is not between 0 and 32767
+        or if both *background* and *tiles* are *True*
+
     .. py:attribute:: kinect
 
         Kinect object associated with this compressor.
+
+    .. py:attribute:: pool
+
+        The :py:class:`CompressionPool` used by this compressor.
+
+    .. py:attribute:: max_in_flight
+
+        The maximum number of frames from this compressor which may be being
+        compressed at any one time.
+
+    .. py:attribute:: drop_policy
+
+        The name of the policy used to drop frames when overloaded.
+
+    .. py:attribute:: codec
+
+        The :py:class:`Codec` used to compress frames.
+
+    .. py:attribute:: keyframe_interval
+
+        The number of frames between keyframes.
+
+    .. py:attribute:: n_bands
+
+        The number of bands each frame is split into for compression.
+
+    .. py:attribute:: background
+
+        *True* if frames are compressed relative to a background model.
+
+    .. py:attribute:: background_threshold
+
+        The maximum difference from the background model of a sample which is
+        treated as background.
+
+    .. py:attribute:: tiles
+
+        *True* if only changed tiles of each frame are sent.
+
+    .. py:attribute:: tile_threshold
+
+        The maximum difference of a sample from the client's frame which does
+        not mark its tile as changed.
+
+    .. py:attribute:: is_paused
+
+        *True* if depth frames from the kinect are currently being ignored.
+        See :py:meth:`pause`.
+
+    .. py:attribute:: latency
+
+        The time, in seconds, between the most recently compressed frame being
+        received from the kinect and its compressed form becoming available or
+        *None* if no frame has yet been compressed.
+
+    .. py:attribute:: n_compressed
+
+        The number of frames which have been compressed.
+
+    .. py:attribute:: n_dropped
+
+        The number of frames which have been dropped without being compressed.
+        This includes replaced frames.
+
+    .. py:attribute:: n_replaced
+
+        The number of waiting frames which have been dropped in favour of a
+        newer frame.
     """
 
     on_compressed_frame = Signal()
     """Signal emitted when a new compressed frame is available. Receivers take
-    a single keyword argument, *compressed_frame*, which is a Python
-    buffer-like object containing the compressed frame data. The signal is
-    emitted on the IOLoop thread."""
+    a single keyword argument, *compressed_frame*, which is a list of Python
+    buffer-like objects giving the parts of a multipart message which encodes
+    the frame. The message may be decompressed with
+    :py:class:`DepthFrameDecompressor`. The signal is emitted on the IOLoop
+    thread."""
+
+    # The supported drop policies
+    _DROP_POLICIES = ('drop_newest', 'replace_pending', 'adaptive')
+
+    # The default number of frames between sending the background model or,
+    # when sending changed tiles, between keyframes
+    _BACKGROUND_INTERVAL = 300
+
+    def __init__(self, kinect, io_loop=None, backend='process', pool=None,
+            max_in_flight=None, drop_policy='drop_newest', codec='lz4',
+            keyframe_interval=None, n_bands=1, background=False,
+            background_threshold=0, tiles=False, tile_threshold=0):
+        codec = get_codec(codec)
+        if keyframe_interval is None:
+            keyframe_interval = DepthFrameCompressor._BACKGROUND_INTERVAL \
+                    if background or tiles else codec.keyframe_interval
 
-    # The maximum number of frames we can be waiting for before we start
-    # dropping them.
-    _MAX_IN_FLIGHT = cpu_count() + 1
+        if drop_policy not in DepthFrameCompressor._DROP_POLICIES:
+            raise ValueError('Unknown drop policy "{0}"'.format(drop_policy))
+        if keyframe_interval < 1:
+            raise ValueError('Keyframe interval must be at least one')
+        if n_bands < 1:
+            raise ValueError('Number of bands must be at least one')
+        if background_threshold < 0 or background_threshold > 0x7fff:
+            raise ValueError('Background threshold must be between 0 and 32767')
+        if tile_threshold < 0 or tile_threshold > 0x7fff:
+            raise ValueError('Tile threshold must be between 0 and 32767')
+        if background and tiles:
+            raise ValueError('Background and tile modes cannot be combined')
+
+        if pool is None:
+            pool = CompressionPool(backend)
 
-    def __init__(self, kinect, io_loop=None):
         # Public attributes
         self.kinect = kinect
+        self.pool = pool
+        self.max_in_flight = max_in_flight or pool.max_in_flight
+        self.drop_policy = drop_policy
+        self.codec = codec
+        self.keyframe_interval = keyframe_interval
+        self.n_bands = n_bands
+        self.background = background
+        self.background_threshold = background_threshold
+        self.tiles = tiles
+        self.tile_threshold = tile_threshold
+        self.is_paused = False
+        self.latency = None
+        self.n_compressed = 0
+        self.n_dropped = 0
+        self.n_replaced = 0
 
         # Private attributes
         self._io_loop = io_loop or tornado.ioloop.IOLoop.instance()
-        self._pool = Pool() # worker process pool
-        self._n_in_flight = 0 # How many frames are we waiting for?
-        self._n_dropped = 0
+
+        # Scheduling state. Protected by the pool's lock.
+        self._pending = None # frame waiting for a worker
+        self._pending_capture_time = None # when the waiting frame was received
+        self._is_waiting = False # are we in the pool's waiting queue?
+        self._n_in_flight = 0 # how many frames are we waiting for?
+        self._in_flight_limit = self.max_in_flight # may be lowered if adaptive
+
+        # Delta coding state. Protected by the pool's lock.
+        self._reference = None # last submitted depth frame
+        self._n_since_keyframe = 0 # frames submitted since last keyframe
+        self._force_keyframe = False # has a keyframe been requested?
+        self._next_seq = 0 # sequence number of next submitted frame
+        self._next_emit_seq = 0 # sequence number of next frame to emit
+        self._completed = {} # compressed frames waiting to be emitted by seq
+        self._chain_broken = False # has a frame been lost since the last keyframe?
+
+        # Background model state. Protected by the pool's lock.
+        self._background = None # last background model sent
+        self._background_id = 0 # id of last background model sent
+        self._furthest = None # furthest sample depths since the model was sent
+
+        # Tile state. Protected by the pool's lock.
+        self._sent = None # frame as seen by the client padded to whole tiles
+        self._padded = None # scratch copy of the current frame padded likewise
+        self._tile_diff = None # scratch for the difference between the two
+        self._tile_wrapped = None # scratch for _absolute_difference
 
         # Wire ourselves up for depth frame events
         kinect.on_depth_frame.connect(self._on_depth_frame, sender=kinect)
 
-    def __del__(self):
-        # As a courtesy, terminate the worker pool to avoid having a sea of
-        # dangling processes.
-        self._pool.terminate()
+    @property
+    def backend(self):
+        """The name of the compression backend in use."""
+        return self.pool.backend
+
+    def request_keyframe(self):
+        """Request that the next frame to be compressed is a keyframe."""
+        with self.pool._lock:
+            self._force_keyframe = True
 
-    def _on_compressed_frame(self, compressed_frame):
-        # Record arrival of frame
-        self._n_in_flight -= 1
+    def pause(self):
+        """Stop compressing depth frames. Frames from the kinect are ignored
+        until :py:meth:`resume` is called. This avoids compressing frames which
+        nobody will receive. Frames already being compressed are still
+        emitted, as is any frame waiting for a worker.
 
+        """
+        with self.pool._lock:
+            self.is_paused = True
+
+    def resume(self):
+        """Resume compressing depth frames after :py:meth:`pause`. The first
+        frame compressed is a keyframe.
+
+        """
+        with self.pool._lock:
+            self.is_paused = False
+            self._force_keyframe = True
+
+    def _prepare(self, depth_frame, capture_time):
+        """Choose how to compress *depth_frame* and return a job to submit to
+        the pool. Must be called with the pool's lock held and in the order
+        frames are submitted.
+
+        """
+        if self.background:
+            return self._prepare_foreground(depth_frame, capture_time)
+        if self.tiles:
+            return self._prepare_tiles(depth_frame, capture_time)
+
+        reference = self._reference
+        if reference is not None and not self._force_keyframe and \
+                reference.shape == depth_frame.shape and \
+                self._n_since_keyframe + 1 < self.keyframe_interval:
+            frame_type = _DELTA_FRAME
+            self._n_since_keyframe += 1
+        else:
+            frame_type = _KEYFRAME
+            self._n_since_keyframe = 0
+            self._force_keyframe = False
+
+        # Only keep a reference frame if delta coding is enabled
+        if self.keyframe_interval > 1:
+            self._reference = depth_frame
+
+        job = CompressionPool._Job(seq=self._next_seq, frame_type=frame_type,
+                depth_frame=depth_frame,
+                reference=reference.data if frame_type == _DELTA_FRAME else None,
+                capture_time=capture_time, background=None, background_id=0,
+                shape=depth_frame.shape, tile_map=None, foreground_mask=None)
+        self._next_seq = (self._next_seq + 1) % _SEQ_MODULUS
+        return job
+
+    def _prepare_tiles(self, depth_frame, capture_time):
+        """As for :py:meth:`_prepare` but for compressors which send only the
+        tiles which have changed.
+
+        """
+        w, h = depth_frame.shape
+        frame = np.frombuffer(depth_frame.data, dtype=np.uint16).reshape((h, w))
+        rows, cols = _tile_grid(depth_frame.shape)
+        padded_shape = (rows * _TILE_SIZE, cols * _TILE_SIZE)
+
+        if self._sent is not None and not self._force_keyframe and \
+                self._sent.shape == padded_shape and \
+                self._n_since_keyframe + 1 < self.keyframe_interval:
+            self._n_since_keyframe += 1
+
+            # Find the largest change within each tile. The padding is zero in
+            # both frames and so never counts as a change.
+            self._padded[:h, :w] = frame
+            _absolute_difference(self._padded, self._sent, self._tile_diff,
+                    self._tile_wrapped)
+            changed = _tiles(self._tile_diff).max(axis=(2, 3)) > self.tile_threshold
+
+            # Send the changed tiles stacked one above the other and update
+            # our copy of the client's frame to match
+            changed_tiles = _tiles(self._padded)[changed]
+            _tiles(self._sent)[changed] = changed_tiles
+            job = CompressionPool._Job(seq=self._next_seq, frame_type=_TILE_FRAME,
+                    depth_frame=DepthFrame(
+                        data=changed_tiles.reshape((-1, _TILE_SIZE)),
+                        shape=(_TILE_SIZE, changed_tiles.shape[0] * _TILE_SIZE)),
+                    reference=None, capture_time=capture_time, background=None,
+                    background_id=0, shape=depth_frame.shape,
+                    tile_map=np.packbits(changed).tobytes(), foreground_mask=None)
+        else:
+            self._n_since_keyframe = 0
+            self._force_keyframe = False
+
+            if self._sent is None or self._sent.shape != padded_shape:
+                self._sent = np.zeros(padded_shape, dtype=np.uint16)
+                self._padded = np.zeros(padded_shape, dtype=np.uint16)
+                self._tile_diff = np.zeros(padded_shape, dtype=np.uint16)
+                self._tile_wrapped = np.zeros(padded_shape, dtype=np.bool_)
+            self._sent[:h, :w] = frame
+            job = CompressionPool._Job(seq=self._next_seq, frame_type=_KEYFRAME,
+                    depth_frame=depth_frame, reference=None,
+                    capture_time=capture_time, background=None, background_id=0,
+                    shape=depth_frame.shape, tile_map=None, foreground_mask=None)
+
+        self._next_seq = (self._next_seq + 1) % _SEQ_MODULUS
+        return job
+
+    def _prepare_foreground(self, depth_frame, capture_time):
+        """As for :py:meth:`_prepare` but for compressors with a background
+        model.
+
+        """
+        frame = np.frombuffer(depth_frame.data, dtype=np.uint16)
+        model = self._background
+        if self._furthest is not None and self._furthest.shape == frame.shape:
+            np.maximum(self._furthest, frame, out=self._furthest)
+        else:
+            self._furthest = None
+
+        if model is not None and not self._force_keyframe and \
+                model.shape == depth_frame.shape and \
+                self._n_since_keyframe + 1 < self.keyframe_interval:
+            frame_type, background = _FOREGROUND_FRAME, None
+            self._n_since_keyframe += 1
+        else:
+            frame_type = _BACKGROUND_FRAME
+            self._n_since_keyframe = 0
+            self._force_keyframe = False
+
+            # Send the furthest depths seen as the new model and start again
+            if self._furthest is None:
+                self._furthest = frame.copy()
+            model = background = DepthFrame(data=self._furthest, shape=depth_frame.shape)
+            self._furthest = frame.copy()
+            self._background = model
+            self._background_id = (self._background_id + 1) % 256
+
+        job = CompressionPool._Job(seq=self._next_seq, frame_type=frame_type,
+                depth_frame=depth_frame, reference=model.data,
+                capture_time=capture_time, background=background,
+                background_id=self._background_id, shape=depth_frame.shape,
+                tile_map=None, foreground_mask=_foreground_mask(frame,
+                    np.frombuffer(model.data, dtype=np.uint16),
+                    self.background_threshold))
+        self._next_seq = (self._next_seq + 1) % _SEQ_MODULUS
+        return job
+
+    def _on_compressed_frame(self, job, compressed_frame, latency):
+        """Called with the pool's lock held when *job* has been compressed."""
+        self.latency = latency
+
+        # Emit compressed frames in the order they were submitted
+        self._completed[job.seq] = (job, time.time(), compressed_frame)
+        while self._next_emit_seq in self._completed:
+            job, compress_time, compressed_frame = self._completed.pop(self._next_emit_seq)
+            self._next_emit_seq = (self._next_emit_seq + 1) % _SEQ_MODULUS
+            frame_type = job.frame_type
+
+            # The worker logs and returns None if compression failed. Delta
+            # and tile frames cannot be decompressed until the next keyframe.
+            # Clients notice a missing background model from the background
+            # id.
+            if compressed_frame is None:
+                self._chain_broken = True
+                self._force_keyframe = True
+                continue
+            if frame_type in (_KEYFRAME, _BACKGROUND_FRAME):
+                self._chain_broken = False
+            elif frame_type in (_DELTA_FRAME, _TILE_FRAME) and self._chain_broken:
+                self.n_dropped += 1
+                continue
+
+            self.n_compressed += 1
+            header = FrameHeader(kinect_id=self.kinect.unique_kinect_id,
+                    seq=job.seq, frame_type=frame_type, codec_id=self.codec.id,
+                    background_id=job.background_id, shape=job.shape,
+                    capture_time=job.capture_time, compress_time=compress_time)
+            header = [make_frame_header(header)]
+            if job.tile_map is not None:
+                header.append(job.tile_map)
+            if job.foreground_mask is not None:
+                header.append(job.foreground_mask)
+            self._emit(header + compressed_frame)
+
+    def _emit(self, compressed_frame):
         # Send signal
         try:
             self._io_loop.add_callback(
@@ -96,14 +1444,513 @@ class DepthFrameCompressor(object):
             log.warn('DepthFrameCompressor swallowed {0} exception'.format(e))
 
     def _on_depth_frame(self, kinect, depth_frame):
-        # If we aren't waiting on too many frames, submit
-        if self._n_in_flight < DepthFrameCompressor._MAX_IN_FLIGHT:
-            self._pool.apply_async(_compress_depth_frame,
-                    args=(depth_frame,), callback=self._on_compressed_frame)
-            self._n_in_flight += 1
-        else:
+        # Paused compressors do no work at all for each frame
+        if self.is_paused:
+            return
+
+        capture_time = time.time()
+        with self.pool._lock:
+            dropped = self._pending is not None
+            if not dropped:
+                self._pending = depth_frame
+                self._pending_capture_time = capture_time
+            elif self.drop_policy != 'drop_newest':
+                # Replace the waiting frame with this one
+                self._pending = depth_frame
+                self._pending_capture_time = capture_time
+                self.n_replaced += 1
+                if self.drop_policy == 'adaptive':
+                    self._in_flight_limit = max(1, self._in_flight_limit >> 1)
+
+            if dropped:
+                self.n_dropped += 1
+                n_dropped = self.n_dropped
+
+        if dropped:
             # Only log every 10 dropped frames to avoid being too spammy
-            self._n_dropped += 1
-            if self._n_dropped % 10 == 0:
-                log.warn('Dropped {0} depth frames'.format(self._n_dropped))
+            if n_dropped % 10 == 0:
+                log.warn('Dropped {0} depth frames'.format(n_dropped))
+            return
+
+        self.pool._frame_ready(self)
+
+class DepthFrameDecompressor(object):
+    """
+    Decompress depth frames produced by :py:class:`DepthFrameCompressor`.
+
+    *shape* is a (width, height) pair giving the expected shape of the depth
+    frames. If *None*, :py:data:`DEFAULT_DEPTH_FRAME_SHAPE` is used. Each
+    frame's header records its shape and codec and so these are only used to
+    pre-allocate buffers.
+
+    *codec* is the name of the registered :py:class:`Codec` which is expected
+    to have been used to compress the frames.
+
+    Frames which were compressed in bands are decompressed by a pool of up to
+    *threads* threads, one band per thread. If *None*, the number of CPUs is
+    used. If one, bands are decompressed in turn.
+
+    :raises ValueError: if *codec* is not recognised
+
+    Frames are decompressed into a single pre-allocated buffer which is re-used
+    for each frame. The :py:class:`streamkinect2.mock.DepthFrame` returned by
+    :py:meth:`decompress` is therefore only valid until the next call. Copy
+    the data if it needs to be kept for longer. The buffer is re-allocated if
+    the frame shape changes.
+
+    Delta and tile frames are applied to the previously decompressed frame.
+    Until the first keyframe has been decompressed, they cannot be
+    decompressed. The same is true if a gap in the frame sequence numbers
+    shows that a frame has been lost.
+
+    .. py:attribute:: shape
+
+        The (width, height) pair giving the shape of decompressed frames.
+
+    .. py:attribute:: codec
+
+        The :py:class:`Codec` used to decompress frames.
+
+    .. py:attribute:: needs_keyframe
+
+        *True* if a keyframe must be received before delta or tile frames can
+        be decompressed.
+
+    .. py:attribute:: header
+
+        The :py:class:`FrameHeader` of the most recently received frame or
+        *None* if no frame has been received.
+
+    .. py:attribute:: n_lost
+
+        The number of frames which, judging by the gaps in sequence numbers,
+        have been lost before reaching this decompressor.
+    """
+
+    def __init__(self, shape=None, codec='lz4', threads=None):
+        # Worker pool, created on first frame with more than one band. Set
+        # first since __del__ relies on it.
+        self._pool = None
+
+        # Public attributes
+        self.codec = get_codec(codec)
+        self.header = None
+        self.n_lost = 0
+
+        # Private attributes
+        self._threads = threads or cpu_count()
+        self._scratch = [] # scratch arrays kept by the codec for each band
+        self._allocate(tuple(shape or DEFAULT_DEPTH_FRAME_SHAPE))
+
+        self.needs_keyframe = True
+
+    def __del__(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def _allocate(self, shape):
+        self.shape = shape
+        w, h = shape
+        self._frame = np.zeros((h, w), dtype=np.uint16)
+        self._residual = None # allocated on first delta or foreground frame
+        self._background = None # allocated on first background frame
+        self._background_id = None # id of the background model if valid
+        self._padded = None # frame padded to whole tiles, allocated on first tile frame
+        self._padded_valid = False # does the padded frame match the frame?
+        self._tiles = None # scratch for the tiles of a tile frame
+        self._depth_frame = DepthFrame(data=self._frame.data, shape=shape)
+
+    def decompress(self, compressed_frame):
+        """Decompress *compressed_frame*, a multipart message as emitted by
+        :py:attr:`DepthFrameCompressor.on_compressed_frame`. Returns a
+        :py:class:`streamkinect2.mock.DepthFrame` which refers to this
+        decompressor's internal buffer or *None* if *compressed_frame* is a
+        delta, tile or foreground frame which cannot be decompressed until a
+        keyframe or background frame arrives.
+
+        :raises ValueError: if *compressed_frame* is malformed, uses an unknown
+            codec or its data does not match the shape given in its header
+
+        """
+        if len(compressed_frame) < 2:
+            raise ValueError('Compressed frame must have at least two parts')
+        header, bands = parse_frame_header(compressed_frame[0]), compressed_frame[1:]
+
+        # Count lost frames. Delta and tile frames following a gap cannot be
+        # decoded.
+        if self.header is not None and header.kinect_id == self.header.kinect_id:
+            n_lost = (header.seq - self.header.seq - 1) % _SEQ_MODULUS
+            if n_lost > 0:
+                self.n_lost += n_lost
+                self.needs_keyframe = True
+        self.header = header
+
+        if header.codec_id != self.codec.id:
+            self.needs_keyframe = True
+            self.codec = _get_codec_by_id(header.codec_id)
+            self._scratch = []
+
+        # Only tile frames keep the padded copy of the frame up to date
+        if header.frame_type != _TILE_FRAME:
+            self._padded_valid = False
+
+        if header.frame_type == _KEYFRAME:
+            if tuple(header.shape) != self.shape:
+                self._allocate(tuple(header.shape))
+
+            # Until decompression succeeds the frame buffer is garbage
+            self.needs_keyframe = True
+            self._decompress_bands(bands, self._frame)
+        elif header.frame_type == _DELTA_FRAME:
+            if self.needs_keyframe or tuple(header.shape) != self.shape:
+                self.needs_keyframe = True
+                return None
+            residual = self._get_residual()
+            self.needs_keyframe = True
+            self._decompress_bands(bands, residual)
+            self._frame ^= residual
+        elif header.frame_type == _TILE_FRAME:
+            if self.needs_keyframe or tuple(header.shape) != self.shape:
+                self.needs_keyframe = True
+                return None
+            if len(bands) < 2:
+                raise ValueError('Tile frame must have a tile map and at least one band')
+            self.needs_keyframe = True
+            self._decompress_tiles(bands[0], bands[1:])
+        else:
+            if len(bands) < 2:
+                raise ValueError('Background and foreground frames must have a '
+                        'foreground mask and at least one band')
+            mask, bands = bands[0], bands[1:]
+            if header.frame_type == _BACKGROUND_FRAME:
+                if len(bands) % 2 != 0:
+                    raise ValueError('Background frame must have an even number of bands')
+                if tuple(header.shape) != self.shape:
+                    self._allocate(tuple(header.shape))
+                if self._background is None:
+                    self._background = np.zeros_like(self._frame)
+
+                # Until decompression succeeds the background is garbage
+                self._background_id = None
+                self._decompress_bands(bands[:len(bands)>>1], self._background)
+                self._background_id = header.background_id
+                bands = bands[len(bands)>>1:]
+            elif self._background_id != header.background_id or \
+                    tuple(header.shape) != self.shape:
+                # The foreground frame needs a background model we do not have
+                self.needs_keyframe = True
+                return None
+
+            # Fill the samples outside the foreground mask from the background
+            residual = self._get_residual()
+            self.needs_keyframe = True
+            foreground = self._decompress_mask(mask)
+            self._decompress_bands(bands, residual)
+            np.copyto(self._frame, self._background)
+            np.copyto(self._frame, residual, where=foreground)
+
+        self.needs_keyframe = False
+        return self._depth_frame
+
+    def _decompress_tiles(self, tile_map, bands):
+        """Decompress the tiles in *bands* and copy each into the frame at the
+        position of the corresponding set bit in *tile_map*.
+
+        """
+        rows, cols = _tile_grid(self.shape)
+        changed = np.unpackbits(np.frombuffer(tile_map, dtype=np.uint8))
+        if changed.shape[0] != ((rows * cols + 7) >> 3) << 3:
+            raise ValueError('Tile map does not match frame shape {0}'.format(self.shape))
+        changed = changed[:rows*cols].reshape((rows, cols)).view(np.bool_)
+
+        n_tiles = int(np.count_nonzero(changed))
+        if self._tiles is None or self._tiles.shape[0] < n_tiles * _TILE_SIZE:
+            self._tiles = np.zeros((rows * cols * _TILE_SIZE, _TILE_SIZE),
+                    dtype=np.uint16)
+        tiles = self._tiles[:n_tiles * _TILE_SIZE]
+        self._decompress_bands(bands, tiles)
+
+        # Tiles are patched into a copy of the frame padded to whole tiles
+        # which is kept in step with the frame for as long as only tile frames
+        # arrive
+        h, w = self._frame.shape
+        if self._padded is None or self._padded.shape != (rows * _TILE_SIZE, cols * _TILE_SIZE):
+            self._padded = np.zeros((rows * _TILE_SIZE, cols * _TILE_SIZE), dtype=np.uint16)
+            self._padded_valid = False
+        if not self._padded_valid:
+            self._padded[:h, :w] = self._frame
+            self._padded_valid = True
+        _tiles(self._padded)[changed] = tiles.reshape((n_tiles, _TILE_SIZE, _TILE_SIZE))
+        np.copyto(self._frame, self._padded[:h, :w])
+
+    def _decompress_mask(self, mask):
+        """Return the boolean array of foreground samples encoded by the
+        compressed bitmap *mask* as produced by :py:func:`_foreground_mask`.
+
+        """
+        h, w = self._frame.shape
+        foreground = np.unpackbits(np.frombuffer(_lz4_decompress(mask), dtype=np.uint8))
+        if foreground.shape[0] != ((h * w + 7) >> 3) << 3:
+            raise ValueError('Foreground mask does not match frame shape {0}'.format(self.shape))
+        return foreground[:h*w].reshape((h, w)).view(np.bool_)
+
+    def _get_residual(self):
+        if self._residual is None:
+            self._residual = np.zeros_like(self._frame)
+        return self._residual
+
+    def _decompress_bands(self, bands, out):
+        """Decompress each part in *bands* into the corresponding band of rows
+        of *out*.
+
+        """
+        rows = _band_rows(out.shape[0], len(bands))
+        while len(self._scratch) < len(bands):
+            self._scratch.append({})
+
+        def decompress_band(idx):
+            start, stop = rows[idx]
+            self.codec.decompress(bands[idx], out[start:stop], self._scratch[idx])
+
+        if len(bands) == 1 or self._threads == 1:
+            for idx in range(len(bands)):
+                decompress_band(idx)
+            return
+
+        if self._pool is None:
+            self._pool = ThreadPool(self._threads)
+        self._pool.map(decompress_band, range(len(bands)))
+
+# The supported methods of downsampling depth frames
+_DOWNSAMPLE_METHODS = ('min', 'median')
+
+def downsample_depth_frame(depth_frame, method='min'):
+    """Return a :py:class:`streamkinect2.mock.DepthFrame` of half the width
+    and height of *depth_frame* in which each sample summarises a 2 by 2 block
+    of samples. A final odd row or column is discarded. *method* may be one
+    of:
+
+    ``'min'``
+        The nearest non-zero sample of the block or zero if every sample in
+        the block is zero. Since zero marks a sample with no depth reading,
+        this keeps thin foreground objects visible at low resolution.
+
+    ``'median'``
+        The lower of the two middle samples of the block. This suppresses
+        isolated noisy samples.
+
+    :raises ValueError: if *method* is not recognised
+
+    """
+    if method not in _DOWNSAMPLE_METHODS:
+        raise ValueError('Unknown downsampling method "{0}"'.format(method))
+
+    w, h = depth_frame.shape
+    d = np.frombuffer(depth_frame.data, dtype=np.uint16).reshape((h, w))
+    d = d[:h & ~1, :w & ~1]
+    blocks = (d[0::2, 0::2], d[0::2, 1::2], d[1::2, 0::2], d[1::2, 1::2])
+    out = np.empty(blocks[0].shape, dtype=np.uint16)
+    tmp = np.empty_like(out)
+
+    if method == 'min':
+        # Subtracting one wraps zero around to the largest value so that the
+        # minimum ignores missing samples unless all of them are missing
+        one = np.uint16(1)
+        np.subtract(blocks[0], one, out=out)
+        for block in blocks[1:]:
+            np.subtract(block, one, out=tmp)
+            np.minimum(out, tmp, out=out)
+        out += one
+    else:
+        # The lower median of four is the smaller of the larger of the pair
+        # minima and the smaller of the pair maxima
+        lo = np.empty_like(out)
+        hi = np.empty_like(out)
+        np.minimum(blocks[0], blocks[1], out=out)
+        np.minimum(blocks[2], blocks[3], out=tmp)
+        np.maximum(out, tmp, out=lo)
+        np.maximum(blocks[0], blocks[1], out=out)
+        np.maximum(blocks[2], blocks[3], out=tmp)
+        np.minimum(out, tmp, out=hi)
+        np.minimum(lo, hi, out=out)
+
+    return DepthFrame(data=out, shape=out.shape[::-1])
+
+class _PyramidLevel(object):
+    """A kinect-like object emitting the depth frames of one level of a
+    :py:class:`DepthFramePyramid`.
+
+    """
+    on_depth_frame = Signal()
+
+    def __init__(self, unique_kinect_id):
+        self.unique_kinect_id = unique_kinect_id
+
+class DepthFramePyramid(object):
+    """
+    Downsample each depth frame emitted by *kinect* into a pyramid of
+    successively halved resolutions.
+
+    *kinect* is a :py:class:`streamkinect2.mock.MockKinect`-like object.
+    *n_levels* is the number of downsampled levels to build. Each depth frame
+    is downsampled once, as it arrives, by :py:func:`downsample_depth_frame`
+    using *method*. Each level is built from the level above it and so a
+    level may be compressed without repeating the work of the levels above.
+
+    Each of the objects in :py:attr:`levels` behaves like a kinect with the
+    same unique id as *kinect* and so may be passed to
+    :py:class:`DepthFrameCompressor`. Only the first
+    :py:attr:`n_active_levels` levels are built for each frame.
+
+    :raises ValueError: if *n_levels* is less than one or *method* is not
+        recognised
+
+    .. py:attribute:: kinect
+
+        Kinect object associated with this pyramid.
+
+    .. py:attribute:: method
+
+        The name of the downsampling method.
+
+    .. py:attribute:: levels
+
+        A list of kinect-like objects emitting depth frames at 1/2, 1/4, etc.
+        of the width and height of the frames emitted by *kinect*.
+
+    .. py:attribute:: n_active_levels
+
+        The number of levels, starting from the first, which are built for
+        each depth frame. Initially all levels are built. Lower this when the
+        smallest levels are not needed to avoid building them.
+    """
+
+    def __init__(self, kinect, n_levels=2, method='min'):
+        if n_levels < 1:
+            raise ValueError('Number of levels must be at least one')
+        if method not in _DOWNSAMPLE_METHODS:
+            raise ValueError('Unknown downsampling method "{0}"'.format(method))
+
+        # Public attributes
+        self.kinect = kinect
+        self.method = method
+        self.levels = [_PyramidLevel(kinect.unique_kinect_id) for _ in range(n_levels)]
+        self.n_active_levels = n_levels
+
+        # Wire ourselves up for depth frame events
+        kinect.on_depth_frame.connect(self._on_depth_frame, sender=kinect)
+
+    def _on_depth_frame(self, kinect, depth_frame):
+        for level in self.levels[:self.n_active_levels]:
+            depth_frame = downsample_depth_frame(depth_frame, self.method)
+            level.on_depth_frame.send(level, depth_frame=depth_frame)
+
+class DepthFrameSelector(object):
+    """
+    Select a region, rate and resolution of the depth frames emitted by
+    *kinect*. This behaves like a kinect with the same unique id as *kinect*
+    and so may be passed to :py:class:`DepthFrameCompressor`.
+
+    If *fps* is not *None*, frames are dropped so that at most *fps* frames
+    per second are emitted. If *roi* is not *None*, it is an (x, y, width,
+    height) tuple and only that region of each frame, clipped to the frame, is
+    emitted. *decimation* keeps only every *decimation*-th sample of every
+    *decimation*-th row of the region. Since the ``lz4`` codec packs pairs of
+    samples, a final odd column of the result is discarded.
+
+    :raises ValueError: if *fps* is not positive, if *decimation* is not
+        between 1 and 16 or if *roi* is not four non-negative integers with a
+        non-zero width and height
+
+    .. py:attribute:: kinect
+
+        Kinect object associated with this selector.
+
+    .. py:attribute:: unique_kinect_id
+
+        The unique id of *kinect*.
+
+    .. py:attribute:: fps
+
+        The maximum number of frames emitted per second or *None* if there is
+        no maximum.
+
+    .. py:attribute:: decimation
+
+        The factor by which the width and height of frames is reduced.
+
+    .. py:attribute:: roi
+
+        The (x, y, width, height) region of each frame emitted or *None* if
+        whole frames are emitted.
+
+    .. py:attribute:: is_paused
+
+        *True* if frames from the kinect are being ignored. Set this while
+        nothing downstream needs frames to avoid selecting them.
+    """
+
+    on_depth_frame = Signal()
+    """A signal which is emitted when a selected depth frame is available. As
+    for :py:attr:`streamkinect2.mock.MockKinect.on_depth_frame`."""
+
+    def __init__(self, kinect, fps=None, decimation=1, roi=None):
+        if fps is not None and fps <= 0:
+            raise ValueError('Frame rate must be positive')
+        if decimation < 1 or decimation > 16:
+            raise ValueError('Decimation must be between 1 and 16')
+        if roi is not None:
+            roi = tuple(roi)
+            if len(roi) != 4 or any(v < 0 for v in roi) or roi[2] == 0 or roi[3] == 0:
+                raise ValueError('Region of interest must be (x, y, width, height)')
+
+        # Public attributes
+        self.kinect = kinect
+        self.unique_kinect_id = kinect.unique_kinect_id
+        self.fps = fps
+        self.decimation = decimation
+        self.roi = roi
+        self.is_paused = False
+
+        # Private attributes
+        self._next_time = None # earliest time at which to emit the next frame
+
+        # Wire ourselves up for depth frame events
+        kinect.on_depth_frame.connect(self._on_depth_frame, sender=kinect)
+
+    def close(self):
+        """Stop selecting frames from the kinect."""
+        self.kinect.on_depth_frame.disconnect(self._on_depth_frame, sender=self.kinect)
+        self.is_paused = True
+
+    def _on_depth_frame(self, kinect, depth_frame):
+        if self.is_paused:
+            return
+
+        if self.fps is not None:
+            # Aim for the next frame one period after this one, unless we have
+            # fallen more than a period behind
+            now, period = time.time(), 1.0 / self.fps
+            if self._next_time is not None and now < self._next_time:
+                return
+            if self._next_time is None or now - self._next_time > period:
+                self._next_time = now + period
+            else:
+                self._next_time += period
+
+        if self.roi is not None or self.decimation > 1:
+            w, h = depth_frame.shape
+            d = np.frombuffer(depth_frame.data, dtype=np.uint16).reshape((h, w))
+            if self.roi is not None:
+                x, y, roi_w, roi_h = self.roi
+                d = d[y:y+roi_h, x:x+roi_w]
+                if d.size == 0:
+                    return
+            d = d[::self.decimation, ::self.decimation]
+            if d.shape[1] > 1:
+                d = d[:, :d.shape[1] & ~1]
+            d = np.ascontiguousarray(d)
+            depth_frame = DepthFrame(data=d, shape=d.shape[::-1])
 
+        self.on_depth_frame.send(self, depth_frame=depth_frame)
@@ -0,0 +1,295 @@
+"""
+Shared memory depth frame rings
+===============================
+
+A client on the same host as a server need not receive depth frames over a
+socket at all. A :py:class:`DepthFrameRingWriter` copies each depth frame into
+a ring of slots in a memory-mapped file and emits only a short message saying
+which slot holds it. A :py:class:`DepthFrameRingReader` in another process
+maps the same file and returns frames which refer directly to the slots.
+
+"""
+from logging import getLogger
+import mmap
+import os
+import struct
+import threading
+import time
+
+from blinker import Signal
+import numpy as np
+import tornado.ioloop
+
+from .compress import DEFAULT_DEPTH_FRAME_SHAPE, FrameHeader, get_codec
+from .compress import make_frame_header, parse_frame_header, _KEYFRAME, _SEQ_MODULUS
+from .mock import DepthFrame
+
+log = getLogger(__name__)
+
+# Fixed layout of the start of a ring file: magic number, version, number of
+# slots and the size of the sample data in each slot. The first slot starts
+# at _FILE_HEADER_SIZE.
+_RING_MAGIC = b'SK2R'
+_RING_VERSION = 1
+_FILE_HEADER_STRUCT = struct.Struct('<4sHHI')
+_FILE_HEADER_SIZE = 64
+
+# Fixed layout of the start of each slot: the number of frames written to the
+# ring before the one in this slot plus one, or zero while the slot is being
+# written, and the frame's width and height. The samples follow.
+_SLOT_HEADER_STRUCT = struct.Struct('<QHH')
+_SLOT_HEADER_SIZE = 16
+
+# Fixed layout of the part following the frame header in each message: the
+# slot index and the count recorded in the slot.
+_NOTIFICATION_STRUCT = struct.Struct('<IQ')
+
+class DepthFrameRingWriter(object):
+    """
+    Write the depth frames emitted by *kinect* into a ring of *n_slots* slots
+    in the file at *path*, which is created and removed by :py:meth:`close`.
+    Each slot holds one frame with at most as many samples as a frame of
+    shape *shape*. If *shape* is *None*,
+    :py:data:`streamkinect2.compress.DEFAULT_DEPTH_FRAME_SHAPE` is used.
+    Larger frames are dropped.
+
+    The writer behaves like a
+    :py:class:`streamkinect2.compress.DepthFrameCompressor` using the ``raw``
+    codec which emits only the header of each frame followed by a part giving
+    the slot holding it. Pass that message to
+    :py:meth:`DepthFrameRingReader.decompress` to recover the frame. Place
+    *path* on a memory-backed file system, such as ``/dev/shm``, to avoid
+    disk writes.
+
+    If *io_loop* is provided, it specifies the
+    :py:class:`tornado.ioloop.IOLoop` on which messages are emitted. If not
+    provided, the global instance is used.
+
+    :raises ValueError: if *n_slots* is less than two
+
+    .. py:attribute:: kinect
+
+        Kinect object associated with this writer.
+
+    .. py:attribute:: path
+
+        The path to the ring file.
+
+    .. py:attribute:: codec
+
+        The ``raw`` :py:class:`streamkinect2.compress.Codec` describing the
+        samples in each slot.
+
+    .. py:attribute:: is_paused
+
+        *True* if frames from the kinect are being ignored.
+
+    .. py:attribute:: n_dropped
+
+        The number of frames dropped because they were too large for a slot.
+
+    """
+
+    on_compressed_frame = Signal()
+    """Signal emitted when a new frame has been written to the ring. Receivers
+    take a single keyword argument, *compressed_frame*, which is a list of
+    Python buffer-like objects giving the parts of a multipart message which
+    locates the frame. The signal is emitted on the IOLoop thread."""
+
+    def __init__(self, kinect, path, n_slots=4, shape=None, io_loop=None):
+        if n_slots < 2:
+            raise ValueError('A ring must have at least two slots')
+
+        w, h = shape or DEFAULT_DEPTH_FRAME_SHAPE
+        self._slot_size = _SLOT_HEADER_SIZE + w * h * 2
+
+        # Create and map the ring file
+        size = _FILE_HEADER_SIZE + n_slots * self._slot_size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        _FILE_HEADER_STRUCT.pack_into(self._map, 0, _RING_MAGIC, _RING_VERSION,
+                n_slots, w * h * 2)
+
+        # Public attributes
+        self.kinect = kinect
+        self.path = path
+        self.codec = get_codec('raw')
+        self.is_paused = False
+        self.n_dropped = 0
+
+        # Private attributes
+        self._io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self._n_slots = n_slots
+        self._n_written = 0
+
+        # Held while writing a frame so that close() cannot unmap the ring
+        # file under the kinect thread
+        self._lock = threading.Lock()
+
+        # Wire ourselves up for depth frame events
+        kinect.on_depth_frame.connect(self._on_depth_frame, sender=kinect)
+
+    def close(self):
+        """Stop writing frames and remove the ring file. Readers which have
+        already mapped the file may continue to use it.
+
+        """
+        self.kinect.on_depth_frame.disconnect(self._on_depth_frame, sender=self.kinect)
+        with self._lock:
+            self.is_paused = True
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def request_keyframe(self):
+        """Every frame in the ring stands alone and so this has no effect."""
+
+    def pause(self):
+        """Stop writing depth frames until :py:meth:`resume` is called."""
+        self.is_paused = True
+
+    def resume(self):
+        """Resume writing depth frames after :py:meth:`pause`."""
+        self.is_paused = False
+
+    def _on_depth_frame(self, kinect, depth_frame):
+        if self.is_paused:
+            return
+
+        capture_time = time.time()
+        w, h = depth_frame.shape
+        if _SLOT_HEADER_SIZE + w * h * 2 > self._slot_size:
+            self.n_dropped += 1
+            return
+
+        with self._lock:
+            # The ring may have been closed since we last looked
+            if self.is_paused or self._map is None:
+                return
+
+            # Mark the slot as being written while the samples are copied so
+            # that readers of the frame it held can tell it has gone
+            slot = self._n_written % self._n_slots
+            offset = _FILE_HEADER_SIZE + slot * self._slot_size
+            _SLOT_HEADER_STRUCT.pack_into(self._map, offset, 0, w, h)
+            samples = np.frombuffer(self._map, dtype=np.uint16, count=w * h,
+                    offset=offset + _SLOT_HEADER_SIZE)
+            samples[:] = np.frombuffer(depth_frame.data, dtype=np.uint16, count=w * h)
+            del samples
+            self._n_written += 1
+            n_written = self._n_written
+            _SLOT_HEADER_STRUCT.pack_into(self._map, offset, n_written, w, h)
+
+        header = FrameHeader(kinect_id=kinect.unique_kinect_id,
+                seq=n_written - 1, frame_type=_KEYFRAME,
+                codec_id=self.codec.id, background_id=0, shape=(w, h),
+                capture_time=capture_time, compress_time=time.time())
+        compressed_frame = [make_frame_header(header),
+                _NOTIFICATION_STRUCT.pack(slot, n_written)]
+        try:
+            self._io_loop.add_callback(self.on_compressed_frame.send,
+                    self, compressed_frame=compressed_frame)
+        except Exception as e:
+            # See DepthFrameCompressor._emit
+            log.warn('DepthFrameRingWriter swallowed {0} exception'.format(e))
+
+class DepthFrameRingReader(object):
+    """
+    Read depth frames from the ring file at *path* written by a
+    :py:class:`DepthFrameRingWriter`, possibly in another process.
+
+    Frames returned by :py:meth:`decompress` refer directly to a slot of the
+    ring and so no samples are copied. A frame is only valid until the writer
+    re-uses its slot, which happens once as many further frames as there are
+    slots have been written. Copy the data if it needs to be kept for longer.
+
+    :raises ValueError: if *path* is not a ring file
+
+    .. py:attribute:: header
+
+        The :py:class:`streamkinect2.compress.FrameHeader` of the most recently
+        received frame or *None* if no frame has been received.
+
+    .. py:attribute:: n_lost
+
+        The number of frames which were lost before reaching this reader,
+        including those whose slot was re-used before they were read.
+
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < _FILE_HEADER_SIZE:
+            raise ValueError('Ring file is too short')
+        magic, version, self._n_slots, data_size = \
+                _FILE_HEADER_STRUCT.unpack_from(self._map)
+        if magic != _RING_MAGIC or version != _RING_VERSION:
+            raise ValueError('Not a depth frame ring file')
+        self._slot_size = _SLOT_HEADER_SIZE + data_size
+        if len(self._map) < _FILE_HEADER_SIZE + self._n_slots * self._slot_size:
+            raise ValueError('Ring file is too short')
+
+        self.header = None
+        self.n_lost = 0
+
+    def close(self):
+        """Unmap the ring file. Frames already returned by :py:meth:`decompress`
+        keep the mapping alive until they are released but no more frames may
+        be read.
+
+        """
+        if self._map is None:
+            return
+        try:
+            self._map.close()
+        except BufferError:
+            # Frames still refer to the mapping which is unmapped once the
+            # last of them goes
+            pass
+        self._map = None
+
+    def decompress(self, compressed_frame):
+        """Return the :py:class:`streamkinect2.mock.DepthFrame` located by
+        *compressed_frame*, a multipart message as emitted by
+        :py:attr:`DepthFrameRingWriter.on_compressed_frame`, or *None* if its
+        slot has already been re-used.
+
+        :raises ValueError: if *compressed_frame* is malformed or the reader
+            has been closed
+
+        """
+        if self._map is None:
+            raise ValueError('Ring reader has been closed')
+        if len(compressed_frame) != 2:
+            raise ValueError('Ring frame message must have two parts')
+        header = parse_frame_header(compressed_frame[0])
+        try:
+            slot, count = _NOTIFICATION_STRUCT.unpack(bytes(compressed_frame[1]))
+        except struct.error:
+            raise ValueError('Bad ring slot part')
+        if slot >= self._n_slots:
+            raise ValueError('Ring slot {0} out of range'.format(slot))
+
+        if self.header is not None and header.kinect_id == self.header.kinect_id:
+            self.n_lost += (header.seq - self.header.seq - 1) % _SEQ_MODULUS
+        self.header = header
+
+        offset = _FILE_HEADER_SIZE + slot * self._slot_size
+        slot_count, w, h = _SLOT_HEADER_STRUCT.unpack_from(self._map, offset)
+        if slot_count != count:
+            self.n_lost += 1
+            return None
+        if _SLOT_HEADER_SIZE + w * h * 2 > self._slot_size:
+            raise ValueError('Ring slot holds too many samples')
+        samples = np.frombuffer(self._map, dtype=np.uint16, count=w * h,
+                offset=offset + _SLOT_HEADER_SIZE)
+        return DepthFrame(data=samples.data, shape=(w, h))
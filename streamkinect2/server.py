@@ -4,8 +4,13 @@ Server
 """
 from collections import namedtuple
 from logging import getLogger
+import functools
+import math
+import os
 import platform
+import shutil
 import socket
+import tempfile
 import uuid
 import weakref
 
@@ -15,8 +20,11 @@ import zeroconf
 import zmq
 from zmq.eventloop.zmqstream import ZMQStream
 
-from .common import EndpointType, MessageType, make_msg, parse_msg
-from .compress import DepthFrameCompressor
+from .common import EndpointType, MessageType, make_msg, parse_msg, msg_encoding
+from .common import control_encoding_names, _DEPTH_ENDPOINT_TYPES
+from .compress import CompressionPool, DepthFrameCompressor, DepthFramePyramid
+from .compress import DepthFrameSelector, get_codec, _FRAME_TOPIC
+from .ring import DepthFrameRingWriter
 
 # Global zeroconf object pool keyed by bind address
 _ZC_POOL = {}
@@ -50,9 +58,21 @@ class ServerInfo(namedtuple('ServerInfo', ['name', 'endpoint'])):
     """
 
 class _KinectRecord(namedtuple('_KinectRecord',
-        ['kinect', 'endpoints', 'streams', 'depth_compresser'])):
+        ['kinect', 'endpoints', 'streams', 'depth_compresser', 'pyramid',
+         'compressers', 'profiles', 'options', 'routes', 'subscribers',
+         'local_endpoints', 'ring', 'ring_endpoint'])):
     pass
 
+class _ProfileRecord(namedtuple('_ProfileRecord', ['topic', 'selector', 'compresser'])):
+    pass
+
+# The maximum number of distinct stream profiles served for each kinect
+_MAX_PROFILES = 16
+
+# The time, in seconds, for which a new stream profile is kept waiting for its
+# first subscriber
+_PROFILE_SUBSCRIBE_TIMEOUT = 10
+
 class Server(object):
     """A server capable of streaming Kinect2 data to interested clients.
 
@@ -80,6 +100,26 @@ class Server(object):
     If *announce* is True then the server will be announced over ZeroConf when
     it starts running.
 
+    Compressed depth frames are queued for sending without being copied. If
+    *flush_depth_frames* is *True*, each frame is sent immediately rather than
+    when the event loop next finds the socket writable. This lowers latency
+    slightly at the cost of sending frames one at a time.
+
+    If *multiplex_depth* is *True*, the depth streams of every kinect are
+    published on a single socket with each message prefixed by a topic
+    starting with the kinect's id. Clients watching many kinects then need
+    only one connection. Otherwise each depth endpoint has its own socket.
+
+    If *ipc* is *True*, depth sockets are also bound to ``ipc://`` endpoints
+    which are advertised to clients. Clients on the same host use these in
+    preference to TCP. If *shared_memory* is *True*, each kinect's depth
+    frames are also written to a ring of frames in shared memory from which
+    clients on the same host may read them without any copying. See
+    :py:class:`streamkinect2.ring.DepthFrameRingWriter`. Files for both are
+    created in a temporary directory, on ``/dev/shm`` if there is one, which
+    is removed with the server. Neither option is available if ZeroMQ does not
+    support ``ipc://`` endpoints.
+
     .. py:attribute:: address
 
         The address bound to as a decimal-dotted string.
@@ -97,9 +137,50 @@ class Server(object):
 
         :py:class:`list` of kinect devices managed by this server. See :py:meth:`add_kinect`.
 
+    .. py:attribute:: flush_depth_frames
+
+        *True* if each depth frame is sent as soon as it has been compressed.
+
+    .. py:attribute:: multiplex_depth
+
+        *True* if the depth streams of all kinects share a single socket.
+
+    .. py:attribute:: ipc
+
+        *True* if depth sockets are also bound to ``ipc://`` endpoints.
+
+    .. py:attribute:: shared_memory
+
+        *True* if depth frames are also written to rings in shared memory.
+
+    All kinects added to a server share a single
+    :py:class:`streamkinect2.compress.CompressionPool` which is created when
+    the first kinect is added. Adding a kinect does not therefore increase the
+    number of compression workers.
+
+    The control endpoint is a *ROUTER* socket and so clients need not wait for
+    one reply before sending their next request. Each reply is returned with
+    the envelope of its request, which may carry a request id.
+
+    Depth endpoints are *XPUB* sockets and so the server knows how many
+    clients are subscribed to each. Depth frames are only compressed for
+    endpoints with at least one subscriber. The first subscriber to an idle
+    endpoint receives a keyframe.
+
+    Clients may ask for a depth stream with a lower frame rate, a region of
+    interest, decimation or a different codec with a ``subscribe`` control
+    message. Each distinct profile is compressed once, however many clients
+    ask for it, and published on the kinect's ``depth`` endpoint under its own
+    topic. A profile is dropped once its last subscriber unsubscribes.
+
     """
     def __init__(self, address=None, start_immediately=False,
-            name=None, zmq_ctx=None, io_loop=None, announce=True):
+            name=None, zmq_ctx=None, io_loop=None, announce=True,
+            flush_depth_frames=False, multiplex_depth=False, ipc=False,
+            shared_memory=False):
+        if (ipc or shared_memory) and not zmq.has('ipc'):
+            raise ValueError('ZeroMQ does not support ipc:// endpoints')
+
         # Choose a sensible name if none is specified
         if name is None:
             import getpass
@@ -124,6 +205,10 @@ class Server(object):
         self.name = name
         self.address = address
         self.endpoints = {}
+        self.flush_depth_frames = flush_depth_frames
+        self.multiplex_depth = multiplex_depth
+        self.ipc = ipc
+        self.shared_memory = shared_memory
 
         self._announce = announce
 
@@ -141,6 +226,35 @@ class Server(object):
         # kinects which we manage. Keyed by device id.
         self._kinects = { }
 
+        # Stream and endpoints shared by all depth streams when multiplexing.
+        # Created on demand.
+        self._multiplex_stream, self._multiplex_endpoint = None, None
+        self._multiplex_local_endpoint = None
+
+        # Directory holding ipc:// sockets and shared memory rings. Created on
+        # demand.
+        self._local_dir = None
+
+        # The "me" payload and its encoded messages keyed by encoding. Built
+        # on demand and invalidated whenever they would change. Each version
+        # has a distinct ETag which clients use to tell whether they are up to
+        # date.
+        self._me, self._me_msgs = None, {}
+        self._me_version = 0
+        self._etag_prefix = uuid.uuid4().hex[:8]
+        self._etag = '{0}-0'.format(self._etag_prefix)
+
+        # The number of stream profiles created, used to give each a distinct
+        # topic.
+        self._n_profiles = 0
+
+        # Timeouts after which stream profiles with no subscriber are dropped,
+        # keyed by the profile's compressor.
+        self._profile_timeouts = {}
+
+        # Compression pool shared by all kinects. Created on demand.
+        self._compression_pool = None
+
         if zmq_ctx is None:
             zmq_ctx = zmq.Context.instance()
         self._zmq_ctx = zmq_ctx
@@ -151,29 +265,137 @@ class Server(object):
     def __del__(self):
         if self.is_running:
             self.stop()
+        self._remove_local_dir()
+        self._terminate_compression_pool()
 
-    def add_kinect(self, kinect):
+    def add_kinect(self, kinect, max_in_flight=None, drop_policy='drop_newest',
+            codec='lz4', keyframe_interval=None, n_bands=1, background=False,
+            background_threshold=0, tiles=False, tile_threshold=0,
+            pyramid_levels=0, pyramid_method='min'):
         """Add a Kinect device to this server. *kinect* should be a object
         implementing the same interface as
         :py:class:`streamkinect2.mock.MockKinect`.
 
-        """
-        endpoints, streams = {}, {}
-
-        # Create zeromq sockets
-        endpoints_to_create = [
-            (zmq.PUB, EndpointType.depth),
-        ]
-        for type, key in endpoints_to_create:
-            streams[key], endpoints[key] = self._create_and_bind_socket(type)
+        *max_in_flight* is the maximum number of depth frames from this kinect
+        which may be being compressed at any one time. If *None*, frames from
+        this kinect may occupy the entire compression pool when other kinects
+        are idle. *drop_policy* specifies which frames are dropped if
+        compression cannot keep up. See
+        :py:class:`streamkinect2.compress.DepthFrameCompressor` for the
+        supported policies.
+
+        *codec* is the name of the codec used to compress depth frames. See
+        :py:func:`streamkinect2.compress.codec_names`. The codec is advertised
+        to clients. The default ``lz4`` codec keeps only the low 12 bits of
+        each sample. Use ``lz4_shuffle`` for lossless 16-bit depth. The
+        lossless ``rvl`` codec is slower than the LZ4 codecs, particularly to
+        decompress, and is best kept for frames with many zero samples.
+
+        If *keyframe_interval* is greater than one, depth frames are delta
+        coded with a keyframe sent every *keyframe_interval* frames. If *None*,
+        the codec's default is used. If *n_bands* is greater than one, each
+        depth frame is split into that many bands of rows which are compressed
+        in parallel.
+
+        If *background* is *True*, depth frames are sent relative to a model
+        of the static background, which suits fixed cameras. Samples within
+        *background_threshold* of the model are replaced by the model. See
+        :py:class:`streamkinect2.compress.DepthFrameCompressor`.
+
+        If *tiles* is *True*, only those 16 by 16 tiles of each depth frame
+        which differ from the client's copy by more than *tile_threshold* are
+        sent. This cannot be combined with *background*.
+
+        If the server was created with *shared_memory* set, the full
+        resolution depth frames are also written to a shared memory ring.
+
+        If *pyramid_levels* is one or two, each depth frame is also
+        downsampled to half and, if two, a quarter of its width and height
+        using *pyramid_method*. Each level is compressed as above and
+        broadcast on its own ``depth_half`` or ``depth_quarter`` endpoint so
+        that clients need only receive the resolution they need. See
+        :py:func:`streamkinect2.compress.downsample_depth_frame` for the
+        supported methods.
+
+        :raises ValueError: if *codec* or *pyramid_method* is not recognised,
+            if *background_threshold*, *tile_threshold* or *pyramid_levels* is
+            out of range or if both *background* and *tiles* are *True*
 
-        depth_compresser = DepthFrameCompressor(kinect, io_loop=self._io_loop)
-        self._kinects[kinect.unique_kinect_id] = _KinectRecord(kinect, endpoints,
-                streams, depth_compresser)
+        """
+        if pyramid_levels < 0 or pyramid_levels >= len(_DEPTH_ENDPOINT_TYPES):
+            raise ValueError('Number of pyramid levels must be between 0 and {0}'.format(
+                len(_DEPTH_ENDPOINT_TYPES) - 1))
+
+        if self._compression_pool is None:
+            self._compression_pool = CompressionPool()
+
+        # Create the compressors first since they validate their arguments.
+        # Each pyramid level is compressed in the same way as the full frame.
+        pyramid = None
+        sources = [kinect]
+        if pyramid_levels > 0:
+            pyramid = DepthFramePyramid(kinect, pyramid_levels, pyramid_method)
+            sources.extend(pyramid.levels)
+        compressers = {}
+        for key, source in zip(_DEPTH_ENDPOINT_TYPES, sources):
+            compressers[key] = DepthFrameCompressor(source, io_loop=self._io_loop,
+                    pool=self._compression_pool, max_in_flight=max_in_flight,
+                    drop_policy=drop_policy, codec=codec,
+                    keyframe_interval=keyframe_interval, n_bands=n_bands,
+                    background=background, background_threshold=background_threshold,
+                    tiles=tiles, tile_threshold=tile_threshold)
+
+        endpoints, streams, local_endpoints = {}, {}, {}
+        kinect_id = kinect.unique_kinect_id
+
+        # Create zeromq sockets, one for each depth endpoint, or share one
+        # socket with a topic for each endpoint. Nobody has subscribed yet and
+        # so there is nothing to compress.
+        routes = {}
+        for key, depth_compresser in compressers.items():
+            depth_compresser.pause()
+            if self.multiplex_depth:
+                streams[key], endpoints[key] = self._get_multiplex_socket()
+                routes[depth_compresser] = (streams[key],
+                        [self._depth_topic(kinect_id, key.name)])
+                if self.ipc:
+                    local_endpoints[key] = self._multiplex_local_endpoint
+            else:
+                streams[key], endpoints[key] = self._create_and_bind_socket(zmq.XPUB)
+                streams[key].on_recv(functools.partial(self._on_subscription, streams[key]))
+                routes[depth_compresser] = (streams[key], [])
+                if self.ipc:
+                    local_endpoints[key] = self._bind_ipc(streams[key],
+                            '{0}-{1}'.format(kinect_id, key.name))
+        if pyramid is not None:
+            pyramid.n_active_levels = 0
+
+        # The shared memory ring has a socket of its own, only reachable from
+        # this host, which says where in the ring each frame is
+        ring, ring_endpoint = None, None
+        if self.shared_memory:
+            ring = DepthFrameRingWriter(kinect, self._local_path('{0}.ring'.format(kinect_id)),
+                    io_loop=self._io_loop)
+            ring.pause()
+            ring_stream = self._create_socket(zmq.XPUB)
+            ring_stream.on_recv(functools.partial(self._on_subscription, ring_stream))
+            ring_endpoint = self._bind_ipc(ring_stream, '{0}-ring'.format(kinect_id))
+            routes[ring] = (ring_stream, [])
+
+        # Stream profiles are compressed with the same options
+        options = dict(max_in_flight=max_in_flight, drop_policy=drop_policy,
+                keyframe_interval=keyframe_interval, n_bands=n_bands,
+                background=background, background_threshold=background_threshold,
+                tiles=tiles, tile_threshold=tile_threshold)
+        self._kinects[kinect_id] = _KinectRecord(kinect, endpoints,
+                streams, compressers[EndpointType.depth], pyramid, compressers,
+                {}, options, routes, {}, local_endpoints, ring, ring_endpoint)
+        self._invalidate_me()
 
         # Register our interest in compressed frames
-        DepthFrameCompressor.on_compressed_frame.connect(
-                self._on_compressed_frame, sender=depth_compresser)
+        for depth_compresser in routes:
+            depth_compresser.on_compressed_frame.connect(
+                    self._on_compressed_frame, sender=depth_compresser)
 
     def remove_kinect(self, kinect):
         """Remove a Kinect device previously added via :py:meth:`add_kinect`."""
@@ -182,10 +404,22 @@ class Server(object):
 
         # Remove it from the list
         del self._kinects[kinect.unique_kinect_id]
+        self._invalidate_me()
 
         # Disconnect signal handlers
-        DepthFrameCompressor.on_compressed_frame.disconnect(
-                self._on_compressed_frame, sender=record.depth_compresser)
+        for depth_compresser in record.routes:
+            depth_compresser.on_compressed_frame.disconnect(
+                    self._on_compressed_frame, sender=depth_compresser)
+            self._cancel_profile_timeout(depth_compresser)
+
+        if record.ring is not None:
+            record.ring.close()
+            ring_stream, _ = record.routes[record.ring]
+            ring_stream.socket.close()
+
+        # The compression pool is only needed while there are kinects
+        if len(self._kinects) == 0:
+            self._terminate_compression_pool()
 
     @property
     def kinects(self):
@@ -204,13 +438,20 @@ class Server(object):
 
         # Create zeromq sockets
         endpoints_to_create = [
-            (zmq.REP, EndpointType.control),
+            (zmq.ROUTER, EndpointType.control),
         ]
         for type, key in endpoints_to_create:
             self._streams[key], self.endpoints[key] = self._create_and_bind_socket(type)
 
         # Listen for incoming messages
         self._streams[EndpointType.control].on_recv_stream(self._control_recv)
+        self._invalidate_me()
+
+        # Resume compressing depth streams which have subscribers
+        for record in self._kinects.values():
+            for depth_compresser in record.routes:
+                if record.subscribers.get(depth_compresser, 0) > 0:
+                    self._resume_compresser(depth_compresser)
 
         # Use the control endpoint's port as the port to advertise on zeroconf
         control_port = int(self.endpoints[EndpointType.control].split(':')[2])
@@ -246,20 +487,65 @@ class Server(object):
         for s in self._streams.values():
             s.socket.close()
         self._streams = {}
+        self._invalidate_me()
+
+        # Stop compressing depth frames. Kinects keep running and so the
+        # compression pool is kept for when the server is restarted.
+        for record in self._kinects.values():
+            for depth_compresser in record.routes:
+                self._pause_compresser(depth_compresser)
+
+        # Remove any ipc:// sockets and shared memory rings. Readers which have
+        # already mapped a ring may continue to use it.
+        self._remove_local_dir()
 
         self.is_running = False
 
+    def _invalidate_me(self):
+        """Discard the cached "me" payload after something it describes has
+        changed.
+
+        """
+        self._me, self._me_msgs = None, {}
+        self._me_version += 1
+        self._etag = '{0}-{1}'.format(self._etag_prefix, self._me_version)
+
     def _current_me(self):
+        """Return the "me" payload describing this server, building it if
+        necessary. The payload is shared and must not be modified.
+
+        """
+        if self._me is not None and self._me['name'] != self.name:
+            self._invalidate_me()
+        if self._me is None:
+            self._me = self._build_me()
+        return self._me
+
+    def _build_me(self):
         devices = []
         for device in self._kinects.values():
             devices.append({
                 'id': device.kinect.unique_kinect_id,
                 'endpoints': dict((k.name, v) for k, v in device.endpoints.items()),
+                'codecs': dict((k.name, v.codec.name) for k, v in device.compressers.items()),
             })
+            if self.multiplex_depth:
+                devices[-1]['topics'] = dict(
+                        (k.name, device.routes[v][1][0].decode('utf8'))
+                        for k, v in device.compressers.items())
+            if len(device.local_endpoints) > 0:
+                devices[-1]['local_endpoints'] = dict(
+                        (k.name, v) for k, v in device.local_endpoints.items())
+            if device.ring is not None:
+                devices[-1]['ring'] = {
+                    'endpoint': device.ring_endpoint, 'path': device.ring.path,
+                }
 
         return {
             'version': 1,
             'name': self.name,
+            'etag': self._etag,
+            'encodings': control_encoding_names(),
             'endpoints': dict((k.name, v) for k, v in self.endpoints.items()),
             'devices': devices,
         }
@@ -269,23 +555,211 @@ class Server(object):
 
         if type == MessageType.ping:
             log.info('Got ping from client')
-            return MessageType.pong, None
+            return MessageType.pong, { 'etag': self._etag }
         elif type == MessageType.who:
             return MessageType.me, self._current_me()
+        elif type == MessageType.keyframe:
+            try:
+                record = self._kinects[payload['id']]
+            except (TypeError, KeyError):
+                return MessageType.error, {
+                    'code': 404, 'reason': 'Unknown device'
+                }
+            for depth_compresser in record.routes:
+                depth_compresser.request_keyframe()
+            return MessageType.keyframe, None
+        elif type == MessageType.subscribe:
+            try:
+                record = self._kinects[payload['id']]
+            except (TypeError, KeyError):
+                return MessageType.error, {
+                    'code': 404, 'reason': 'Unknown device'
+                }
+            try:
+                profile = self._get_profile(record, payload)
+            except (TypeError, ValueError, OverflowError) as e:
+                return MessageType.error, { 'code': 400, 'reason': str(e) }
+            return MessageType.subscribe, {
+                'topic': profile.topic.decode('utf8'),
+                'codec': profile.compresser.codec.name,
+            }
         else:
             log.warn('Unknown message type from client: "{0}"'.format(type))
             return MessageType.error, {
                 'code': 400, 'reason': 'Unknown message type "{0}"'.format(type)
             }
 
+    def _get_profile(self, record, payload):
+        """Return the :py:class:`_ProfileRecord` for the stream profile
+        requested by the ``subscribe`` message *payload*, creating it if no
+        client has asked for the same profile before.
+
+        :raises ValueError: if the profile is invalid or there are too many
+            profiles
+        :raises OverflowError: if the decimation or region of interest is
+            infinite
+
+        """
+        fps, decimation, roi = payload.get('fps'), payload.get('decimation'), payload.get('roi')
+        if fps is not None:
+            fps = float(fps)
+            if math.isinf(fps) or math.isnan(fps):
+                raise ValueError('Frame rate must be finite')
+        if decimation is None:
+            decimation = 1
+        if decimation != int(decimation):
+            raise ValueError('Decimation must be an integer')
+        if roi is not None:
+            if any(v != int(v) for v in roi):
+                raise ValueError('Region of interest must be integers')
+            roi = tuple(int(v) for v in roi)
+        codec = get_codec(payload.get('codec') or record.depth_compresser.codec.name)
+
+        key = (fps, int(decimation), roi, codec.name)
+        profile = record.profiles.get(key)
+        if profile is not None:
+            # Give this client as long to subscribe as the first one had
+            if record.subscribers.get(profile.compresser, 0) == 0:
+                self._start_profile_timeout(record, profile.compresser)
+            return profile
+        if len(record.profiles) >= _MAX_PROFILES:
+            raise ValueError('Too many stream profiles for device')
+
+        # Frames are selected from the kinect and compressed for this profile
+        # alone. Until a client subscribes to its topic, it is paused. Topics
+        # are never re-used since profiles are dropped once idle or if nobody
+        # subscribes to them in time.
+        selector = DepthFrameSelector(record.kinect, fps, int(decimation), roi)
+        depth_compresser = DepthFrameCompressor(selector, io_loop=self._io_loop,
+                pool=self._compression_pool, codec=codec, **record.options)
+        depth_compresser.pause()
+        selector.is_paused = True
+        topic = 'profile{0}'.format(self._n_profiles)
+        self._n_profiles += 1
+        if self.multiplex_depth:
+            topic = self._depth_topic(record.kinect.unique_kinect_id, topic)
+        else:
+            topic = '{0}/'.format(topic).encode('utf8')
+        profile = _ProfileRecord(topic, selector, depth_compresser)
+        record.profiles[key] = profile
+        record.routes[depth_compresser] = (record.streams[EndpointType.depth], [profile.topic])
+        DepthFrameCompressor.on_compressed_frame.connect(
+                self._on_compressed_frame, sender=depth_compresser)
+        self._start_profile_timeout(record, depth_compresser)
+        return profile
+
+    def _start_profile_timeout(self, record, depth_compresser):
+        """Drop the stream profile of *record* whose frames are compressed by
+        *depth_compresser* unless it has a subscriber after
+        :py:data:`_PROFILE_SUBSCRIBE_TIMEOUT` seconds. Any earlier timeout for
+        the profile is cancelled.
+
+        """
+        def on_timeout():
+            del self._profile_timeouts[depth_compresser]
+            if record.subscribers.get(depth_compresser, 0) == 0:
+                self._remove_profile(record, depth_compresser)
+
+        self._cancel_profile_timeout(depth_compresser)
+        self._profile_timeouts[depth_compresser] = self._io_loop.call_later(
+                _PROFILE_SUBSCRIBE_TIMEOUT, on_timeout)
+
+    def _cancel_profile_timeout(self, depth_compresser):
+        handle = self._profile_timeouts.pop(depth_compresser, None)
+        if handle is not None:
+            self._io_loop.remove_timeout(handle)
+
+    def _remove_profile(self, record, depth_compresser):
+        """Drop the stream profile of *record* whose frames are compressed by
+        *depth_compresser*, if any. Clients which want it again must send
+        another ``subscribe`` message.
+
+        """
+        for key, profile in list(record.profiles.items()):
+            if profile.compresser is not depth_compresser:
+                continue
+            log.info('Dropping idle stream profile "{0}"'.format(profile.topic))
+            self._cancel_profile_timeout(depth_compresser)
+            profile.selector.close()
+            DepthFrameCompressor.on_compressed_frame.disconnect(
+                    self._on_compressed_frame, sender=depth_compresser)
+            del record.profiles[key]
+            del record.routes[depth_compresser]
+            record.subscribers.pop(depth_compresser, None)
+
+    def _get_multiplex_socket(self):
+        """Return the ZMQStream and endpoint address of the socket shared by
+        all depth streams, creating it if necessary.
+
+        """
+        if self._multiplex_stream is None:
+            self._multiplex_stream, self._multiplex_endpoint = \
+                    self._create_and_bind_socket(zmq.XPUB)
+            self._multiplex_stream.on_recv(functools.partial(
+                self._on_subscription, self._multiplex_stream))
+            if self.ipc:
+                self._multiplex_local_endpoint = self._bind_ipc(
+                        self._multiplex_stream, 'depth')
+        return self._multiplex_stream, self._multiplex_endpoint
+
+    def _depth_topic(self, kinect_id, name):
+        """Return the topic of the depth stream *name* of the kinect with id
+        *kinect_id* on a multiplexed socket.
+
+        """
+        return '{0}/{1}/'.format(kinect_id, name).encode('utf8')
+
     def _create_and_bind_socket(self, type):
         """Create and bind a socket of the specified type. Returns the ZMQStream
         and endpoint address.
 
+        """
+        stream = self._create_socket(type)
+        port = stream.socket.bind_to_random_port('tcp://{0}'.format(self.address))
+        return stream, 'tcp://{0}:{1}'.format(self._server_address, port)
+
+    def _create_socket(self, type):
+        """Create an unbound socket of the specified type. Returns the
+        ZMQStream.
+
         """
         socket = self._zmq_ctx.socket(type)
-        port = socket.bind_to_random_port('tcp://{0}'.format(self.address))
-        return ZMQStream(socket, self._io_loop), 'tcp://{0}:{1}'.format(self._server_address, port)
+        if type == zmq.XPUB and hasattr(zmq, 'XPUB_VERBOSER'):
+            # Pass on every subscription and unsubscription, not just the
+            # first and last for each topic, so that subscribers can be
+            # counted
+            socket.setsockopt(zmq.XPUB_VERBOSE, 1)
+            socket.setsockopt(zmq.XPUB_VERBOSER, 1)
+        return ZMQStream(socket, self._io_loop)
+
+    def _bind_ipc(self, stream, name):
+        """Bind the socket of *stream* to an ipc:// endpoint named after
+        *name*. Returns the endpoint address.
+
+        """
+        endpoint = 'ipc://{0}'.format(self._local_path(name))
+        stream.socket.bind(endpoint)
+        return endpoint
+
+    def _local_path(self, name):
+        """Return the path of the file named *name* in the directory for
+        ipc:// sockets and shared memory rings, creating the directory if
+        necessary.
+
+        """
+        if self._local_dir is None:
+            self._local_dir = tempfile.mkdtemp(prefix='streamkinect2-',
+                    dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        return os.path.join(self._local_dir, name)
+
+    def _remove_local_dir(self):
+        """Remove the directory for ipc:// sockets and shared memory rings,
+        if it has been created.
+
+        """
+        if self._local_dir is not None:
+            shutil.rmtree(self._local_dir, ignore_errors=True)
+            self._local_dir = None
 
     def __enter__(self):
         self.start()
@@ -295,22 +769,135 @@ class Server(object):
         self.stop()
 
     def _control_recv(self, stream, msg):
-        # Read message
+        # Split off the envelope. This is the parts up to and including the
+        # first empty part: the client's identity, added by the ROUTER socket,
+        # and any request id sent by the client. It is returned unchanged
+        # with the reply.
+        try:
+            envelope_len = msg.index(b'') + 1
+        except ValueError:
+            log.warn('Server received a message without an envelope')
+            return
+        envelope, msg = msg[:envelope_len], msg[envelope_len:]
+
+        # Read message. The reply uses the same encoding.
+        encoding = msg_encoding(msg)
         try:
             type, payload = parse_msg(msg)
         except ValueError as e:
-            stream.send_multipart(make_msg(MessageType.error, {
+            stream.send_multipart(envelope + make_msg(MessageType.error, {
                 'code': 400,
                 'reason': str(e),
-            }))
+            }, encoding))
             log.warn('Server received a bad message: {0}'.format(e))
             return
 
         # Handle control packet and receive response type and payload
         r_type, r_payload = self._handle_control(type, payload)
 
-        # Send response
-        stream.send_multipart(make_msg(r_type, r_payload))
+        # Send response. The "me" payload is only encoded when it changes.
+        if r_type == MessageType.me and r_payload is self._me:
+            try:
+                reply = self._me_msgs[encoding]
+            except KeyError:
+                reply = self._me_msgs[encoding] = make_msg(r_type, r_payload, encoding)
+        else:
+            reply = make_msg(r_type, r_payload, encoding)
+        stream.send_multipart(envelope + reply)
+
+    def _on_subscription(self, stream, msg):
+        """Called when a client subscribes to or unsubscribes from a topic on
+        the depth socket *stream*. Compressors are paused while their stream
+        has no subscribers.
+
+        """
+        records = []
+        for event in msg:
+            # The first byte is 1 for a subscription and 0 for an
+            # unsubscription. The topic follows. Anything else is not a
+            # subscription message.
+            event = bytes(event)
+            if len(event) == 0 or event[:1] not in (b'\x00', b'\x01'):
+                continue
+            record, depth_compresser = self._compresser_for_topic(stream, event[1:])
+            if depth_compresser is None:
+                continue
+            if record not in records:
+                records.append(record)
+
+            n_subscribers = record.subscribers.get(depth_compresser, 0)
+            if event[:1] == b'\x01':
+                record.subscribers[depth_compresser] = n_subscribers + 1
+            else:
+                record.subscribers[depth_compresser] = max(0, n_subscribers - 1)
+
+            # A stream profile's selector is paused along with its compressor
+            # and the profile is dropped once its last subscriber has gone. A
+            # stopped server compresses nothing until it is restarted.
+            kinect_id = record.kinect.unique_kinect_id
+            if n_subscribers == 0 and record.subscribers[depth_compresser] > 0:
+                if self.is_running:
+                    log.info('Resuming depth stream of "{0}"'.format(kinect_id))
+                    self._resume_compresser(depth_compresser)
+            elif n_subscribers > 0 and record.subscribers[depth_compresser] == 0:
+                log.info('Pausing depth stream of "{0}"'.format(kinect_id))
+                self._pause_compresser(depth_compresser)
+                if isinstance(depth_compresser.kinect, DepthFrameSelector):
+                    self._remove_profile(record, depth_compresser)
+
+        # Only build the pyramid levels down to the smallest one in use
+        for record in records:
+            if record.pyramid is None:
+                continue
+            n_active_levels = 0
+            for level, level_key in enumerate(_DEPTH_ENDPOINT_TYPES[1:]):
+                depth_compresser = record.compressers.get(level_key)
+                if record.subscribers.get(depth_compresser, 0) > 0:
+                    n_active_levels = level + 1
+            record.pyramid.n_active_levels = n_active_levels
+
+    def _pause_compresser(self, depth_compresser):
+        """Pause *depth_compresser* and, if it compresses a stream profile,
+        the profile's selector.
+
+        """
+        depth_compresser.pause()
+        if isinstance(depth_compresser.kinect, DepthFrameSelector):
+            depth_compresser.kinect.is_paused = True
+
+    def _resume_compresser(self, depth_compresser):
+        """Resume *depth_compresser* and, if it compresses a stream profile,
+        the profile's selector.
+
+        """
+        depth_compresser.resume()
+        if isinstance(depth_compresser.kinect, DepthFrameSelector):
+            depth_compresser.kinect.is_paused = False
+
+    def _terminate_compression_pool(self):
+        """Terminate the workers of the shared compression pool, if it has
+        been created.
+
+        """
+        if self._compression_pool is not None:
+            self._compression_pool.terminate()
+            self._compression_pool = None
+
+    def _compresser_for_topic(self, stream, topic):
+        """Return a pair giving the kinect record and compressor whose frames
+        are sent on the depth socket *stream* under *topic* or a pair of
+        *None* if there is none. An empty topic, which receives every message,
+        counts as the default stream of an unshared socket.
+
+        """
+        for record in self._kinects.values():
+            for depth_compresser, route in record.routes.items():
+                route_stream, prefix = route
+                if route_stream is not stream:
+                    continue
+                if prefix == [topic] or (len(prefix) == 0 and topic in (b'', _FRAME_TOPIC)):
+                    return record, depth_compresser
+        return None, None
 
     def _on_compressed_frame(self, depth_compresser, compressed_frame):
         kinect_id = depth_compresser.kinect.unique_kinect_id
@@ -318,11 +905,20 @@ class Server(object):
             record = self._kinects[kinect_id]
         except KeyError:
             log.warn('Got depth from from unknown kinect "{0}"'.format(kinect_id))
+            return
+
+        # Send data to clients of the socket for this compressor. Stream
+        # profiles and multiplexed streams prefix each frame with their topic.
+        try:
+            stream, prefix = record.routes[depth_compresser]
+        except KeyError:
+            return
 
-        # Send data to clients
-        stream = record.streams[EndpointType.depth]
-        stream.send(compressed_frame)
-        stream.flush()
+        # The compressed parts are not modified once emitted and so ZeroMQ may
+        # send them directly from our buffers
+        stream.send_multipart(prefix + compressed_frame, copy=False)
+        if self.flush_depth_frames:
+            stream.flush()
 
 class ServerBrowser(object):
     """An object which listens for kinect2 streaming servers on the network.
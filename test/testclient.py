@@ -3,11 +3,12 @@ Test basic client
 """
 from logging import getLogger
 
+from nose.plugins.skip import SkipTest
 from nose.tools import raises
 
 from streamkinect2.client import Client
 from streamkinect2.server import Server
-from streamkinect2.common import EndpointType
+from streamkinect2.common import EndpointType, MessageType, control_encoding_names
 from streamkinect2.mock import MockKinect
 
 from .util import AsyncTestCase
@@ -52,6 +53,32 @@ class TestClientConnection(AsyncTestCase):
         client.disconnect()
         assert not client.is_connected
 
+    def test_reconnect(self):
+        client = Client(self.endpoint, io_loop=self.io_loop)
+        client.connect()
+        client.disconnect()
+        client.connect()
+        assert client.is_connected
+        client.disconnect()
+
+    def test_pipelined_requests_free_deadlines(self):
+        client = Client(self.endpoint, io_loop=self.io_loop)
+        client.connect()
+
+        state = { 'n_pongs': 0 }
+        def pong():
+            state['n_pongs'] += 1
+        for _ in range(100):
+            client.ping(pong)
+        assert len(client._pending_requests) == 101
+
+        # Once every request is answered, no deadlines or timeout remain
+        self.keep_checking(lambda: state['n_pongs'] == 100 and client.server_name is not None)
+        self.wait()
+        assert len(client._deadlines) == 0
+        assert client._response_timeout_handle is None
+        client.disconnect()
+
     def test_explicit_connect_sends_events(self):
         state = { 'on_connect': 0 }
 
@@ -131,13 +158,14 @@ class TestBasicClient(AsyncTestCase):
         self.client.connect()
 
     def tearDown(self):
-        super(TestBasicClient, self).tearDown()
-
+        # Disconnect before the IOLoop closes the client's sockets
         if self.client.is_connected:
             self.client.disconnect()
         if self.server.is_running:
             self.server.stop()
 
+        super(TestBasicClient, self).tearDown()
+
     def test_control_endpoint(self):
         control_endpoint = self.server.endpoints[EndpointType.control]
         log.info('Testing client control endpoint {0} matches server endpoint {1}'.format(
@@ -158,6 +186,26 @@ class TestBasicClient(AsyncTestCase):
         self.keep_checking(lambda: len(self.client.kinect_ids) == 1)
         self.wait()
 
+    def test_heartbeat_fetches_devices_only_when_changed(self):
+        state = { 'n_who': 0 }
+        handle_control = self.server._handle_control
+        def counting_handle_control(type, payload):
+            if type == MessageType.who:
+                state['n_who'] += 1
+            return handle_control(type, payload)
+        self.server._handle_control = counting_handle_control
+
+        # Several heartbeats pass without the device list being fetched
+        self.io_loop.call_later(0.5, self.stop)
+        self.wait()
+        assert state['n_who'] <= 1
+
+        k = MockKinect()
+        self.server.add_kinect(k)
+        self.keep_checking(lambda: k.unique_kinect_id in self.client.kinect_ids)
+        self.wait()
+        assert state['n_who'] <= 2
+
     def test_add_signal_device_after_connect(self):
         self.keep_checking(lambda: self.client.server_name is not None)
         self.wait()
@@ -193,6 +241,23 @@ class TestBasicClient(AsyncTestCase):
         self.keep_checking(condition)
         self.wait()
 
+    def test_negotiates_control_encoding(self):
+        if 'msgpack' not in control_encoding_names():
+            raise SkipTest('msgpack is not installed')
+        self.keep_checking(lambda: self.client.server_name is not None)
+        self.wait()
+        assert self.client.control_encoding == 'msgpack'
+        self.client.ping(lambda: self.stop(True))
+        assert self.wait()
+
+    def test_json_control_encoding(self):
+        self.client.control_encodings = ['json']
+        self.keep_checking(lambda: self.client.server_name is not None)
+        self.wait()
+        assert self.client.control_encoding == 'json'
+        self.client.ping(lambda: self.stop(True))
+        assert self.wait()
+
     def test_ping(self):
         def pong():
             log.info('Got pong from server')
@@ -225,6 +290,7 @@ class TestBasicClient(AsyncTestCase):
         @self.client.on_depth_frame.connect_via(self.client)
         def on_depth_frame(client, depth_frame, kinect_id):
             assert k.unique_kinect_id == kinect_id
+            assert depth_frame.shape == (512, 424)
             state['n_depth_frames'] += 1
 
         @self.client.on_add_kinect.connect_via(self.client)
@@ -237,3 +303,284 @@ class TestBasicClient(AsyncTestCase):
             self.server.add_kinect(k)
             self.keep_checking(lambda: state['n_depth_frames'] > 1)
             self.wait()
+
+    def test_receives_delta_coded_depth_frames(self):
+        k = MockKinect()
+
+        state = { 'n_depth_frames': 0 }
+        @self.client.on_depth_frame.connect_via(self.client)
+        def on_depth_frame(client, depth_frame, kinect_id):
+            assert k.unique_kinect_id == kinect_id
+            assert depth_frame.shape == (512, 424)
+            state['n_depth_frames'] += 1
+
+        @self.client.on_add_kinect.connect_via(self.client)
+        def on_add_kinect(client, kinect_id):
+            assert client == self.client
+            assert kinect_id == k.unique_kinect_id
+            client.enable_depth_frames(kinect_id)
+
+        with k:
+            self.server.add_kinect(k, keyframe_interval=10)
+            self.keep_checking(lambda: state['n_depth_frames'] > 1)
+            self.wait()
+
+    def test_receives_lossless_depth_frames(self):
+        k = MockKinect()
+
+        state = { 'n_depth_frames': 0 }
+        @self.client.on_depth_frame.connect_via(self.client)
+        def on_depth_frame(client, depth_frame, kinect_id):
+            assert k.unique_kinect_id == kinect_id
+            assert depth_frame.shape == (512, 424)
+            state['n_depth_frames'] += 1
+
+        @self.client.on_add_kinect.connect_via(self.client)
+        def on_add_kinect(client, kinect_id):
+            assert client == self.client
+            assert kinect_id == k.unique_kinect_id
+            client.enable_depth_frames(kinect_id)
+
+        with k:
+            self.server.add_kinect(k, codec='lz4_16bit')
+            self.keep_checking(lambda: state['n_depth_frames'] > 1)
+            self.wait()
+
+    def test_receives_shuffled_depth_frames(self):
+        k = MockKinect()
+
+        state = { 'n_depth_frames': 0 }
+        @self.client.on_depth_frame.connect_via(self.client)
+        def on_depth_frame(client, depth_frame, kinect_id):
+            assert k.unique_kinect_id == kinect_id
+            assert depth_frame.shape == (512, 424)
+            state['n_depth_frames'] += 1
+
+        @self.client.on_add_kinect.connect_via(self.client)
+        def on_add_kinect(client, kinect_id):
+            assert client == self.client
+            assert kinect_id == k.unique_kinect_id
+            client.enable_depth_frames(kinect_id)
+
+        with k:
+            self.server.add_kinect(k, codec='lz4_shuffle')
+            self.keep_checking(lambda: state['n_depth_frames'] > 1)
+            self.wait()
+
+    def test_receives_banded_depth_frames(self):
+        k = MockKinect()
+
+        state = { 'n_depth_frames': 0 }
+        @self.client.on_depth_frame.connect_via(self.client)
+        def on_depth_frame(client, depth_frame, kinect_id):
+            assert depth_frame.shape == (512, 424)
+            state['n_depth_frames'] += 1
+
+        @self.client.on_add_kinect.connect_via(self.client)
+        def on_add_kinect(client, kinect_id):
+            client.enable_depth_frames(kinect_id)
+
+        with k:
+            self.server.add_kinect(k, n_bands=4)
+            self.keep_checking(lambda: state['n_depth_frames'] > 1)
+            self.wait()
+
+    def test_receives_background_coded_depth_frames(self):
+        k = MockKinect()
+
+        state = { 'n_depth_frames': 0 }
+        @self.client.on_depth_frame.connect_via(self.client)
+        def on_depth_frame(client, depth_frame, kinect_id):
+            assert depth_frame.shape == (512, 424)
+            state['n_depth_frames'] += 1
+
+        @self.client.on_add_kinect.connect_via(self.client)
+        def on_add_kinect(client, kinect_id):
+            client.enable_depth_frames(kinect_id)
+
+        with k:
+            self.server.add_kinect(k, background=True, background_threshold=4)
+            self.keep_checking(lambda: state['n_depth_frames'] > 1)
+            self.wait()
+
+    def test_receives_flushed_depth_frames(self):
+        k = MockKinect()
+        self.server.flush_depth_frames = True
+
+        state = { 'n_depth_frames': 0 }
+        @self.client.on_depth_frame.connect_via(self.client)
+        def on_depth_frame(client, depth_frame, kinect_id):
+            assert depth_frame.shape == (512, 424)
+            state['n_depth_frames'] += 1
+
+        @self.client.on_add_kinect.connect_via(self.client)
+        def on_add_kinect(client, kinect_id):
+            client.enable_depth_frames(kinect_id)
+
+        with k:
+            self.server.add_kinect(k)
+            self.keep_checking(lambda: state['n_depth_frames'] > 1)
+            self.wait()
+
+    def test_receives_downsampled_depth_frames(self):
+        k = MockKinect()
+
+        state = { 'n_depth_frames': 0 }
+        @self.client.on_depth_frame.connect_via(self.client)
+        def on_depth_frame(client, depth_frame, kinect_id):
+            assert depth_frame.shape == (128, 106)
+            state['n_depth_frames'] += 1
+
+        @self.client.on_add_kinect.connect_via(self.client)
+        def on_add_kinect(client, kinect_id):
+            client.enable_depth_frames(kinect_id, EndpointType.depth_quarter)
+
+        with k:
+            self.server.add_kinect(k, pyramid_levels=2)
+            self.keep_checking(lambda: state['n_depth_frames'] > 1)
+            self.wait()
+
+    def test_receives_profiled_depth_frames(self):
+        k = MockKinect()
+
+        state = { 'n_depth_frames': 0 }
+        @self.client.on_depth_frame.connect_via(self.client)
+        def on_depth_frame(client, depth_frame, kinect_id):
+            assert depth_frame.shape == (100, 50)
+            state['n_depth_frames'] += 1
+
+        @self.client.on_add_kinect.connect_via(self.client)
+        def on_add_kinect(client, kinect_id):
+            client.enable_depth_frames(kinect_id, fps=20, decimation=2,
+                    roi=(10, 20, 200, 100), codec='lz4_shuffle')
+
+        with k:
+            self.server.add_kinect(k)
+            self.keep_checking(lambda: state['n_depth_frames'] > 1)
+            self.wait()
+
+        # Only the profile was compressed
+        record = self.server._kinects[k.unique_kinect_id]
+        assert record.depth_compresser.n_compressed == 0
+        assert self.client.depth_stream_stats(k.unique_kinect_id).header.codec_id == 5
+
+    def test_receives_multiplexed_depth_frames(self):
+        self.server.multiplex_depth = True
+        mocks = [MockKinect(), MockKinect()]
+
+        state = dict((k.unique_kinect_id, 0) for k in mocks)
+        @self.client.on_depth_frame.connect_via(self.client)
+        def on_depth_frame(client, depth_frame, kinect_id):
+            assert depth_frame.shape == (512, 424)
+            state[kinect_id] += 1
+
+        @self.client.on_add_kinect.connect_via(self.client)
+        def on_add_kinect(client, kinect_id):
+            client.enable_depth_frames(kinect_id)
+
+        with mocks[0], mocks[1]:
+            for k in mocks:
+                self.server.add_kinect(k)
+            self.keep_checking(lambda: all(n > 1 for n in state.values()))
+            self.wait()
+
+        # Both devices share one connection
+        assert len(self.client._depth_sockets) == 1
+
+    def test_receives_local_depth_frames(self):
+        self.server.ipc = True
+        self.server.shared_memory = True
+        mocks = [MockKinect(), MockKinect()]
+
+        state = dict((k.unique_kinect_id, 0) for k in mocks)
+        @self.client.on_depth_frame.connect_via(self.client)
+        def on_depth_frame(client, depth_frame, kinect_id):
+            assert depth_frame.shape == (512, 424)
+            state[kinect_id] += 1
+
+        # Read one device from shared memory and one over ipc://
+        @self.client.on_add_kinect.connect_via(self.client)
+        def on_add_kinect(client, kinect_id):
+            if kinect_id == mocks[0].unique_kinect_id:
+                client.enable_depth_frames(kinect_id)
+            else:
+                client.enable_depth_frames(kinect_id, codec='lz4_shuffle')
+
+        with mocks[0], mocks[1]:
+            for k in mocks:
+                self.server.add_kinect(k)
+            self.keep_checking(lambda: all(n > 1 for n in state.values()))
+            self.wait()
+
+        assert all(ep.startswith('ipc://') for ep in self.client._depth_sockets)
+        stats = self.client.depth_stream_stats(mocks[0].unique_kinect_id)
+        assert stats.header.codec_id == 0
+
+        # Frames read from shared memory are never compressed
+        record = self.server._kinects[mocks[0].unique_kinect_id]
+        assert record.depth_compresser.n_compressed == 0
+
+    def test_compression_follows_subscribers(self):
+        k = MockKinect()
+        self.server.add_kinect(k, pyramid_levels=2)
+        record = self.server._kinects[k.unique_kinect_id]
+        assert all(c.is_paused for c in record.compressers.values())
+        assert record.pyramid.n_active_levels == 0
+
+        @self.client.on_add_kinect.connect_via(self.client)
+        def on_add_kinect(client, kinect_id):
+            client.enable_depth_frames(kinect_id, EndpointType.depth_quarter)
+
+        compresser = record.compressers[EndpointType.depth_quarter]
+        self.keep_checking(lambda: not compresser.is_paused)
+        self.wait()
+        assert record.depth_compresser.is_paused
+        assert record.pyramid.n_active_levels == 2
+
+        # Once the only subscriber goes away, compression pauses again
+        self.client.disconnect()
+        self.keep_checking(lambda: compresser.is_paused)
+        self.wait()
+        assert record.pyramid.n_active_levels == 0
+
+    def test_depth_stream_stats(self):
+        k = MockKinect()
+
+        state = { 'n_depth_frames': 0 }
+        @self.client.on_depth_frame.connect_via(self.client)
+        def on_depth_frame(client, depth_frame, kinect_id):
+            state['n_depth_frames'] += 1
+
+        @self.client.on_add_kinect.connect_via(self.client)
+        def on_add_kinect(client, kinect_id):
+            client.enable_depth_frames(kinect_id)
+
+        with k:
+            self.server.add_kinect(k)
+            self.keep_checking(lambda: state['n_depth_frames'] > 1)
+            self.wait()
+
+        stats = self.client.depth_stream_stats(k.unique_kinect_id)
+        assert stats.n_received >= state['n_depth_frames']
+        assert stats.header.kinect_id == k.unique_kinect_id
+        assert stats.header.shape == (512, 424)
+        assert stats.latency >= 0
+
+    def test_cannot_receive_missing_depth_level(self):
+        k = MockKinect()
+
+        state = { 'raised': False }
+        @self.client.on_add_kinect.connect_via(self.client)
+        def on_add_kinect(client, kinect_id):
+            try:
+                client.enable_depth_frames(kinect_id, EndpointType.depth_half)
+            except ValueError:
+                state['raised'] = True
+
+        self.server.add_kinect(k)
+        self.keep_checking(lambda: state['raised'])
+        self.wait()
+
+    @raises(ValueError)
+    def test_depth_stream_stats_need_depth_frames(self):
+        self.client.depth_stream_stats(MockKinect().unique_kinect_id)
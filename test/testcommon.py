@@ -0,0 +1,74 @@
+"""
+Control message encoding
+
+"""
+from nose.plugins.skip import SkipTest
+from nose.tools import raises
+
+from streamkinect2.common import MessageType, control_encoding_names
+from streamkinect2.common import make_msg, msg_encoding, parse_msg
+
+PAYLOADS = [
+    None,
+    { 'etag': 'abcd1234-5' },
+    { 'id': u'kinect \u00e9', 'fps': 12.5, 'decimation': 2, 'roi': [0, -10, 640, 480] },
+    { 'nested': { 'empty': {}, 'list': [], 'flags': [True, False, None] } },
+    { 'small': -32, 'large': 1 << 40, 'negative': -(1 << 40), 'long': 'x' * 70000 },
+    { 'many': dict(('key{0}'.format(i), i) for i in range(300)) },
+]
+
+def check_round_trip(encoding, payload):
+    msg = make_msg(MessageType.subscribe, payload, encoding)
+    assert msg_encoding(msg) == encoding
+    assert parse_msg(msg) == (MessageType.subscribe, payload)
+
+def test_round_trips():
+    for encoding in control_encoding_names():
+        for payload in PAYLOADS:
+            yield check_round_trip, encoding, payload
+
+def requires_msgpack():
+    if 'msgpack' not in control_encoding_names():
+        raise SkipTest('msgpack is not installed')
+
+def test_json_is_default():
+    assert make_msg(MessageType.ping, { 'a': 1 }) == [b'\x01', b'{"a": 1}']
+
+def test_json_is_always_supported():
+    assert 'json' in control_encoding_names()
+
+def test_msgpack_is_preferred():
+    requires_msgpack()
+    assert control_encoding_names()[0] == 'msgpack'
+
+def test_msgpack_encoding():
+    requires_msgpack()
+    # The example from the MessagePack specification
+    msg = make_msg(MessageType.me, { 'compact': True }, 'msgpack')
+    assert msg == [b'\x14', b'\x81\xa7compact\xc3']
+
+def test_msgpack_decodes_all_integer_widths():
+    requires_msgpack()
+    msg = [b'\x11', b'\x96\xcc\x80\xcd\x01\x00\xce\x00\x01\x00\x00\xd0\x80\xd1\xfc\x18\xca\x3f\xc0\x00\x00']
+    assert parse_msg(msg)[1] == [128, 256, 65536, -128, -1000, 1.5]
+
+@raises(ValueError)
+def check_bad_msgpack(payload):
+    requires_msgpack()
+    parse_msg([b'\x11', payload])
+
+def test_bad_msgpack():
+    for payload in (b'', b'\xa5abc', b'\x92\x01', b'\x01\x02', b'\xc1',
+            b'\x81\x01\x02', b'\xa2\xff\xfe'):
+        yield check_bad_msgpack, payload
+
+@raises(ValueError)
+def test_unknown_message_type():
+    parse_msg([b'\x0f'])
+
+@raises(ValueError)
+def test_unknown_encoding():
+    make_msg(MessageType.ping, None, 'nonesuch')
+
+def test_unknown_message_encoded_as_json():
+    assert msg_encoding([b'\xff']) == 'json'
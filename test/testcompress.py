@@ -0,0 +1,581 @@
+"""
+Depth frame compression and decompression
+
+"""
+from nose.tools import raises
+import numpy as np
+
+from streamkinect2.compress import _compress_depth_frame, _KEYFRAME, _DELTA_FRAME
+from streamkinect2.compress import _BACKGROUND_FRAME, _FOREGROUND_FRAME, _subtract_reference
+from streamkinect2.compress import _foreground_mask
+from streamkinect2.compress import _band_rows, _scratch_buffer, _shuffle_bytes, _split_12bit
+from streamkinect2.compress import _TILE_FRAME, _tile_grid, _tiles
+from streamkinect2.compress import DepthFrameCompressor, DepthFrameDecompressor
+from streamkinect2.compress import DepthFramePyramid, DepthFrameSelector, downsample_depth_frame
+from streamkinect2.compress import codec_names, get_codec, register_codec
+from streamkinect2.compress import FrameHeader, make_frame_header, parse_frame_header
+from streamkinect2.mock import DepthFrame, MockKinect, _make_mock
+
+def make_depth_frame():
+    wall, sphere = _make_mock((424, 512))
+    df = np.asarray(np.minimum(wall, sphere), order='C', dtype=np.uint16)
+    return DepthFrame(data=bytes(df.data), shape=df.shape[::-1]), df
+
+def frame_array(depth_frame):
+    w, h = depth_frame.shape
+    return np.frombuffer(depth_frame.data, dtype=np.uint16).reshape((h, w))
+
+def make_compressed_frame(depth_frame, frame_type=_KEYFRAME, reference=None,
+        codec='lz4', seq=0, shape=None, background_id=0, threshold=None):
+    header = FrameHeader(kinect_id=u'test', seq=seq, frame_type=frame_type,
+            codec_id=get_codec(codec).id, background_id=background_id,
+            shape=shape or depth_frame.shape, capture_time=0.0, compress_time=0.0)
+    msg = [make_frame_header(header), _compress_depth_frame(depth_frame,
+        reference, get_codec(codec).compress, threshold=threshold)]
+    if frame_type in (_BACKGROUND_FRAME, _FOREGROUND_FRAME):
+        msg.insert(1, _foreground_mask(frame_array(depth_frame),
+            np.frombuffer(reference, dtype=np.uint16), threshold))
+    return msg
+
+def make_background_frame(depth_frame, background, background_id=1, threshold=0,
+        seq=0):
+    msg = make_compressed_frame(depth_frame, _BACKGROUND_FRAME, background.data,
+            'lz4_shuffle', seq, background_id=background_id, threshold=threshold)
+    return msg[:2] + [_compress_depth_frame(background,
+        compress=get_codec('lz4_shuffle').compress)] + msg[2:]
+
+def make_banded_frame(depth_frame, n_bands, frame_type=_KEYFRAME, reference=None,
+        seq=0):
+    msg = make_compressed_frame(depth_frame, frame_type, reference, seq=seq)
+    return msg[:1] + [
+        _compress_depth_frame(depth_frame, reference, rows=rows)
+        for rows in _band_rows(depth_frame.shape[1], n_bands)
+    ]
+
+def test_round_trip():
+    depth_frame, expected = make_depth_frame()
+    decompressor = DepthFrameDecompressor()
+    output = decompressor.decompress(make_compressed_frame(depth_frame))
+    assert output.shape == depth_frame.shape
+    assert np.all(frame_array(output) == (expected & 0xfff))
+
+def check_codec_round_trip(name):
+    depth_frame, expected = make_depth_frame()
+    decompressor = DepthFrameDecompressor(codec=name)
+    output = decompressor.decompress(make_compressed_frame(depth_frame, codec=name))
+    output = frame_array(output)
+    if name in ('lz4', 'delta'):
+        assert np.all(output == (expected & 0xfff))
+    else:
+        assert np.all(output == expected)
+
+def test_codec_round_trips():
+    for name in codec_names():
+        yield check_codec_round_trip, name
+
+def check_codec_decompresses_memoryview(name):
+    depth_frame, expected = make_depth_frame()
+    msg = [memoryview(part) for part in make_compressed_frame(depth_frame, codec=name)]
+    output = frame_array(DepthFrameDecompressor(codec=name).decompress(msg))
+    assert np.all(output == (expected & 0xfff if name in ('lz4', 'delta') else expected))
+
+def test_codecs_decompress_memoryviews():
+    for name in codec_names():
+        yield check_codec_decompresses_memoryview, name
+
+def test_lossless_codecs_keep_high_bits():
+    depth_frame, expected = make_depth_frame()
+    expected = expected | 0xf000
+    depth_frame = DepthFrame(data=bytes(expected.data), shape=depth_frame.shape)
+    for name in ('raw', 'lz4_16bit', 'lz4_shuffle', 'rvl'):
+        decompressor = DepthFrameDecompressor(codec=name)
+        output = decompressor.decompress(make_compressed_frame(depth_frame, codec=name))
+        assert np.all(frame_array(output) == expected)
+
+def check_rvl_round_trip(expected):
+    expected = np.asarray(expected, dtype=np.uint16)
+    codec = get_codec('rvl')
+    output = np.empty_like(expected)
+    codec.decompress(codec.compress(expected), output, {})
+    assert np.all(output == expected)
+
+def test_rvl_round_trips():
+    _, frame = make_depth_frame()
+    holes = frame.copy()
+    holes[::7, ::3] = 0
+    holes[100:200, :] = 0
+    yield check_rvl_round_trip, frame
+    yield check_rvl_round_trip, holes
+    yield check_rvl_round_trip, np.zeros((424, 512))
+    yield check_rvl_round_trip, np.full((424, 512), 0xffff)
+    yield check_rvl_round_trip, [[0, 0, 5, 4, 3, 0, 0], [1, 0, 0, 0, 0, 2, 0]]
+    yield check_rvl_round_trip, [[65535, 1, 65535, 0, 40000, 2, 1 << 15]]
+
+def test_rvl_reuses_scratch():
+    _, frame = make_depth_frame()
+    codec, scratch = get_codec('rvl'), {}
+    for expected in (frame, frame[:10, :20], np.zeros((3, 4), dtype=np.uint16)):
+        output = np.empty_like(expected)
+        codec.decompress(codec.compress(expected), output, scratch)
+        assert np.all(output == expected)
+
+@raises(ValueError)
+def test_rvl_rejects_truncated_data():
+    _, frame = make_depth_frame()
+    codec = get_codec('rvl')
+    compressed = codec.compress(frame)
+    codec.decompress(compressed[:len(compressed)//2], np.empty_like(frame), {})
+
+@raises(ValueError)
+def test_unknown_codec():
+    get_codec('nonesuch')
+
+@raises(ValueError)
+def test_duplicate_codec():
+    register_codec(get_codec('lz4'))
+
+def test_delta_round_trip():
+    first, _ = make_depth_frame()
+    second_array = frame_array(first) + 3
+    second = DepthFrame(data=bytes(second_array.data), shape=first.shape)
+
+    decompressor = DepthFrameDecompressor()
+    decompressor.decompress(make_compressed_frame(first))
+    output = decompressor.decompress(make_compressed_frame(second, _DELTA_FRAME,
+        first.data, seq=1))
+    assert np.all(frame_array(output) == (second_array & 0xfff))
+
+def test_delta_needs_keyframe():
+    first, _ = make_depth_frame()
+    decompressor = DepthFrameDecompressor()
+    assert decompressor.needs_keyframe
+    assert decompressor.decompress(make_compressed_frame(first, _DELTA_FRAME,
+        first.data)) is None
+
+def test_lost_frame_needs_keyframe():
+    first, _ = make_depth_frame()
+    decompressor = DepthFrameDecompressor()
+    decompressor.decompress(make_compressed_frame(first, seq=10))
+    assert decompressor.decompress(make_compressed_frame(first, _DELTA_FRAME,
+        first.data, seq=13)) is None
+    assert decompressor.n_lost == 2
+    assert decompressor.needs_keyframe
+    assert decompressor.decompress(make_compressed_frame(first, seq=14)) is not None
+    assert decompressor.n_lost == 2
+
+def test_sequence_numbers_wrap():
+    first, _ = make_depth_frame()
+    decompressor = DepthFrameDecompressor()
+    decompressor.decompress(make_compressed_frame(first, seq=(1<<32) - 1))
+    assert decompressor.decompress(make_compressed_frame(first, _DELTA_FRAME,
+        first.data, seq=0)) is not None
+    assert decompressor.n_lost == 0
+
+def test_frame_header_round_trip():
+    header = FrameHeader(kinect_id=u'abc123', seq=1234, frame_type=_DELTA_FRAME,
+            codec_id=3, background_id=7, shape=(512, 424), capture_time=1.5,
+            compress_time=2.25)
+    assert parse_frame_header(make_frame_header(header)) == header
+
+@raises(ValueError)
+def test_short_frame_header():
+    parse_frame_header(b'\x01\x00')
+
+@raises(ValueError)
+def test_unknown_frame_header_version():
+    depth_frame, _ = make_depth_frame()
+    msg = make_compressed_frame(depth_frame)
+    parse_frame_header(b'\xff' + msg[0][1:])
+
+@raises(ValueError)
+def test_unknown_frame_type():
+    depth_frame, _ = make_depth_frame()
+    DepthFrameDecompressor().decompress(make_compressed_frame(depth_frame, 0xff))
+
+def test_decompressor_uses_header_codec():
+    depth_frame, expected = make_depth_frame()
+    decompressor = DepthFrameDecompressor(codec='lz4')
+    output = decompressor.decompress(make_compressed_frame(depth_frame, codec='raw'))
+    assert decompressor.codec.name == 'raw'
+    assert np.all(frame_array(output) == expected)
+
+def test_split_12bit():
+    _, frame = make_depth_frame()
+    frame = frame | 0xf000
+    h, w = frame.shape
+    out = np.empty(h*w + h*(w>>1), dtype=np.uint8)
+    _split_12bit(frame, out)
+    assert np.all(out[:h*w] == ((frame >> 4) & 0xff).ravel())
+    low_bits = frame & 0xf
+    assert np.all(out[h*w:] == ((low_bits[:,0::2] << 4) | low_bits[:,1::2]).ravel())
+
+def test_shuffle_bytes():
+    _, frame = make_depth_frame()
+    out = np.empty(2 * frame.size, dtype=np.uint8)
+    _shuffle_bytes(frame, out)
+    assert np.all(out[:frame.size] == (frame >> 8).ravel())
+    assert np.all(out[frame.size:] == (frame & 0xff).ravel())
+
+def test_scratch_buffer_is_reused():
+    first = _scratch_buffer(1000)
+    second = _scratch_buffer(500)
+    assert second.shape == (500,)
+    assert np.may_share_memory(first, second)
+
+def test_band_rows_cover_frame():
+    for n_bands in (1, 3, 4, 7):
+        rows = _band_rows(424, n_bands)
+        assert len(rows) == n_bands
+        assert rows[0][0] == 0 and rows[-1][1] == 424
+        assert all(a[1] == b[0] for a, b in zip(rows[:-1], rows[1:]))
+
+def check_banded_round_trip(threads):
+    first, expected = make_depth_frame()
+    second_array = expected + 3
+    second = DepthFrame(data=bytes(second_array.data), shape=first.shape)
+
+    decompressor = DepthFrameDecompressor(threads=threads)
+    output = decompressor.decompress(make_banded_frame(first, 3))
+    assert np.all(frame_array(output) == (expected & 0xfff))
+    output = decompressor.decompress(make_banded_frame(second, 3, _DELTA_FRAME,
+        first.data, seq=1))
+    assert np.all(frame_array(output) == (second_array & 0xfff))
+
+def test_banded_round_trip():
+    yield check_banded_round_trip, 1
+    yield check_banded_round_trip, 4
+
+@raises(ValueError)
+def test_too_few_parts():
+    depth_frame, _ = make_depth_frame()
+    DepthFrameDecompressor().decompress(make_compressed_frame(depth_frame)[:1])
+
+@raises(ValueError)
+def test_bad_number_of_bands():
+    DepthFrameCompressor(MockKinect(), backend='inline', n_bands=0)
+
+def test_subtract_background():
+    frame = np.array([[0, 10, 100, 1000, 65535, 5]], dtype=np.uint16)
+    background = np.array([[0, 12, 96, 1000, 0, 65533]], dtype=np.uint16)
+    out = np.empty_like(frame)
+    _subtract_reference(frame, background, 3, out)
+    assert np.all(out == [[0, 0, 100, 0, 65535, 5]])
+    _subtract_reference(frame, background, 0, out)
+    assert np.all(out == [[0, 10, 100, 0, 65535, 5]])
+
+def make_scene(dx, seed):
+    """A fixed camera looking at the mock wall, with up to 2mm of noise, and
+    only the nearest part of the mock sphere, shifted by *dx*, in front of
+    it. Returns the frame and the noiseless wall."""
+    wall, sphere = _make_mock((424, 512))
+    noise = np.random.RandomState(seed).randint(-2, 3, wall.shape)
+    sphere = np.roll(sphere, dx, 1)
+    df = np.where(sphere < 600, sphere, wall + noise)
+    df = np.asarray(df, order='C', dtype=np.uint16)
+    return DepthFrame(data=bytes(df.data), shape=df.shape[::-1]), df, wall
+
+def test_background_round_trip():
+    _, _, wall = make_scene(0, 0)
+    background = DepthFrame(data=bytes(wall.data), shape=wall.shape[::-1])
+    first, first_array, _ = make_scene(30, 1)
+    second, second_array, _ = make_scene(60, 2)
+
+    decompressor = DepthFrameDecompressor()
+    output = decompressor.decompress(make_background_frame(first, background,
+        threshold=4))
+    assert np.all(np.abs(frame_array(output).astype(np.int32) - first_array) <= 4)
+
+    msg = make_compressed_frame(second, _FOREGROUND_FRAME, background.data,
+            'lz4_shuffle', 1, background_id=1, threshold=4)
+    output = frame_array(decompressor.decompress(msg))
+    person = second_array < 600
+    assert np.all(output[person] == second_array[person])
+    assert np.all(output[~person] == wall[~person])
+
+    # The foreground should compress far better than the noisy frame itself
+    keyframe = make_compressed_frame(second, codec='lz4_shuffle')
+    assert len(msg[2]) * 10 < len(keyframe[1])
+
+def test_foreground_needs_background():
+    background, _, _ = make_scene(0, 0)
+    frame, _, _ = make_scene(30, 1)
+    msg = make_compressed_frame(frame, _FOREGROUND_FRAME, background.data,
+            'lz4_shuffle', background_id=1, threshold=0)
+    decompressor = DepthFrameDecompressor()
+    assert decompressor.decompress(msg) is None
+    assert decompressor.needs_keyframe
+
+    # A foreground frame for a different background cannot be decompressed
+    decompressor.decompress(make_background_frame(frame, background, background_id=2))
+    assert decompressor.decompress(msg) is None
+
+@raises(ValueError)
+def test_background_frame_needs_even_number_of_bands():
+    background, _, _ = make_scene(0, 0)
+    DepthFrameDecompressor().decompress(make_background_frame(background, background)[:3])
+
+@raises(ValueError)
+def test_foreground_frame_needs_mask():
+    background, _, _ = make_scene(0, 0)
+    DepthFrameDecompressor().decompress(make_background_frame(background, background)[:1])
+
+def test_foreground_keeps_zero_samples():
+    _, _, wall = make_scene(0, 0)
+    background = DepthFrame(data=bytes(wall.data), shape=wall.shape[::-1])
+    first, first_array, _ = make_scene(30, 1)
+    second, second_array, _ = make_scene(60, 2)
+
+    # Samples with no depth reading in front of the wall are foreground even
+    # though the residual zeroes background samples too
+    first_array[100:110, 100:110] = 0
+    second_array[200:210, 300:310] = 0
+    first = DepthFrame(data=bytes(first_array.data), shape=first.shape)
+    second = DepthFrame(data=bytes(second_array.data), shape=second.shape)
+
+    decompressor = DepthFrameDecompressor()
+    output = frame_array(decompressor.decompress(make_background_frame(first,
+        background, threshold=4)))
+    assert np.all(output[100:110, 100:110] == 0)
+
+    msg = make_compressed_frame(second, _FOREGROUND_FRAME, background.data,
+            'lz4_shuffle', 1, background_id=1, threshold=4)
+    output = frame_array(decompressor.decompress(msg))
+    assert np.all(output[200:210, 300:310] == 0)
+    assert np.all(np.abs(output.astype(np.int32) - second_array) <= 4)
+
+@raises(ValueError)
+def test_bad_background_threshold():
+    DepthFrameCompressor(MockKinect(), backend='inline', background=True,
+            background_threshold=-1)
+
+def test_tile_grid_covers_frame():
+    assert _tile_grid((512, 424)) == (27, 32)
+    assert _tile_grid((16, 16)) == (1, 1)
+    assert _tile_grid((17, 1)) == (1, 2)
+
+def test_tiles_view():
+    padded = np.arange(32*48, dtype=np.uint16).reshape((32, 48))
+    tiles = _tiles(padded)
+    assert tiles.shape == (2, 3, 16, 16)
+    assert np.all(tiles[1, 2] == padded[16:32, 32:48])
+
+def make_tile_frame(depth_frame, changed, seq=1):
+    """Return a tile frame sending the tiles of *depth_frame* for which the
+    boolean array *changed* is set."""
+    w, h = depth_frame.shape
+    rows, cols = _tile_grid(depth_frame.shape)
+    padded = np.zeros((rows*16, cols*16), dtype=np.uint16)
+    padded[:h, :w] = frame_array(depth_frame)
+    tiles = np.ascontiguousarray(_tiles(padded)[changed].reshape((-1, 16)))
+    msg = make_compressed_frame(DepthFrame(data=tiles, shape=(16, tiles.shape[0])),
+            _TILE_FRAME, seq=seq, codec='raw', shape=depth_frame.shape)
+    return msg[:1] + [np.packbits(changed).tobytes()] + msg[1:]
+
+def test_tile_frame_round_trip():
+    depth_frame, expected = make_depth_frame()
+    changed = np.zeros(_tile_grid(depth_frame.shape), dtype=np.bool_)
+    changed[0, 0] = changed[26, 31] = changed[10, 3] = True
+
+    decompressor = DepthFrameDecompressor()
+    decompressor.decompress(make_compressed_frame(DepthFrame(
+        data=bytes(np.zeros_like(expected).data), shape=depth_frame.shape), codec='raw'))
+    output = frame_array(decompressor.decompress(make_tile_frame(depth_frame, changed)))
+    assert np.all(output[:16, :16] == expected[:16, :16])
+    assert np.all(output[416:, 496:] == expected[416:, 496:])
+    assert np.all(output[160:176, 48:64] == expected[160:176, 48:64])
+    assert np.count_nonzero(output) == np.count_nonzero(expected[:16, :16]) + \
+            np.count_nonzero(expected[416:, 496:]) + np.count_nonzero(expected[160:176, 48:64])
+
+    # A further tile frame patches the result of the first
+    changed[...] = True
+    output = frame_array(decompressor.decompress(make_tile_frame(depth_frame, changed, 2)))
+    assert np.all(output == expected)
+
+def test_tile_frame_needs_keyframe():
+    depth_frame, _ = make_depth_frame()
+    changed = np.ones(_tile_grid(depth_frame.shape), dtype=np.bool_)
+    decompressor = DepthFrameDecompressor()
+    assert decompressor.decompress(make_tile_frame(depth_frame, changed)) is None
+    assert decompressor.needs_keyframe
+
+@raises(ValueError)
+def test_tile_frame_rejects_wrong_tile_map():
+    depth_frame, _ = make_depth_frame()
+    changed = np.ones(_tile_grid(depth_frame.shape), dtype=np.bool_)
+    msg = make_tile_frame(depth_frame, changed)
+    decompressor = DepthFrameDecompressor()
+    decompressor.decompress(make_compressed_frame(depth_frame, codec='raw'))
+    decompressor.decompress(msg[:1] + [msg[1][:-1]] + msg[2:])
+
+@raises(ValueError)
+def test_bad_tile_threshold():
+    DepthFrameCompressor(MockKinect(), backend='inline', tiles=True, tile_threshold=-1)
+
+@raises(ValueError)
+def test_tiles_with_background():
+    DepthFrameCompressor(MockKinect(), backend='inline', tiles=True, background=True)
+
+def test_decompressor_reuses_buffer():
+    depth_frame, _ = make_depth_frame()
+    compressed = make_compressed_frame(depth_frame)
+    decompressor = DepthFrameDecompressor()
+    first = frame_array(decompressor.decompress(compressed))
+    second = frame_array(decompressor.decompress(compressed))
+    assert np.may_share_memory(first, second)
+
+def test_decompressor_uses_header_shape():
+    depth_frame, expected = make_depth_frame()
+    decompressor = DepthFrameDecompressor(shape=(256, 212))
+    output = decompressor.decompress(make_compressed_frame(depth_frame))
+    assert output.shape == depth_frame.shape
+    assert decompressor.shape == depth_frame.shape
+    assert np.all(frame_array(output) == (expected & 0xfff))
+
+@raises(ValueError)
+def test_decompressor_rejects_wrong_shape():
+    depth_frame, _ = make_depth_frame()
+    compressed = make_compressed_frame(depth_frame, shape=(256, 212))
+    DepthFrameDecompressor().decompress(compressed)
+
+def send_frames_to_busy_compressor(drop_policy, n_frames):
+    """Send *n_frames* frames to a compressor whose workers are all busy.
+    Returns the compressor and the frames sent."""
+    kinect = MockKinect()
+    fc = DepthFrameCompressor(kinect, backend='inline', drop_policy=drop_policy)
+
+    # Pretend that the maximum number of frames are being compressed
+    fc._n_in_flight = fc.max_in_flight
+
+    frames = [make_depth_frame()[0] for _ in range(n_frames)]
+    for frame in frames:
+        kinect.on_depth_frame.send(kinect, depth_frame=frame)
+    return fc, frames
+
+def test_paused_compressor_ignores_frames():
+    kinect = MockKinect()
+    fc = DepthFrameCompressor(kinect, backend='inline', keyframe_interval=10)
+    fc.pause()
+    kinect.on_depth_frame.send(kinect, depth_frame=make_depth_frame()[0])
+    assert fc.n_compressed == 0
+    assert fc.n_dropped == 0
+
+    # The first frame after resuming is a keyframe
+    fc._reference = make_depth_frame()[0]
+    fc.resume()
+    kinect.on_depth_frame.send(kinect, depth_frame=make_depth_frame()[0])
+    assert fc.n_compressed == 1
+    assert fc._n_since_keyframe == 0
+
+@raises(ValueError)
+def test_bad_keyframe_interval():
+    DepthFrameCompressor(MockKinect(), backend='inline', keyframe_interval=0)
+
+@raises(ValueError)
+def test_unknown_drop_policy():
+    DepthFrameCompressor(MockKinect(), backend='inline', drop_policy='random')
+
+def test_drop_newest_policy():
+    fc, frames = send_frames_to_busy_compressor('drop_newest', 3)
+    assert fc._pending is frames[0]
+    assert fc.n_dropped == 2
+    assert fc.n_replaced == 0
+
+def test_replace_pending_policy():
+    fc, frames = send_frames_to_busy_compressor('replace_pending', 3)
+    assert fc._pending is frames[2]
+    assert fc.n_dropped == 2
+    assert fc.n_replaced == 2
+
+def test_adaptive_policy_lowers_in_flight_limit():
+    fc, frames = send_frames_to_busy_compressor('adaptive', 3)
+    assert fc._pending is frames[2]
+    assert fc.n_replaced == 2
+    assert fc._in_flight_limit < fc.max_in_flight
+
+def check_downsample(method, expected):
+    frame = np.array([
+        [0, 0, 10, 20, 5],
+        [0, 0, 40, 30, 5],
+        [9, 1, 0, 60, 5],
+        [7, 8, 50, 70, 5],
+        [1, 1, 1, 1, 1],
+    ], dtype=np.uint16)
+    output = downsample_depth_frame(DepthFrame(data=bytes(frame.data), shape=(5, 5)), method)
+    assert output.shape == (2, 2)
+    assert np.all(frame_array(output) == expected)
+
+def test_downsample():
+    yield check_downsample, 'min', [[0, 10], [1, 50]]
+    yield check_downsample, 'median', [[0, 20], [7, 50]]
+
+@raises(ValueError)
+def test_unknown_downsample_method():
+    depth_frame, _ = make_depth_frame()
+    downsample_depth_frame(depth_frame, 'mean')
+
+def test_pyramid_levels():
+    kinect = MockKinect()
+    pyramid = DepthFramePyramid(kinect, 2)
+    frames = []
+    for level in pyramid.levels:
+        level.on_depth_frame.connect(
+            lambda level, depth_frame: frames.append(depth_frame),
+            sender=level, weak=False)
+    depth_frame, expected = make_depth_frame()
+    kinect.on_depth_frame.send(kinect, depth_frame=depth_frame)
+
+    assert [f.shape for f in frames] == [(256, 212), (128, 106)]
+    assert all(level.unique_kinect_id == kinect.unique_kinect_id for level in pyramid.levels)
+    quarter = expected.reshape((106, 4, 128, 4)).min(axis=(1, 3))
+    assert np.all(frame_array(frames[1]) == quarter)
+
+@raises(ValueError)
+def test_pyramid_needs_a_level():
+    DepthFramePyramid(MockKinect(), 0)
+
+def select_frames(n_frames, **kwargs):
+    kinect = MockKinect()
+    selector = DepthFrameSelector(kinect, **kwargs)
+    frames = []
+    selector.on_depth_frame.connect(
+        lambda selector, depth_frame: frames.append(depth_frame),
+        sender=selector, weak=False)
+    depth_frame, expected = make_depth_frame()
+    for _ in range(n_frames):
+        kinect.on_depth_frame.send(kinect, depth_frame=depth_frame)
+    return frames, expected
+
+def test_selector_passes_frames_through():
+    frames, expected = select_frames(3)
+    assert len(frames) == 3
+    assert np.all(frame_array(frames[0]) == expected)
+
+def test_selector_region_and_decimation():
+    frames, expected = select_frames(1, decimation=3, roi=(500, 10, 100, 7))
+    # The region is clipped to 12 columns which decimate to 4
+    assert frames[0].shape == (4, 3)
+    assert np.all(frame_array(frames[0]) == expected[10:17:3, 500:512:3])
+
+def test_selector_drops_odd_column():
+    frames, expected = select_frames(1, roi=(0, 0, 5, 4))
+    assert frames[0].shape == (4, 4)
+
+def test_selector_limits_frame_rate():
+    frames, _ = select_frames(5, fps=0.1)
+    assert len(frames) == 1
+
+def test_selector_skips_region_outside_frame():
+    frames, _ = select_frames(1, roi=(1000, 0, 10, 10))
+    assert len(frames) == 0
+
+def check_bad_selector(kwargs):
+    try:
+        DepthFrameSelector(MockKinect(), **kwargs)
+    except ValueError:
+        return
+    assert False
+
+def test_bad_selectors():
+    for kwargs in ({ 'fps': 0 }, { 'decimation': 0 }, { 'decimation': 17 },
+            { 'roi': (0, 0, 10) }, { 'roi': (-1, 0, 10, 10) }, { 'roi': (0, 0, 10, 0) }):
+        yield check_bad_selector, kwargs
@@ -5,10 +5,16 @@ Mock kinect support
 from logging import getLogger
 import time
 
+from nose.tools import raises
+
 log = getLogger(__name__)
 
+import numpy as np
+
 import streamkinect2.mock as mock
-from streamkinect2.compress import DepthFrameCompressor
+from streamkinect2.compress import CompressionPool, DepthFrameCompressor, DepthFrameDecompressor
+from streamkinect2.compress import parse_frame_header, _BACKGROUND_FRAME, _FOREGROUND_FRAME
+from streamkinect2.compress import _KEYFRAME, _TILE_FRAME
 
 from .util import AsyncTestCase
 
@@ -36,10 +42,12 @@ class TestMock(AsyncTestCase):
         # Return the number of frames received and how long we waited
         return state['count'], (end-start)
 
-    def wait_for_and_compress_frames(self, kinect, min_count, timeout):
+    def wait_for_and_compress_frames(self, kinect, min_count, timeout, backend='process',
+            keyframe_interval=1, **kwargs):
         compressed = []
 
-        fc = DepthFrameCompressor(kinect, io_loop=self.io_loop)
+        fc = DepthFrameCompressor(kinect, io_loop=self.io_loop, backend=backend,
+                keyframe_interval=keyframe_interval, **kwargs)
         @fc.on_compressed_frame.connect_via(fc)
         def new_compressed_frame(_, compressed_frame):
             compressed.append(compressed_frame)
@@ -78,11 +86,224 @@ class TestMock(AsyncTestCase):
         log.info('Got {0} compressed packets in {1:.2f} seconds'.format(len(packets), t))
         assert len(packets) > 0
 
+    def test_thread_backend(self):
+        with self.kinect as kinect:
+            packets, t = self.wait_for_and_compress_frames(kinect, 10, 0.5, backend='thread')
+        assert len(packets) > 0
+
+    def test_inline_backend(self):
+        with self.kinect as kinect:
+            packets, t = self.wait_for_and_compress_frames(kinect, 10, 0.5, backend='inline')
+        assert len(packets) > 0
+
+    @raises(ValueError)
+    def test_unknown_backend(self):
+        DepthFrameCompressor(self.kinect, io_loop=self.io_loop, backend='quantum')
+
+    def test_shared_pool_serves_all_kinects(self):
+        # A single worker is shared between two kinects
+        pool = CompressionPool(backend='thread', workers=1)
+        counts = {}
+
+        kinects = [self.kinect, mock.MockKinect()]
+        compressors = []
+        for kinect in kinects:
+            fc = DepthFrameCompressor(kinect, io_loop=self.io_loop, pool=pool, max_in_flight=1)
+            counts[fc] = 0
+            @fc.on_compressed_frame.connect_via(fc)
+            def new_compressed_frame(fc, compressed_frame):
+                counts[fc] += 1
+            compressors.append(fc)
+
+        with kinects[0], kinects[1]:
+            start = time.time()
+            self.keep_checking(lambda: min(counts.values()) > 5 or time.time() > start + 2)
+            self.wait()
+
+        pool.terminate()
+        for fc in compressors:
+            assert fc.pool is pool
+            assert counts[fc] > 5
+
+    def test_compressed_frames_decompress(self):
+        with self.kinect as kinect:
+            packets, t = self.wait_for_and_compress_frames(kinect, 10, 0.5)
+        assert len(packets) > 0
+
+        decompressor = DepthFrameDecompressor()
+        for packet in packets:
+            depth_frame = decompressor.decompress(packet)
+            # The mock scene is never closer than 500mm
+            assert np.all(np.frombuffer(depth_frame.data, dtype=np.uint16) >= 500)
+
+    def test_compressed_frames_have_headers(self):
+        with self.kinect as kinect:
+            packets, t = self.wait_for_and_compress_frames(kinect, 10, 0.5)
+        assert len(packets) > 1
+
+        headers = [parse_frame_header(packet[0]) for packet in packets]
+        for idx, header in enumerate(headers):
+            assert header.kinect_id == kinect.unique_kinect_id
+            assert header.seq == headers[0].seq + idx
+            assert header.shape == (512, 424)
+            assert header.capture_time <= header.compress_time
+
+    def compress_frames_inline(self, n_frames, dx_step=20, **kwargs):
+        """Send *n_frames* mock depth frames from a kinect which is not running
+        to a compressor using the inline backend. The mock sphere moves
+        *dx_step* pixels between frames. Since the inline backend never drops
+        frames, each compressed frame corresponds to the depth frame at the
+        same index. Returns the depth frames and compressed frames.
+
+        """
+        wall, sphere = mock._make_mock((424, 512))
+        frames = []
+        for dx in range(0, dx_step*n_frames, dx_step) if dx_step else [0] * n_frames:
+            df = np.asarray(np.minimum(wall, np.roll(sphere, dx, 1)), dtype=np.uint16)
+            frames.append(mock.DepthFrame(data=bytes(df.data), shape=df.shape[::-1]))
+
+        compressed = []
+        fc = DepthFrameCompressor(self.kinect, io_loop=self.io_loop, backend='inline',
+                **kwargs)
+        @fc.on_compressed_frame.connect_via(fc)
+        def new_compressed_frame(_, compressed_frame):
+            compressed.append(compressed_frame)
+
+        for depth_frame in frames:
+            self.kinect.on_depth_frame.send(self.kinect, depth_frame=depth_frame)
+        self.keep_checking(lambda: len(compressed) == len(frames))
+        self.wait()
+        return frames, compressed
+
+    def test_delta_coded_frames_decompress(self):
+        frames, packets = self.compress_frames_inline(10, keyframe_interval=4)
+
+        decompressor = DepthFrameDecompressor()
+        for frame, packet in zip(frames, packets):
+            depth_frame = decompressor.decompress(packet)
+            expected = np.frombuffer(frame.data, dtype=np.uint16) & 0xfff
+            assert np.all(np.frombuffer(depth_frame.data, dtype=np.uint16) == expected)
+
+    def test_delta_coding_with_process_backend(self):
+        with self.kinect as kinect:
+            packets, t = self.wait_for_and_compress_frames(kinect, 10, 1.0,
+                    keyframe_interval=4)
+        assert len(packets) > 4
+
+        decompressor = DepthFrameDecompressor()
+        for packet in packets:
+            depth_frame = decompressor.decompress(packet)
+            assert np.all(np.frombuffer(depth_frame.data, dtype=np.uint16) >= 500)
+
+    def check_banded_frames_decompress(self, backend, keyframe_interval):
+        with self.kinect as kinect:
+            packets, t = self.wait_for_and_compress_frames(kinect, 10, 1.0,
+                    backend=backend, keyframe_interval=keyframe_interval, n_bands=4)
+        assert len(packets) > 4
+
+        decompressor = DepthFrameDecompressor()
+        for packet in packets:
+            assert len(packet) == 5
+            depth_frame = decompressor.decompress(packet)
+            assert np.all(np.frombuffer(depth_frame.data, dtype=np.uint16) >= 500)
+
+    def test_banded_frames_decompress(self):
+        self.check_banded_frames_decompress('process', 1)
+
+    def test_banded_delta_frames_decompress(self):
+        self.check_banded_frames_decompress('process', 4)
+
+    def test_banded_frames_with_thread_backend(self):
+        self.check_banded_frames_decompress('thread', 1)
+
+    def test_banded_frames_with_inline_backend(self):
+        self.check_banded_frames_decompress('inline', 4)
+
+    def check_background_frames(self, packets, n_bands):
+        decompressor = DepthFrameDecompressor()
+        depth_frames = []
+        for idx, packet in enumerate(packets):
+            header = parse_frame_header(packet[0])
+            assert header.frame_type == (_BACKGROUND_FRAME if idx % 4 == 0 else _FOREGROUND_FRAME)
+            assert len(packet) == 2 + n_bands * (2 if idx % 4 == 0 else 1)
+            depth_frame = decompressor.decompress(packet)
+            depth_frames.append(np.frombuffer(depth_frame.data, dtype=np.uint16).copy())
+        return depth_frames
+
+    def check_background_frames_decompress(self, n_bands):
+        frames, packets = self.compress_frames_inline(10, keyframe_interval=4,
+                n_bands=n_bands, codec='lz4_shuffle', background=True)
+        depth_frames = self.check_background_frames(packets, n_bands)
+        for frame, depth_frame in zip(frames, depth_frames):
+            assert np.all(depth_frame == np.frombuffer(frame.data, dtype=np.uint16))
+
+    def test_background_frames_decompress(self):
+        self.check_background_frames_decompress(1)
+
+    def test_banded_background_frames_decompress(self):
+        self.check_background_frames_decompress(3)
+
+    def test_background_with_process_backend(self):
+        with self.kinect as kinect:
+            packets, t = self.wait_for_and_compress_frames(kinect, 10, 1.0,
+                    keyframe_interval=4, codec='lz4_shuffle', background=True)
+        assert len(packets) > 4
+        for depth_frame in self.check_background_frames(packets, 1):
+            assert np.all(depth_frame >= 500)
+
+    def check_tile_frames_decompress(self, n_bands, tile_threshold):
+        frames, packets = self.compress_frames_inline(10, keyframe_interval=4,
+                n_bands=n_bands, codec='lz4_shuffle', tiles=True,
+                tile_threshold=tile_threshold)
+
+        decompressor = DepthFrameDecompressor()
+        for idx, (frame, packet) in enumerate(zip(frames, packets)):
+            header = parse_frame_header(packet[0])
+            assert header.frame_type == (_KEYFRAME if idx % 4 == 0 else _TILE_FRAME)
+            assert header.shape == frame.shape
+            assert len(packet) == 1 + n_bands + (0 if idx % 4 == 0 else 1)
+            depth_frame = decompressor.decompress(packet)
+            error = np.frombuffer(depth_frame.data, dtype=np.uint16).astype(np.int32) - \
+                    np.frombuffer(frame.data, dtype=np.uint16)
+            assert np.all(np.abs(error) <= tile_threshold)
+
+    def test_tile_frames_decompress(self):
+        self.check_tile_frames_decompress(1, 0)
+
+    def test_banded_tile_frames_decompress(self):
+        self.check_tile_frames_decompress(3, 0)
+
+    def test_lossy_tile_frames_decompress(self):
+        self.check_tile_frames_decompress(1, 8)
+
+    def test_tile_frames_of_static_scene_are_small(self):
+        frames, packets = self.compress_frames_inline(3, dx_step=0, codec='lz4_shuffle',
+                tiles=True)
+        keyframe_size = sum(len(part) for part in packets[0])
+        for packet in packets[1:]:
+            assert sum(len(part) for part in packet) * 100 < keyframe_size
+
+        decompressor = DepthFrameDecompressor()
+        for frame, packet in zip(frames, packets):
+            depth_frame = decompressor.decompress(packet)
+            assert bytes(depth_frame.data) == frame.data
+
+    def test_tile_frames_with_process_backend(self):
+        with self.kinect as kinect:
+            packets, t = self.wait_for_and_compress_frames(kinect, 10, 1.0,
+                    keyframe_interval=4, codec='lz4_shuffle', tiles=True)
+        assert len(packets) > 4
+
+        decompressor = DepthFrameDecompressor()
+        for packet in packets:
+            depth_frame = decompressor.decompress(packet)
+            assert np.all(np.frombuffer(depth_frame.data, dtype=np.uint16) >= 500)
+
     def test_getting_good_enough_compression(self):
         with self.kinect as kinect:
             packets, t = self.wait_for_and_compress_frames(kinect, 1024, 2.0)
         log.info('Got {0} compressed packets in {1:.2f} seconds'.format(len(packets), t))
-        size = sum(len(y) for y in packets)
+        size = sum(len(part) for y in packets for part in y)
         data_rate = (float(size) / t) / (1024*1024)
         log.info('Total size is {0} bytes => {1:.2f} Mbytes/s'.format(size, data_rate))
         assert data_rate < 80 * 1024 * 1024
@@ -0,0 +1,112 @@
+"""
+Shared memory depth frame rings
+
+"""
+import os
+import tempfile
+
+from nose.tools import raises
+import numpy as np
+
+from streamkinect2.compress import parse_frame_header
+from streamkinect2.mock import DepthFrame, MockKinect
+from streamkinect2.ring import DepthFrameRingReader, DepthFrameRingWriter
+
+from .util import AsyncTestCase
+
+def make_depth_frame(value, shape=(64, 48)):
+    w, h = shape
+    return DepthFrame(data=np.full((h, w), value, dtype=np.uint16).data, shape=shape)
+
+class TestRing(AsyncTestCase):
+    def setUp(self):
+        super(TestRing, self).setUp()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.kinect = MockKinect()
+        self.writer = DepthFrameRingWriter(self.kinect, self.path, n_slots=2,
+                shape=(64, 48), io_loop=self.io_loop)
+        self.messages = []
+        self.writer.on_compressed_frame.connect(self.on_compressed_frame,
+                sender=self.writer, weak=False)
+
+    def tearDown(self):
+        self.writer.close()
+        super(TestRing, self).tearDown()
+
+    def on_compressed_frame(self, writer, compressed_frame):
+        self.messages.append(compressed_frame)
+
+    def send_frames(self, values):
+        for value in values:
+            self.kinect.on_depth_frame.send(self.kinect, depth_frame=make_depth_frame(value))
+        self.keep_checking(lambda: len(self.messages) == len(values))
+        self.wait()
+
+    def test_frames_round_trip(self):
+        self.send_frames([1, 2])
+        reader = DepthFrameRingReader(self.path)
+        for value, msg in zip([1, 2], self.messages):
+            depth_frame = reader.decompress(msg)
+            assert depth_frame.shape == (64, 48)
+            assert np.all(np.frombuffer(depth_frame.data, dtype=np.uint16) == value)
+        assert reader.header.seq == 1
+        assert reader.n_lost == 0
+        assert parse_frame_header(self.messages[0][0]).codec_id == self.writer.codec.id
+
+    def test_reused_slot_is_lost(self):
+        self.send_frames([1, 2, 3])
+        reader = DepthFrameRingReader(self.path)
+        assert reader.decompress(self.messages[0]) is None
+        assert reader.n_lost == 1
+        assert reader.decompress(self.messages[2]) is not None
+        assert reader.n_lost == 2
+
+    def test_paused_writer_ignores_frames(self):
+        self.writer.pause()
+        self.kinect.on_depth_frame.send(self.kinect, depth_frame=make_depth_frame(1))
+        self.writer.resume()
+        self.send_frames([2])
+        assert parse_frame_header(self.messages[0][0]).seq == 0
+
+    def test_oversized_frames_dropped(self):
+        self.kinect.on_depth_frame.send(self.kinect,
+                depth_frame=make_depth_frame(1, (128, 48)))
+        assert self.writer.n_dropped == 1
+
+    def test_close_removes_file(self):
+        self.writer.close()
+        assert not os.path.exists(self.path)
+
+    def test_closed_writer_ignores_frames(self):
+        # A frame may arrive from the kinect thread as the writer closes
+        self.writer.close()
+        self.writer.resume()
+        self.writer._on_depth_frame(self.kinect, make_depth_frame(1))
+        assert self.writer._n_written == 0
+
+    def test_reader_close_keeps_returned_frames(self):
+        self.send_frames([1])
+        reader = DepthFrameRingReader(self.path)
+        depth_frame = reader.decompress(self.messages[0])
+        reader.close()
+        assert np.all(np.frombuffer(depth_frame.data, dtype=np.uint16) == 1)
+        reader.close()
+
+    @raises(ValueError)
+    def test_closed_reader_rejects_frames(self):
+        self.send_frames([1])
+        reader = DepthFrameRingReader(self.path)
+        reader.close()
+        reader.decompress(self.messages[0])
+
+@raises(ValueError)
+def test_reader_rejects_other_files():
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(b'\0' * 128)
+        f.flush()
+        DepthFrameRingReader(f.name)
+
+@raises(ValueError)
+def test_writer_needs_two_slots():
+    DepthFrameRingWriter(MockKinect(), os.devnull, n_slots=1)
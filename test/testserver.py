@@ -3,11 +3,18 @@ Basic server support
 """
 
 from logging import getLogger
-from tornado.testing import AsyncTestCase
+import os
+from nose.tools import raises
+import zmq
 from zmq.eventloop.ioloop import ZMQIOLoop
+from zmq.eventloop.zmqstream import ZMQStream
+from streamkinect2.common import EndpointType, MessageType, make_msg, parse_msg
+from streamkinect2 import server as server_module
 from streamkinect2.server import Server
 from streamkinect2.mock import MockKinect
 
+from .util import AsyncTestCase
+
 log = getLogger(__name__)
 
 def test_no_server_start():
@@ -46,6 +53,211 @@ class TestServer(AsyncTestCase):
             self.server.remove_kinect(mock)
             assert len(self.server.kinects) == 0
 
+    def test_kinects_share_compression_pool(self):
+        mocks = [MockKinect(), MockKinect()]
+        for mock in mocks:
+            self.server.add_kinect(mock)
+        pools = set(r.depth_compresser.pool for r in self.server._kinects.values())
+        assert len(pools) == 1
+
+    def test_stop_with_running_kinect(self):
+        mock = MockKinect()
+        self.server.start()
+        self.server.add_kinect(mock, codec='raw')
+        record = self.server._kinects[mock.unique_kinect_id]
+        depth_compresser = record.depth_compresser
+        self.server._on_subscription(record.streams[EndpointType.depth], [b'\x01'])
+        assert not depth_compresser.is_paused
+
+        with mock:
+            self.keep_checking(lambda: depth_compresser.n_compressed > 0)
+            self.wait()
+
+            # The kinect keeps running but nothing is compressed
+            self.server.stop()
+            assert depth_compresser.is_paused
+            assert depth_compresser.pool is self.server._compression_pool
+
+            # Restarting resumes the stream with the same pool
+            self.server.start()
+            assert not depth_compresser.is_paused
+            n_compressed = depth_compresser.n_compressed
+            self.keep_checking(lambda: depth_compresser.n_compressed > n_compressed)
+            self.wait()
+
+        self.server.remove_kinect(mock)
+        assert self.server._compression_pool is None
+
+    def test_codec_advertised(self):
+        mock = MockKinect()
+        self.server.add_kinect(mock, codec='raw')
+        devices = self.server._current_me()['devices']
+        assert devices[0]['codecs']['depth'] == 'raw'
+
+    def test_pyramid_endpoints_advertised(self):
+        mock = MockKinect()
+        self.server.add_kinect(mock, codec='raw', pyramid_levels=2)
+        device = self.server._current_me()['devices'][0]
+        assert set(device['endpoints'].keys()) == set(['depth', 'depth_half', 'depth_quarter'])
+        assert len(set(device['endpoints'].values())) == 3
+        assert device['codecs']['depth_quarter'] == 'raw'
+        self.server.remove_kinect(mock)
+
+    def test_multiplexed_depth_endpoints_advertised(self):
+        self.server.multiplex_depth = True
+        mocks = [MockKinect(), MockKinect()]
+        for mock in mocks:
+            self.server.add_kinect(mock, pyramid_levels=1)
+        devices = self.server._current_me()['devices']
+        endpoints = set(ep for d in devices for ep in d['endpoints'].values())
+        assert len(endpoints) == 1
+        topics = set(t for d in devices for t in d['topics'].values())
+        assert len(topics) == 4
+        for device in devices:
+            assert device['topics']['depth'].startswith(device['id'])
+
+    def test_local_endpoints_advertised(self):
+        server = Server(io_loop=self.io_loop, address='127.0.0.1', announce=False,
+                ipc=True, shared_memory=True)
+        mock = MockKinect()
+        server.add_kinect(mock, pyramid_levels=1)
+        device = server._current_me()['devices'][0]
+        assert set(device['local_endpoints'].keys()) == set(['depth', 'depth_half'])
+        assert all(ep.startswith('ipc://') for ep in device['local_endpoints'].values())
+        assert device['ring']['endpoint'].startswith('ipc://')
+        assert os.path.exists(device['ring']['path'])
+        server.remove_kinect(mock)
+        assert not os.path.exists(device['ring']['path'])
+
+    def test_stop_removes_local_files(self):
+        server = Server(io_loop=self.io_loop, address='127.0.0.1', announce=False,
+                start_immediately=True, ipc=True, shared_memory=True)
+        server.add_kinect(MockKinect())
+        local_dir = os.path.dirname(server._current_me()['devices'][0]['ring']['path'])
+        assert os.path.isdir(local_dir)
+        server.stop()
+        assert not os.path.exists(local_dir)
+
+    def test_pipelined_control_requests(self):
+        dealer = zmq.Context.instance().socket(zmq.DEALER)
+        stream = ZMQStream(dealer, self.io_loop)
+        replies = []
+        def on_recv(msg):
+            replies.append(msg)
+            if len(replies) == 3:
+                self.stop()
+        stream.on_recv(on_recv)
+
+        with self.server:
+            dealer.connect(self.server.endpoints[EndpointType.control])
+            for request_id in (b'1', b'2', b'3'):
+                stream.send_multipart([request_id, b''] + make_msg(MessageType.ping, None))
+            self.wait()
+        stream.close()
+
+        # Replies carry the id of their request
+        assert [r[0] for r in replies] == [b'1', b'2', b'3']
+        assert all(parse_msg(r[2:])[0] == MessageType.pong for r in replies)
+
+    def test_me_cached_until_devices_change(self):
+        me = self.server._current_me()
+        assert self.server._current_me() is me
+        type, payload = self.server._handle_control(MessageType.ping, None)
+        assert payload['etag'] == me['etag']
+
+        mock = MockKinect()
+        self.server.add_kinect(mock)
+        added = self.server._current_me()
+        assert added is not me
+        assert added['etag'] != me['etag']
+        assert len(added['devices']) == 1
+
+        self.server.remove_kinect(mock)
+        assert self.server._current_me()['etag'] not in (me['etag'], added['etag'])
+
+    def test_subscribe_shares_profiles(self):
+        mock = MockKinect()
+        self.server.add_kinect(mock)
+        def subscribe(**profile):
+            profile['id'] = mock.unique_kinect_id
+            return self.server._handle_control(MessageType.subscribe, profile)
+
+        type, first = subscribe(fps=5, decimation=2)
+        assert type == MessageType.subscribe
+        assert first['codec'] == 'lz4'
+        assert subscribe(fps=5, decimation=2)[1]['topic'] == first['topic']
+        type, other = subscribe(roi=[0, 0, 64, 64], codec='raw')
+        assert other['codec'] == 'raw'
+        assert other['topic'] != first['topic']
+        assert len(self.server._kinects[mock.unique_kinect_id].profiles) == 2
+
+    def test_idle_profiles_are_dropped(self):
+        mock = MockKinect()
+        self.server.add_kinect(mock)
+        record = self.server._kinects[mock.unique_kinect_id]
+        type, payload = self.server._handle_control(MessageType.subscribe,
+                { 'id': mock.unique_kinect_id, 'fps': 5, 'decimation': None })
+        assert type == MessageType.subscribe
+        profile, = record.profiles.values()
+        assert profile.selector.decimation == 1
+        assert profile.selector.is_paused
+
+        stream, topic = record.streams[EndpointType.depth], payload['topic'].encode('utf8')
+        self.server._on_subscription(stream, [b'\x01' + topic])
+        assert not profile.selector.is_paused
+        self.server._on_subscription(stream, [b'\x00' + topic])
+        assert len(record.profiles) == 0
+        assert profile.compresser not in record.routes
+
+    def test_unsubscribed_profiles_are_dropped(self):
+        mock = MockKinect()
+        self.server.add_kinect(mock)
+        record = self.server._kinects[mock.unique_kinect_id]
+        timeout = server_module._PROFILE_SUBSCRIBE_TIMEOUT
+        server_module._PROFILE_SUBSCRIBE_TIMEOUT = 0.1
+        try:
+            for fps in range(1, server_module._MAX_PROFILES + 1):
+                type, _ = self.server._handle_control(MessageType.subscribe,
+                        { 'id': mock.unique_kinect_id, 'fps': fps })
+                assert type == MessageType.subscribe
+            type, payload = self.server._handle_control(MessageType.subscribe,
+                    { 'id': mock.unique_kinect_id, 'fps': 100 })
+            assert type == MessageType.error
+        finally:
+            server_module._PROFILE_SUBSCRIBE_TIMEOUT = timeout
+
+        # Profiles nobody subscribed to make room for new ones
+        self.keep_checking(lambda: len(record.profiles) == 0)
+        self.wait()
+        type, _ = self.server._handle_control(MessageType.subscribe,
+                { 'id': mock.unique_kinect_id, 'fps': 100 })
+        assert type == MessageType.subscribe
+
+    def test_subscribe_rejects_bad_profiles(self):
+        mock = MockKinect()
+        self.server.add_kinect(mock)
+        for profile in ({ 'id': 'nonesuch' }, { 'id': mock.unique_kinect_id, 'decimation': 1.5 },
+                { 'id': mock.unique_kinect_id, 'codec': 'nonesuch' },
+                { 'id': mock.unique_kinect_id, 'fps': -1 },
+                { 'id': mock.unique_kinect_id, 'fps': float('nan') },
+                { 'id': mock.unique_kinect_id, 'decimation': float('inf') },
+                { 'id': mock.unique_kinect_id, 'roi': [0, 0, 1e400, 10] },
+                { 'id': mock.unique_kinect_id, 'roi': [0, 0, 0, 10] }):
+            type, payload = self.server._handle_control(MessageType.subscribe, profile)
+            assert type == MessageType.error
+
+    @raises(ValueError)
+    def test_adding_kinect_with_too_many_pyramid_levels(self):
+        self.server.add_kinect(MockKinect(), pyramid_levels=3)
+
+    @raises(ValueError)
+    def test_adding_kinect_with_unknown_pyramid_method(self):
+        self.server.add_kinect(MockKinect(), pyramid_levels=1, pyramid_method='mean')
+
+    @raises(ValueError)
+    def test_adding_kinect_with_unknown_codec(self):
+        self.server.add_kinect(MockKinect(), codec='nonesuch')
+
     def test_adding_kinects_before(self):
         mock = MockKinect()
         assert len(self.server.kinects) == 0